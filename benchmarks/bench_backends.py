@@ -0,0 +1,64 @@
+'''Benchmark packet extraction throughput: tshark vs native reader.
+
+Usage: python benchmarks/bench_backends.py [--file capture.pcap]
+                                           [--packets N]
+
+Without --file a synthetic capture with N SYN packets (plus DNS answers
+for their hostnames) is written to temporary directory with pcap_writer.
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet')))
+
+import pcap  # noqa: E402
+import generator  # noqa: E402
+import pcap_writer  # noqa: E402
+
+
+def write_synthetic_capture(path, packet_count):
+    chunks = generator.generate_chunks(1577836800, 1577836800 + 365 * 86400,
+                                       100.0, seed=1)
+    pcap_writer.write_capture(path, chunks, generator.domains,
+                              max_packets=packet_count)
+
+
+def measure(backend, path, size):
+    start = time.perf_counter()
+    count = 0
+    for _ in pcap.extract_packets(path, backend=backend):
+        count += 1
+    elapsed = time.perf_counter() - start
+    print(f'{backend:<8} {count:>10} packets {elapsed:9.3f}s '
+          f'{count / elapsed:12.0f} packets/s '
+          f'{size / elapsed / 2**20:9.1f} MiB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file', default=None)
+    parser.add_argument('--packets', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = args.file
+        if path is None:
+            path = os.path.join(temp_dir, 'synthetic.pcap')
+            write_synthetic_capture(path, args.packets)
+        size = os.path.getsize(path)
+        print(f'capture: {path} ({size / 2**20:.1f} MiB)')
+
+        measure('native', path, size)
+        if shutil.which('tshark'):
+            measure('tshark', path, size)
+        else:
+            print('tshark   not installed, skipped')
+
+
+if __name__ == '__main__':
+    main()
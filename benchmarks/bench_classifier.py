@@ -0,0 +1,107 @@
+'''Benchmark resource classification: linear substring scan vs
+DomainClassifier suffix lookup vs memory-mapped CompiledDomainClassifier.
+
+Usage: python benchmarks/bench_classifier.py [--hostnames N] [--seed S]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet')))
+
+from classifier import DomainClassifier  # noqa: E402
+from classifier import CompiledDomainClassifier  # noqa: E402
+
+lists_path = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet', 'resources', 'domain-lists'))
+assets_path = os.path.join(lists_path, 'assets', '_all.txt')
+ads_path = os.path.join(lists_path, 'ads', '_all.txt')
+
+
+def linear_classify(hostname, asset_hosts, ads_hosts):
+    '''Reference implementation replaced by DomainClassifier'''
+    if any(asset_host in hostname for asset_host in asset_hosts):
+        return 'asset'
+    if any(ads_host in hostname for ads_host in ads_hosts):
+        return 'ads'
+    return 'other'
+
+
+def sample_hostnames(count, ads_hosts, asset_hosts, rng):
+    '''Mix of ads, asset, subdomain-of-listed and unlisted hostnames'''
+    plain = ['google.com', 'www.reddit.com', 'github.com', 'vk.com',
+             'en.wikipedia.org', 'mail.yahoo.com', 'api.twitter.com']
+    hostnames = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.3:
+            hostnames.append(rng.choice(ads_hosts))
+        elif kind < 0.4:
+            hostnames.append('img' + str(rng.randint(0, 9)) + '.'
+                             + rng.choice(asset_hosts + ['akamaihd.net']))
+        elif kind < 0.5:
+            hostnames.append('x.' + rng.choice(ads_hosts))
+        else:
+            hostnames.append(rng.choice(plain))
+    return hostnames
+
+
+def measure(label, func, hostnames):
+    start = time.perf_counter()
+    results = [func(hostname) for hostname in hostnames]
+    elapsed = time.perf_counter() - start
+    print(f'{label:<20} {len(hostnames):>8} lookups  '
+          f'{elapsed:9.3f}s  {len(hostnames) / elapsed:12.0f} lookups/s')
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hostnames', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asset_hosts = [line.strip() for line in open(assets_path, 'r')]
+    ads_hosts = [line.strip() for line in open(ads_path, 'r')]
+    hostnames = sample_hostnames(args.hostnames, ads_hosts, asset_hosts,
+                                 random.Random(args.seed))
+
+    start = time.perf_counter()
+    classifier = DomainClassifier.from_files([('asset', assets_path),
+                                              ('ads', ads_path)])
+    print(f'{"classifier build":<20} {len(classifier):>8} entries   '
+          f'{time.perf_counter() - start:9.3f}s')
+
+    linear, linear_time = measure(
+        'linear scan',
+        lambda hostname: linear_classify(hostname, asset_hosts, ads_hosts),
+        hostnames)
+    indexed, indexed_time = measure(
+        'DomainClassifier', classifier.classify, hostnames)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, 'index.bin')
+        classifier.save(index_path)
+        start = time.perf_counter()
+        compiled = CompiledDomainClassifier.open(index_path)
+        compiled.classify('example.com')
+        print(f'{"compiled open":<20} {len(compiled):>8} entries   '
+              f'{time.perf_counter() - start:9.3f}s')
+        compiled_results, _ = measure(
+            'CompiledClassifier', compiled.classify, hostnames)
+        del compiled
+    if compiled_results != indexed:
+        print('compiled index results differ from DomainClassifier')
+
+    mismatches = sum(1 for a, b in zip(linear, indexed) if a != b)
+    print(f'speedup: {linear_time / indexed_time:.0f}x, '
+          f'mismatches: {mismatches}/{len(hostnames)} '
+          f'(substring matches that are not on a label boundary)')
+
+
+if __name__ == '__main__':
+    main()
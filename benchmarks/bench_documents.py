@@ -0,0 +1,181 @@
+'''Benchmark ES document schema: previous layout (stored date parts,
+analyzed hostnames, null values) vs current compact layout. Reports JSON
+bytes per document and conversion rate, and with --es-host also index
+store bytes per document and ingest rate measured on temporary indices.
+
+Usage: python benchmarks/bench_documents.py [--packets N] [--hostnames N]
+                                            [--es-host HOST] [--es-port N]
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet')))
+
+import elastic  # noqa: E402
+from packet import Packet, HostTable, parse_ip  # noqa: E402
+
+
+def legacy_document(packet):
+    '''Document layout used before schema version 2'''
+    date_time = datetime.fromtimestamp(packet.timestamp)
+    return {
+        'datetime': {
+            'timestamp': packet.timestamp,
+            'year': date_time.year,
+            'month': date_time.month,
+            'day': date_time.day,
+            'hour': date_time.hour,
+            'minute': date_time.minute,
+            'second': date_time.second
+        },
+        'tcp_stream': packet.tcp_stream,
+        'source': {
+            'ip': packet.src_address,
+            'port': packet.src_port,
+            'hostname': packet.src.hostname,
+            'domain': packet.src.domain,
+            'subdomain': packet.src.subdomain,
+            'fld': packet.src.fld
+        },
+        'destination': {
+            'ip': packet.dst_address,
+            'port': packet.dst_port,
+            'hostname': packet.dst.hostname,
+            'domain': packet.dst.domain,
+            'subdomain': packet.dst.subdomain,
+            'fld': packet.dst.fld
+        },
+        'resource': {
+            'type': packet.resource_type,
+            'category': None
+        }
+    }
+
+
+def legacy_mappings():
+    endpoint = {
+        "properties": {
+            "ip": {"type": "ip"},
+            "port": {"type": "integer"},
+            "hostname": {"type": "text"},
+            "domain": {"type": "keyword"},
+            "subdomain": {"type": "keyword"},
+            "fld": {"type": "keyword"}
+        }
+    }
+    date_parts = {part: {"type": "integer"} for part
+                  in ('year', 'month', 'day', 'hour', 'minute', 'second')}
+    return {
+        "properties": {
+            "datetime": {
+                "properties": dict(date_parts, timestamp={
+                    "type": "date", "format": "epoch_second"})
+            },
+            "tcp_stream": {"type": "integer"},
+            "source": endpoint,
+            "destination": endpoint,
+            "resource": {
+                "properties": {
+                    "type": {"type": "keyword"},
+                    "category": {"type": "keyword"}
+                }
+            }
+        }
+    }
+
+
+def synthetic_packets(count, hostname_count, seed):
+    '''Enriched packets, local source without hostname as in captures'''
+    rng = random.Random(seed)
+    hosts = HostTable()
+    targets = []
+    for index in range(hostname_count):
+        host = hosts.get(f'cdn{index}.example{index % 100}.com')
+        host.domain = f'example{index % 100}'
+        host.subdomain = f'cdn{index}'
+        host.fld = f'example{index % 100}.com'
+        host.resource_type = rng.choice(('ad', 'asset', 'content'))
+        targets.append((parse_ip(f'93.184.{index // 256 % 256}.'
+                                 f'{index % 256}')[1], host))
+    src = hosts.get('')
+    ip_version, src_ip = parse_ip('10.0.0.2')
+    packets = []
+    for index in range(count):
+        dst_ip, dst = targets[rng.randrange(hostname_count)]
+        packets.append(Packet(1577836800 + index * 0.01, index + 1, index,
+                              ip_version, src_ip, 10000 + index % 50000,
+                              src, dst_ip, 443, dst))
+    return packets
+
+
+def measure_documents(label, convert, packets):
+    started = time.perf_counter()
+    documents = [convert(packet) for packet in packets]
+    elapsed = time.perf_counter() - started
+    size = sum(len(json.dumps(document)) for document in documents)
+    print(f'{label:<10} {size / len(documents):8.0f} JSON bytes/doc '
+          f'{len(documents) / elapsed:12.0f} docs/s converted')
+    return documents
+
+
+def measure_index(label, client, index, body, documents):
+    client.indices.delete(index, ignore_unavailable=True)
+    client.indices.create(index, json.dumps(body))
+    try:
+        started = time.perf_counter()
+        for ok, item in elastic.helpers.streaming_bulk(
+                client, ({'_index': index, '_source': document}
+                         for document in documents),
+                chunk_size=1000, raise_on_error=False):
+            if not ok:
+                raise RuntimeError(f'Indexing failed: {item}')
+        client.indices.refresh(index)
+        elapsed = time.perf_counter() - started
+        client.indices.forcemerge(index, max_num_segments=1,
+                                  request_timeout=600)
+        store = client.indices.stats(index, metric='store')
+        size = store['indices'][index]['primaries']['store']['size_in_bytes']
+        print(f'{label:<10} {size / len(documents):8.0f} store bytes/doc '
+              f'{len(documents) / elapsed:12.0f} docs/s indexed')
+        return size
+    finally:
+        client.indices.delete(index, ignore_unavailable=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--packets', type=int, default=100000)
+    parser.add_argument('--hostnames', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--es-host', default=None)
+    parser.add_argument('--es-port', type=int, default=9200)
+    args = parser.parse_args()
+
+    packets = synthetic_packets(args.packets, args.hostnames, args.seed)
+    legacy = measure_documents('legacy', legacy_document, packets)
+    compact = measure_documents('compact', elastic.convert_to_document,
+                                packets)
+    if args.es_host is None:
+        return
+
+    settings = {"index.number_of_replicas": 0,
+                "index.refresh_interval": "-1"}
+    client = elastic.get_client(args.es_host, args.es_port)
+    legacy_size = measure_index(
+        'legacy', client, 'metanet-bench-legacy',
+        {"settings": settings, "mappings": legacy_mappings()}, legacy)
+    compact_size = measure_index(
+        'compact', client, 'metanet-bench-compact',
+        {"settings": dict(settings, **{"index.codec": "best_compression"}),
+         "mappings": elastic.packet_mappings()}, compact)
+    print(f'reduction: {legacy_size / compact_size:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''Benchmark sample generation: previous per-packet rejection sampling
+(list membership checks, one packet at a time) vs vectorized NumPy batches.
+Legacy generator is skipped above --legacy-limit packets, it is quadratic.
+Vectorized generator is measured with each of --workers process counts.
+
+Usage: python benchmarks/bench_generator.py [--days N] [--density D ...]
+                                            [--workers N ...]
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet')))
+
+import generator  # noqa: E402
+
+from_timestamp = 1577836800
+
+
+def legacy_sample(to_timestamp, desired_density, seed):
+    '''Timestamps and domains drawn as by previous generator'''
+    np.random.seed(seed)
+    sample_interval = to_timestamp - from_timestamp
+    timestamps = []
+    while len(timestamps) / sample_interval < desired_density:
+        interval = np.random.randint(*generator.batch_interval_generator_range)
+        density = np.random.random_sample() / 25
+        start = np.random.randint(from_timestamp, to_timestamp - interval)
+        count = round(density * interval)
+        batch = []
+        while len(batch) < count:
+            timestamp = np.random.randint(start, start + interval)
+            if timestamp not in batch:
+                batch.append(timestamp)
+        batch.sort()
+        timestamps.extend((timestamp, np.random.randint(
+            0, len(generator.domains))) for timestamp in batch)
+    timestamps.sort()
+    return timestamps
+
+
+def measure(label, generate):
+    started = time.perf_counter()
+    count = generate()
+    elapsed = time.perf_counter() - started
+    print(f'{label:<14} {count:>10} packets {elapsed:8.2f}s '
+          f'{count / elapsed:12.0f} packets/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--density', type=float, nargs='+',
+                        default=[0.02, 0.2, 2.0])
+    parser.add_argument('--legacy-limit', type=int, default=200000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    to_timestamp = from_timestamp + int(args.days * 86400)
+    for density in args.density:
+        print(f'density {density}:')
+        if density * args.days * 86400 <= args.legacy_limit:
+            measure('legacy', lambda: len(legacy_sample(
+                to_timestamp, density, args.seed)))
+        for workers in args.workers:
+            chunks = generator.generate_chunks(
+                from_timestamp, to_timestamp, density, args.seed,
+                workers=workers)
+            measure(f'vectorized x{workers}', lambda: sum(
+                len(chunk['timestamps']) for chunk in chunks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''Benchmark memory footprint of packet representation: nested dicts
+(previous layout) vs Packet records with interned Host instances.
+
+Usage: python benchmarks/bench_packets.py [--packets N] [--hostnames N]
+'''
+import os
+import sys
+import random
+import argparse
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'metanet')))
+
+from packet import Packet, HostTable, parse_ip  # noqa: E402
+
+
+def source_records(count, hostname_count, seed):
+    '''Raw (timestamp, stream, src ip, src host, src port, dst ip, dst host,
+    dst port) tuples as tshark would output them'''
+    rng = random.Random(seed)
+    hostnames = [f'Host{index}.Example{index % 100}.com'
+                 for index in range(hostname_count)]
+    for index in range(count):
+        host_index = rng.randrange(hostname_count)
+        yield (1577836800 + index * 0.01, index,
+               '10.0.0.2', '10.0.0.2', 10000 + index % 50000,
+               f'93.184.{host_index // 256 % 256}.{host_index % 256}',
+               hostnames[host_index], 443)
+
+
+def dict_packet(record):
+    (timestamp, tcp_stream, src_ip, src_host, src_port,
+     dst_ip, dst_host, dst_port) = record
+    return {
+        'timestamp': datetime.fromtimestamp(timestamp),
+        'tcp_stream': tcp_stream,
+        'src': {'ip': src_ip, 'hostname': str.lower(src_host),
+                'port': src_port, 'domain': None, 'subdomain': None,
+                'fld': None},
+        'dst': {'ip': dst_ip, 'hostname': str.lower(dst_host),
+                'port': dst_port, 'domain': None, 'subdomain': None,
+                'fld': None},
+        'metadata': {'resource_type': None}
+    }
+
+
+def record_packet(record, hosts):
+    (timestamp, tcp_stream, src_ip, src_host, src_port,
+     dst_ip, dst_host, dst_port) = record
+    ip_version, src_ip = parse_ip(src_ip)
+    _, dst_ip = parse_ip(dst_ip)
+    return Packet(timestamp, tcp_stream + 1, tcp_stream, ip_version,
+                  src_ip, src_port, hosts.get(src_host),
+                  dst_ip, dst_port, hosts.get(dst_host))
+
+
+def measure(label, build):
+    tracemalloc.start()
+    packets = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<16} {len(packets):>10} packets '
+          f'{current / 2**20:9.1f} MiB '
+          f'{current / len(packets):8.0f} bytes/packet '
+          f'(peak {peak / 2**20:.1f} MiB)')
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--packets', type=int, default=200000)
+    parser.add_argument('--hostnames', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    def records():
+        return source_records(args.packets, args.hostnames, args.seed)
+
+    dict_size = measure('nested dicts',
+                        lambda: [dict_packet(record)
+                                 for record in records()])
+
+    def build_records():
+        hosts = HostTable()
+        return [record_packet(record, hosts) for record in records()]
+
+    record_size = measure('Packet records', build_records)
+    print(f'reduction: {dict_size / record_size:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+'''Benchmark suite measuring analysis pipeline stage by stage.
+
+Every input (generated capture of given size or fixture capture) runs
+through stages one after another, each consuming output of previous ones
+held in memory, so stage timings do not include each other:
+
+- extract: packets read from capture (native backend by default)
+- tld: TLD lookup of every distinct hostname
+- classify: resource classification of every distinct hostname
+- analyze: enrichment of packets (TLD and classification, cached)
+- convert: conversion of packets into documents
+- index: bulk indexing into BulkStub, local stand-in for Elasticsearch
+
+Stage reports throughput, latency percentiles of batches of items (time
+between batch_size items passing through stage) and peak RSS. Results are
+written as JSON and compared with baseline results to flag regressions.
+'''
+import gc
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tempfile
+import collections
+import multiprocessing
+import click
+import numpy as np
+import simple_logger as logger
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import elastic
+import generator
+import pcap
+import pcap_writer
+import workload
+from cache import HostnameCache
+
+stages = ['extract', 'tld', 'classify', 'analyze', 'convert', 'index']
+results_version = 1
+
+# Generated captures: page loads model from 2020-01-01
+__generated_from = 1577836800
+__generated_density = 100.0
+
+
+class _BulkStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    documents = None
+
+    def log_message(self, *args):
+        pass
+
+    def __reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def __read_body(self):
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def do_HEAD(self):
+        # Indices and templates exist, so nothing is created
+        self.__reply({})
+
+    def do_GET(self):
+        self.__reply({'version': {'number': '7.6.0'}})
+
+    def do_PUT(self):
+        self.__read_body()
+        self.__reply({})
+
+    def do_DELETE(self):
+        self.__reply({})
+
+    def do_POST(self):
+        body = self.__read_body()
+        if '_bulk' not in self.path:
+            return self.__reply({})
+        # Every action is followed by document line
+        count = body.count(b'\n') // 2
+        with self.documents.get_lock():
+            self.documents.value += count
+        self.__reply({'took': 0, 'errors': False,
+                      'items': [{'index': {'status': 201}}] * count})
+
+
+def _serve_bulk_stub(host, port, documents, ports):
+    _BulkStubHandler.documents = documents
+    server = ThreadingHTTPServer((host, port), _BulkStubHandler)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class BulkStub:
+    '''Local stand-in for Elasticsearch speaking just enough of API for
+    indexing: _bulk requests are acknowledged (every document created) and
+    other requests succeed. Runs in own process, so it does not compete
+    for GIL with measured process. documents is number of received
+    documents'''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.__documents = multiprocessing.Value('q', 0)
+        self.__process = None
+
+    @property
+    def documents(self):
+        return self.__documents.value
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self.__process = multiprocessing.Process(
+            target=_serve_bulk_stub,
+            args=(self.host, self.port, self.__documents, ports),
+            daemon=True)
+        self.__process.start()
+        self.port = ports.get(timeout=10)
+        logger.log_debug(f'Bulk stub listening on {self.host}:{self.port}')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__process.terminate()
+        self.__process.join()
+
+
+def _reset_peak_rss():
+    '''Resets peak RSS of process (Linux), returns False if unsupported'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    '''Peak RSS since last reset, or of whole process if reset is not
+    supported'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class _BatchTimer:
+    '''Records time whenever batch_size items pass through track'''
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.count = 0
+        self.marks = []
+
+    def track(self, items):
+        self.marks.append(time.perf_counter())
+        for item in items:
+            yield item
+            self.count += 1
+            if self.count % self.batch_size == 0:
+                self.marks.append(time.perf_counter())
+        if self.count % self.batch_size or len(self.marks) == 1:
+            self.marks.append(time.perf_counter())
+
+    def latencies_ms(self):
+        '''Durations of full batches, or of single partial batch'''
+        durations = np.diff(self.marks) * 1000
+        if len(durations) > 1 and self.count % self.batch_size:
+            durations = durations[:-1]
+        return durations
+
+
+def _measure(input_name, stage, unit, batch_size, run):
+    '''Runs stage with run(track), where track wraps items stage goes
+    through. Returns (stage output, result)'''
+    gc.collect()
+    _reset_peak_rss()
+    timer = _BatchTimer(batch_size)
+    started = time.perf_counter()
+    output = run(timer.track)
+    seconds = time.perf_counter() - started
+
+    latencies = timer.latencies_ms()
+    p50, p90, p99 = (np.percentile(latencies, [50, 90, 99])
+                     if len(latencies) else (0.0, 0.0, 0.0))
+    result = {
+        'input': input_name,
+        'stage': stage,
+        'unit': unit,
+        'items': timer.count,
+        'seconds': seconds,
+        'throughput': timer.count / seconds if seconds else 0.0,
+        'batch_size': batch_size,
+        'latency_ms': {'p50': float(p50), 'p90': float(p90),
+                       'p99': float(p99)},
+        'peak_rss_mb': _peak_rss_mb()
+    }
+    logger.log_debug(f'{input_name} {stage}: {timer.count} {unit} in '
+                     f'{seconds:.2f}s')
+    return output, result
+
+
+def __consume(items):
+    collections.deque(items, maxlen=0)
+
+
+def generate_capture(path, packets, seed=1):
+    '''Writes capture of packets generated by page loads model'''
+    model = workload.create_model('pages', __generated_density)
+    chunks = generator.generate_chunks(
+        __generated_from, __generated_from + 100 * 365 * 86400,
+        __generated_density, seed, model=model)
+    pcap_writer.write_capture(path, chunks, model.hosts,
+                              max_packets=packets)
+
+
+def run_input(input_name, capture_path, selected=None, batch_size=1000,
+              backend='native', chunk_size=500, index_threads=2):
+    '''Runs selected stages (all by default) over capture, extraction
+    always runs. Returns list of stage results'''
+    selected = set(selected or stages)
+    results = []
+
+    packets, result = _measure(
+        input_name, 'extract', 'packets', batch_size,
+        lambda track: list(track(pcap.extract_packets(
+            capture_path, backend=backend))))
+    results.append(result)
+    # Hosts are interned, pipeline enriches each of them once
+    hostnames = list({host.hostname: None for packet in packets
+                      for host in (packet.src, packet.dst)})
+
+    if 'tld' in selected:
+        # TLD list is loaded on first lookup
+        pcap.lookup_tld('example.com')
+        results.append(_measure(
+            input_name, 'tld', 'hostnames', batch_size,
+            lambda track: __consume(track(map(pcap.lookup_tld,
+                                              hostnames))))[1])
+    if 'classify' in selected:
+        classifier = pcap.load_resource_classifier()
+        results.append(_measure(
+            input_name, 'classify', 'hostnames', batch_size,
+            lambda track: __consume(track(map(classifier.classify,
+                                              hostnames))))[1])
+    if 'analyze' in selected:
+        results.append(_measure(
+            input_name, 'analyze', 'packets', batch_size,
+            lambda track: __consume(track(pcap.analize_packets(
+                packets, HostnameCache()))))[1])
+    if 'convert' in selected:
+        results.append(_measure(
+            input_name, 'convert', 'documents', batch_size,
+            lambda track: __consume(track(map(elastic.convert_to_document,
+                                              packets))))[1])
+    if 'index' in selected:
+        with BulkStub() as stub:
+            es = elastic.MetanetElastic(hostname=stub.host, port=stub.port,
+                                        chunk_size=chunk_size,
+                                        thread_count=index_threads)
+            stats, result = _measure(
+                input_name, 'index', 'documents', batch_size,
+                lambda track: es.index_packets(track(packets)))
+            result['failed'] = stats.failed
+            # Packet documents and their rollups
+            result['received'] = stub.documents
+            results.append(result)
+    return results
+
+
+def run(sizes=(10000, 100000), fixtures=(), selected=None,
+        batch_size=1000, seed=1, **options):
+    '''Runs benchmark over generated captures of sizes (packets) and
+    fixture captures. Returns results document'''
+    results = []
+    with tempfile.TemporaryDirectory(prefix='metanet-bench-') as work_dir:
+        for size in sizes:
+            capture_path = os.path.join(work_dir, f'generated-{size}.pcap')
+            generate_capture(capture_path, size, seed)
+            results.extend(run_input(f'generated-{size}', capture_path,
+                                     selected, batch_size, **options))
+            os.remove(capture_path)
+    for fixture in fixtures:
+        results.extend(run_input(os.path.basename(fixture), fixture,
+                                 selected, batch_size, **options))
+
+    return {
+        'version': results_version,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': seed,
+        'results': results
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''Returns regressions [(input, stage, metric, baseline, current)] of
+    stages with throughput lower or peak RSS higher than baseline by more
+    than tolerance. Stages missing in baseline are not compared'''
+    baseline_results = {(result['input'], result['stage']): result
+                        for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        previous = baseline_results.get((result['input'], result['stage']))
+        if previous is None:
+            continue
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append((result['input'], result['stage'],
+                                'throughput', previous['throughput'],
+                                result['throughput']))
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append((result['input'], result['stage'],
+                                'peak_rss_mb', previous['peak_rss_mb'],
+                                result['peak_rss_mb']))
+    return regressions
+
+
+def echo_results(results, baseline=None):
+    '''Prints results table, with throughput change against baseline'''
+    baseline_results = {(result['input'], result['stage']): result
+                        for result in (baseline or {}).get('results', [])}
+    click.echo(f'{"input":<24} {"stage":<9} {"items":>10} {"seconds":>8} '
+               f'{"items/s":>12} {"p50 ms":>8} {"p99 ms":>8} '
+               f'{"rss MB":>8} {"change":>8}')
+    for result in results['results']:
+        previous = baseline_results.get((result['input'], result['stage']))
+        change = '-'
+        if previous and previous['throughput']:
+            ratio = result['throughput'] / previous['throughput']
+            change = f'{ratio - 1:+.0%}'
+        latency = result['latency_ms']
+        click.echo(f'{result["input"]:<24} {result["stage"]:<9} '
+                   f'{result["items"]:>10} {result["seconds"]:>8.2f} '
+                   f'{result["throughput"]:>12.0f} {latency["p50"]:>8.2f} '
+                   f'{latency["p99"]:>8.2f} {result["peak_rss_mb"]:>8.0f} '
+                   f'{change:>8}')
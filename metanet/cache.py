@@ -0,0 +1,94 @@
+import os
+import json
+import simple_logger as logger
+from collections import OrderedDict
+
+
+class HostnameCache:
+    '''Bounded LRU cache of hostname enrichment data.
+
+    Each entry stores (domain, subdomain, fld, resource_type) for hostname.
+    Cache can be persisted to JSON file so subsequent runs start warm. File
+    is ignored if it was written with different signature (e.g. domain
+    lists changed since).
+    '''
+
+    version = 1
+
+    def __init__(self, capacity=100000, path=None, signature=None):
+        self.capacity = capacity
+        self.path = path
+        self.signature = signature
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, hostname):
+        '''Returns cached entry for hostname or None'''
+        entry = self.__entries.get(hostname)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__entries.move_to_end(hostname)
+        return entry
+
+    def put(self, hostname, entry):
+        self.__entries[hostname] = tuple(entry)
+        self.__entries.move_to_end(hostname)
+        while len(self.__entries) > self.capacity:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0
+        return (f'hits={self.hits} misses={self.misses} '
+                f'hit_ratio={hit_ratio:.2%} size={len(self)} '
+                f'evictions={self.evictions}')
+
+    def load(self):
+        '''Loads entries from cache file if present and valid'''
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError) as ex:
+            logger.log_warning(f'Failed to load hostname cache '
+                               f'"{self.path}": {ex}')
+            return
+
+        if data.get('version') != self.version \
+                or data.get('signature') != self.signature:
+            logger.log_debug(f'Hostname cache "{self.path}" is stale, '
+                             f'ignoring')
+            return
+
+        for hostname, entry in data['entries']:
+            self.put(hostname, entry)
+        logger.log_debug(f'Loaded {len(self)} hostname cache entries '
+                         f'from "{self.path}"')
+
+    def save(self):
+        '''Saves entries to cache file, least recently used first'''
+        if self.path is None:
+            return
+
+        data = {
+            'version': self.version,
+            'signature': self.signature,
+            'entries': list(self.__entries.items())
+        }
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(temp_path, self.path)
+        logger.log_debug(f'Saved {len(self)} hostname cache entries '
+                         f'to "{self.path}"')
@@ -0,0 +1,282 @@
+import re
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+import tempfile
+from array import array
+
+# Compiled classifier index file layout (native byte order):
+#   magic, version, byte order, header length
+#   JSON header (signature, resource types, tokens, entry and table size)
+#   hash table (uint32 entry index + 1, 0 for empty slot)
+#   entry offsets (uint32, entry count + 1)
+#   entry ranks (uint8)
+#   entry blob (utf-8 domain suffixes)
+index_magic = b'MNDC'
+index_version = 1
+_index_preamble = '4sHBxI'
+
+
+class DomainClassifier:
+    '''Classifies hostnames into resource types using domain lists.
+
+    Dotted list entries are matched as domain suffixes on label boundaries,
+    so a lookup costs one hash probe per hostname label. Entries without a
+    dot (e.g. "akamai", "cdn") are partial tokens and match anywhere in the
+    hostname. Resource types are checked in the order they were added, so
+    earlier lists take precedence over later ones.
+    '''
+
+    def __init__(self, default='other'):
+        self.default = default
+        self.__resource_types = []
+        self.__suffixes = dict()
+        self.__tokens = []
+        self.__patterns = []
+
+    def add(self, resource_type, entries):
+        '''Adds domain list entries for resource_type. Lists added earlier
+        take precedence when hostname matches multiple lists'''
+        if resource_type not in self.__resource_types:
+            self.__resource_types.append(resource_type)
+            self.__tokens.append(set())
+            self.__patterns.append(None)
+        rank = self.__resource_types.index(resource_type)
+
+        tokens = self.__tokens[rank]
+        for entry in entries:
+            entry = entry.strip().lower().strip('.')
+            if not entry:
+                continue
+            if '.' not in entry:
+                tokens.add(entry)
+                continue
+            if rank < self.__suffixes.get(entry, len(self.__resource_types)):
+                self.__suffixes[entry] = rank
+
+        if tokens:
+            self.__patterns[rank] = re.compile(
+                '|'.join(re.escape(token) for token in sorted(tokens)))
+
+    def add_file(self, resource_type, path):
+        '''Adds domain list file (one entry per line) for resource_type'''
+        with open(path, 'r') as list_file:
+            self.add(resource_type, list_file)
+
+    def __len__(self):
+        return len(self.__suffixes) + sum(
+            len(tokens) for tokens in self.__tokens)
+
+    def match_rank(self, hostname):
+        '''Returns rank of best matching list or None if nothing matches'''
+        best_rank = None
+
+        suffix_start = 0
+        while suffix_start >= 0:
+            rank = self.__suffixes.get(hostname[suffix_start:])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank = rank
+                if best_rank == 0:
+                    return best_rank
+            suffix_start = hostname.find('.', suffix_start)
+            if suffix_start >= 0:
+                suffix_start += 1
+
+        limit = len(self.__patterns) if best_rank is None else best_rank
+        for rank in range(limit):
+            pattern = self.__patterns[rank]
+            if pattern is not None and pattern.search(hostname):
+                return rank
+
+        return best_rank
+
+    def classify(self, hostname):
+        '''Returns resource type for hostname'''
+        if not hostname:
+            return self.default
+        rank = self.match_rank(hostname.lower())
+        if rank is None:
+            return self.default
+        return self.__resource_types[rank]
+
+    def save(self, path, signature=None):
+        '''Writes compiled memory-mappable index of classifier to path'''
+        entries = sorted(self.__suffixes.items())
+        table_size = 1
+        while table_size < len(entries) * 2:
+            table_size *= 2
+
+        table = array('I', bytes(4 * table_size))
+        offsets = array('I', [0])
+        ranks = array('B')
+        blob = bytearray()
+        for index, (suffix, rank) in enumerate(entries):
+            encoded = suffix.encode('utf-8')
+            slot = zlib.crc32(encoded) & (table_size - 1)
+            while table[slot]:
+                slot = (slot + 1) & (table_size - 1)
+            table[slot] = index + 1
+            blob.extend(encoded)
+            offsets.append(len(blob))
+            ranks.append(rank)
+
+        header = json.dumps({
+            'signature': signature,
+            'resource_types': self.__resource_types,
+            'tokens': [sorted(tokens) for tokens in self.__tokens],
+            'entry_count': len(entries),
+            'table_size': table_size
+        }).encode('utf-8')
+
+        # Unique temporary file, so processes rebuilding stale index at the
+        # same time do not write into each other's file
+        descriptor, temp_path = tempfile.mkstemp(
+            prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+            dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(descriptor, 'wb') as index_file:
+                index_file.write(struct.pack(_index_preamble, index_magic,
+                                             index_version,
+                                             sys.byteorder == 'little',
+                                             len(header)))
+                index_file.write(header)
+                table.tofile(index_file)
+                offsets.tofile(index_file)
+                ranks.tofile(index_file)
+                index_file.write(blob)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def from_files(cls, lists, default='other'):
+        '''Creates classifier from ordered (resource_type, path) pairs'''
+        classifier = cls(default)
+        for resource_type, path in lists:
+            classifier.add_file(resource_type, path)
+        return classifier
+
+
+class CompiledDomainClassifier:
+    '''Domain classifier backed by index file written by
+    DomainClassifier.save.
+
+    Index is memory-mapped on first lookup, so loading costs only a file
+    open and lists of any size use almost no heap. Matching rules are the
+    same as in DomainClassifier.
+    '''
+
+    def __init__(self, path, default='other'):
+        self.path = path
+        self.default = default
+        self.signature = None
+        self.__resource_types = None
+        self.__patterns = None
+        self.__mapped = None
+
+    @classmethod
+    def open(cls, path, signature=None, default='other'):
+        '''Returns classifier for index at path or None when index is
+        missing, unreadable or written with different signature'''
+        try:
+            classifier = cls(path, default)
+            classifier.__read_header()
+        except (OSError, ValueError):
+            return None
+        if classifier.signature != signature:
+            return None
+        return classifier
+
+    def __read_header(self):
+        preamble_size = struct.calcsize(_index_preamble)
+        with open(self.path, 'rb') as index_file:
+            magic, version, little_endian, header_length = struct.unpack(
+                _index_preamble, index_file.read(preamble_size))
+            if magic != index_magic or version != index_version \
+                    or bool(little_endian) != (sys.byteorder == 'little'):
+                raise ValueError(f'Unsupported index file "{self.path}"')
+            header = json.loads(index_file.read(header_length))
+
+        self.signature = header['signature']
+        self.__resource_types = header['resource_types']
+        self.__token_count = sum(len(tokens) for tokens in header['tokens'])
+        self.__patterns = [
+            re.compile('|'.join(re.escape(token) for token in tokens))
+            if tokens else None
+            for tokens in header['tokens']]
+        self.__entry_count = header['entry_count']
+        self.__table_size = header['table_size']
+        self.__data_offset = preamble_size + header_length
+
+    def __map(self):
+        with open(self.path, 'rb') as index_file:
+            self.__mapped = mmap.mmap(index_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        view = memoryview(self.__mapped)
+
+        offset = self.__data_offset
+        table_end = offset + 4 * self.__table_size
+        offsets_end = table_end + 4 * (self.__entry_count + 1)
+        ranks_end = offsets_end + self.__entry_count
+        self.__table = view[offset:table_end].cast('I')
+        self.__offsets = view[table_end:offsets_end].cast('I')
+        self.__ranks = view[offsets_end:ranks_end]
+        self.__blob_offset = ranks_end
+
+    def __len__(self):
+        return self.__entry_count + self.__token_count
+
+    def __lookup(self, suffix):
+        mask = self.__table_size - 1
+        slot = zlib.crc32(suffix) & mask
+        while True:
+            index = self.__table[slot]
+            if not index:
+                return None
+            index -= 1
+            start = self.__blob_offset + self.__offsets[index]
+            end = self.__blob_offset + self.__offsets[index + 1]
+            if self.__mapped[start:end] == suffix:
+                return self.__ranks[index]
+            slot = (slot + 1) & mask
+
+    def match_rank(self, hostname):
+        '''Returns rank of best matching list or None if nothing matches'''
+        if self.__mapped is None:
+            self.__map()
+
+        encoded = hostname.encode('utf-8')
+        best_rank = None
+
+        suffix_start = 0
+        while suffix_start >= 0:
+            rank = self.__lookup(encoded[suffix_start:])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank = rank
+                if best_rank == 0:
+                    return best_rank
+            suffix_start = encoded.find(b'.', suffix_start)
+            if suffix_start >= 0:
+                suffix_start += 1
+
+        limit = len(self.__patterns) if best_rank is None else best_rank
+        for rank in range(limit):
+            pattern = self.__patterns[rank]
+            if pattern is not None and pattern.search(hostname):
+                return rank
+
+        return best_rank
+
+    def classify(self, hostname):
+        '''Returns resource type for hostname'''
+        if not hostname:
+            return self.default
+        rank = self.match_rank(hostname.lower())
+        if rank is None:
+            return self.default
+        return self.__resource_types[rank]
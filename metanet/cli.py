@@ -7,6 +7,16 @@ import elastic
 import kibana
 import simple_logger as logger
 import pcap
+import watch
+import live
+import frame_index
+import sinks
+import report
+import pcap_writer
+import workload
+import bench
+import metrics
+from packet import HostTable
 from datetime import datetime
 
 
@@ -14,9 +24,42 @@ from datetime import datetime
 @click.option('-v', '--verbose', 'verbose_logging',
               is_flag=True, default=False,
               help='Enable verbose logging')
-def cli(verbose_logging):
+@click.option('--log-level', 'log_level',
+              type=click.Choice(logger.levels), default='info',
+              show_default=True,
+              help='Minimal level of logged messages')
+@click.option('--log-format', 'log_format',
+              type=click.Choice(logger.formats), default='text',
+              show_default=True,
+              help='Log as text or JSON lines')
+@click.option('--metrics-file', 'metrics_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Write counters and stage timings into file at the end '
+              'of run')
+@click.option('--metrics-format', 'metrics_format',
+              type=click.Choice(metrics.formats), default=None,
+              help='Metrics file format (default: prometheus for .prom '
+              'files, JSON otherwise)')
+@click.option('--metrics-interval', 'metrics_interval',
+              type=click.FloatRange(min=1), default=None,
+              help='Also write metrics file every N seconds (for watch and '
+              'live analysis)')
+@click.option('--profile', 'profile_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Profile run with cProfile and write stats into file')
+@click.option('--tracemalloc', 'trace_memory',
+              is_flag=True, default=False,
+              help='Trace memory allocations and log top allocation sites '
+              'at the end')
+@click.pass_context
+def cli(ctx, verbose_logging, log_level, log_format, metrics_path,
+        metrics_format, metrics_interval, profile_path, trace_memory):
     '''Metanet Analyzer'''
-    logger.verbose = verbose_logging
+    logger.configure(log_level, log_format, verbose_logging)
+    instrumentation = metrics.Instrumentation(
+        metrics_path, metrics_format, metrics_interval, profile_path,
+        trace_memory).start()
+    ctx.call_on_close(instrumentation.finish)
 
 ##
 # Setup
@@ -113,27 +156,193 @@ def setup_cleanup(setup_ctx):
     logger.log_info("Cleanup configuration completed")
 
 
+@cli.group('indices')
+def indices_group():
+    '''Daily packet indices commands'''
+    pass
+
+
+@indices_group.command('list')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def indices_list(es_host, es_port):
+    '''List daily packet indices'''
+    es = elastic.MetanetElastic(hostname=es_host, port=es_port)
+    for date, index in es.daily_indices():
+        click.echo(index)
+
+
+@indices_group.command('prune')
+@click.option('--older-than', 'days',
+              type=click.IntRange(min=0), required=True,
+              help='Drop daily indices older than this many days')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def indices_prune(days, es_host, es_port):
+    '''Drop daily packet indices outside of retention period'''
+    es = elastic.MetanetElastic(hostname=es_host, port=es_port)
+    dropped = es.drop_older_than(days)
+    logger.log_info(f"Dropped {len(dropped)} indices")
+
+
+@indices_group.command('migrate')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def indices_migrate(es_host, es_port):
+    '''Rewrite indices created by previous versions into current schema'''
+    es = elastic.MetanetElastic(hostname=es_host, port=es_port)
+    try:
+        migrated = es.migrate()
+    except RuntimeError as ex:
+        raise click.ClickException(ex) from ex
+    logger.log_info(f"Migrated {len(migrated)} indices")
+
+
+@cli.group('lists')
+def lists_group():
+    '''Domain lists commands'''
+    pass
+
+
+@lists_group.command('compile')
+def lists_compile():
+    '''Compile domain lists into memory-mapped index'''
+    logger.log_info("Compiling domain lists index...")
+    classifier = pcap.compile_resource_classifier()
+    logger.log_info(f"Domain lists index compiled: {len(classifier)} entries")
+
+
 @cli.group('analyze')
 def analyze_group():
     '''Analyze packets'''
     pass
 
 
+def __frame_index_builder(pcap_path, build_index, backend, workers):
+    '''Returns builder writing frame index while capture is analyzed, or
+    None if index is not requested or analysis does not read frame offsets
+    (tshark, shards), in which case capture is indexed after analysis'''
+    if build_index and backend == 'native' and workers == 1:
+        return frame_index.FrameIndexBuilder(pcap_path)
+    return None
+
+
 @analyze_group.command('pcap')
 @click.option('-f', '--file', 'pcap_path',
               type=click.Path(exists=True),
               required=True,
               help='PCAP file path')
+@click.option('--backend',
+              type=click.Choice(pcap.backends), default='tshark',
+              show_default=True,
+              help='Packet extraction backend. Native backend reads '
+              'PCAP/PCAPNG files directly and does not require tshark')
+@click.option('--workers',
+              type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of worker processes. Capture is split into '
+              'frame range shards processed in parallel')
+@click.option('--frame-index', 'build_index',
+              is_flag=True, default=False,
+              help='Write sidecar frame offset index (<file>.idx) used by '
+              'extract command. Native backend with single worker writes '
+              'it while analyzing, otherwise capture is read again after '
+              'analysis')
+@click.option('--queue-size',
+              type=click.IntRange(min=1), default=10000, show_default=True,
+              help='Maximum number of packets queued between extract, '
+              'enrich and index stages')
+@click.option('--checkpoint', 'checkpoint_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Indexing progress file used to resume interrupted run '
+              '(default: <file>.progress.json)')
+@click.option('--restart', 'restart',
+              is_flag=True, default=False,
+              help='Index whole capture even if progress file exists')
+@click.option('-o', '--output', 'output_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Write packets into file instead of Elasticsearch '
+              '(.gz files are compressed)')
+@click.option('--format', 'output_format',
+              type=click.Choice(sinks.formats), default=None,
+              help='Output file format (default: guessed from file name, '
+              'ndjson otherwise). Bulk output is split into files of at '
+              'most --chunk-mb')
+@click.option('--row-group-size', 'row_group_size',
+              type=click.IntRange(min=1), default=65536, show_default=True,
+              help='Rows per row group of parquet and arrow output')
+@click.option('--cache-file', 'cache_file',
+              type=click.Path(dir_okay=False), default=None,
+              help='Persist hostname enrichment cache to file, so '
+              'subsequent runs start warm')
+@click.option('--cache-size', 'cache_size',
+              type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Maximum number of hostnames kept in enrichment cache')
+@click.option('--chunk-size', 'chunk_size',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Maximum number of documents per bulk request')
+@click.option('--chunk-mb', 'chunk_mb',
+              type=click.IntRange(min=1), default=10, show_default=True,
+              help='Maximum size of bulk request (MB)')
+@click.option('--index-threads', 'index_threads',
+              type=click.IntRange(min=1), default=2, show_default=True,
+              help='Number of concurrent bulk requests')
+@click.option('--max-retries', 'max_retries',
+              type=click.IntRange(min=0), default=5, show_default=True,
+              help='Retries with exponential backoff for documents '
+              'rejected because cluster is overloaded (429)')
 @click.option('--es-host', 'es_host',
               default='localhost',
               help='Elasticsearch host')
 @click.option('--es-port', 'es_port',
               default=9200,
               help='Elasticsearch port')
-def analyze_pcap(pcap_path, es_host, es_port):
+def analyze_pcap(pcap_path, backend, workers, build_index, queue_size,
+                 checkpoint_path, restart, output_path, output_format,
+                 row_group_size, cache_file, cache_size,
+                 chunk_size, chunk_mb, index_threads, max_retries,
+                 es_host, es_port):
     '''Analyze packets in PCAP file'''
 
     logger.log_info("Process packets")
+    if output_path is not None:
+        if checkpoint_path is not None or restart:
+            raise click.UsageError('--checkpoint and --restart apply only '
+                                   'to indexing, not to -o output')
+        try:
+            sink = sinks.open_sink(output_path, output_format,
+                                   chunk_mb * 1024 * 1024, row_group_size)
+        except ImportError as ex:
+            raise click.ClickException(ex) from ex
+
+        cache = pcap.load_hostname_cache(cache_file, cache_size)
+        index_builder = __frame_index_builder(pcap_path, build_index,
+                                              backend, workers)
+        logger.log_info("Processing and writing packets...")
+        sinks.write_packets(
+            pcap.analize_packets_from_file(pcap_path, workers, cache,
+                                           backend, queue_size,
+                                           index_builder=index_builder),
+            sink)
+        cache.save()
+
+        if build_index and index_builder is None:
+            frame_index.build_frame_index(pcap_path)
+
+        logger.log_info("Process packets completed")
+        return
+
     logger.log_info("Verify connection...")
     try:
         elastic.verify_connection(es_host, es_port)
@@ -143,7 +352,11 @@ def analyze_pcap(pcap_path, es_host, es_port):
 
     es = elastic.MetanetElastic(
         hostname=es_host,
-        port=es_port)
+        port=es_port,
+        chunk_size=chunk_size,
+        max_chunk_bytes=chunk_mb * 1024 * 1024,
+        thread_count=index_threads,
+        max_retries=max_retries)
 
     logger.log_info("Verify Elasticsearch configuration...")
     if not es.is_configured():
@@ -152,16 +365,237 @@ def analyze_pcap(pcap_path, es_host, es_port):
         return
     logger.log_info("Elasticsearch configured")
 
-    logger.log_info("Processing packets...")
-    packets = pcap.analize_packets_from_file(pcap_path)
+    cache = pcap.load_hostname_cache(cache_file, cache_size)
+
+    capture = pcap.capture_identity(pcap_path)
+    checkpoint = elastic.IndexCheckpoint(
+        checkpoint_path or f'{pcap_path}.progress.json', capture,
+        mode='parallel' if workers > 1 else 'sequential', backend=backend)
+    if not restart:
+        try:
+            checkpoint.load()
+        except ValueError as ex:
+            raise click.ClickException(
+                f'{ex}, resume with the same --workers and --backend or '
+                f'use --restart to index whole capture again') from ex
+    if checkpoint.packets:
+        logger.log_info(f"Resuming after {checkpoint.packets} "
+                        f"indexed packets")
+
+    index_builder = __frame_index_builder(pcap_path, build_index, backend,
+                                          workers)
+    logger.log_info("Processing and indexing packets...")
+    with es.bulk_load():
+        es.index_packets(
+            pcap.analize_packets_from_file(pcap_path, workers, cache,
+                                           backend, queue_size,
+                                           capture, checkpoint.packets,
+                                           index_builder),
+            checkpoint)
+    cache.save()
 
-    logger.log_info("Indexing packets...")
-    es.truncate()
-    es.index_packets(packets)
+    if build_index and index_builder is None:
+        frame_index.build_frame_index(pcap_path)
 
     logger.log_info("Process packets completed")
 
 
+@analyze_group.command('watch')
+@click.option('-d', '--dir', 'capture_dir',
+              type=click.Path(exists=True, file_okay=False),
+              required=True,
+              help='Directory with rotating capture files')
+@click.option('--pattern',
+              default='*.pcap*', show_default=True,
+              help='Capture file name pattern')
+@click.option('--checkpoint', 'checkpoint_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Checkpoint file  [default: .metanet-checkpoint.json '
+              'in watched directory]')
+@click.option('--poll-interval',
+              type=click.FloatRange(min=0), default=5, show_default=True,
+              help='Seconds between directory scans')
+@click.option('--settle-time',
+              type=click.FloatRange(min=0), default=30, show_default=True,
+              help='Seconds newest capture must be unmodified before it is '
+              'considered complete')
+@click.option('--once',
+              is_flag=True, default=False,
+              help='Process completed captures and exit')
+@click.option('--backend',
+              type=click.Choice(pcap.backends), default='tshark',
+              show_default=True,
+              help='Packet extraction backend')
+@click.option('--cache-file', 'cache_file',
+              type=click.Path(dir_okay=False), default=None,
+              help='Persist hostname enrichment cache to file, so '
+              'subsequent runs start warm')
+@click.option('--cache-size', 'cache_size',
+              type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Maximum number of hostnames kept in enrichment cache')
+@click.option('--chunk-size', 'chunk_size',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Maximum number of documents per bulk request')
+@click.option('--chunk-mb', 'chunk_mb',
+              type=click.IntRange(min=1), default=10, show_default=True,
+              help='Maximum size of bulk request (MB)')
+@click.option('--index-threads', 'index_threads',
+              type=click.IntRange(min=1), default=2, show_default=True,
+              help='Number of concurrent bulk requests')
+@click.option('--max-retries', 'max_retries',
+              type=click.IntRange(min=0), default=5, show_default=True,
+              help='Retries with exponential backoff for documents '
+              'rejected because cluster is overloaded (429)')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def analyze_watch(capture_dir, pattern, checkpoint_path, poll_interval,
+                  settle_time, once, backend, cache_file, cache_size,
+                  chunk_size, chunk_mb, index_threads, max_retries,
+                  es_host, es_port):
+    '''Analyze capture files in directory as they are rotated'''
+
+    logger.log_info("Watch captures")
+    logger.log_info("Verify connection...")
+    try:
+        elastic.verify_connection(es_host, es_port)
+    except ConnectionError as ex:
+        raise click.ClickException(ex) from ex
+    logger.log_info("Elasticsearch available")
+
+    es = elastic.MetanetElastic(
+        hostname=es_host,
+        port=es_port,
+        chunk_size=chunk_size,
+        max_chunk_bytes=chunk_mb * 1024 * 1024,
+        thread_count=index_threads,
+        max_retries=max_retries)
+
+    logger.log_info("Verify Elasticsearch configuration...")
+    if not es.is_configured():
+        logger.log_error("Elasticsearch is not configured. "
+                         "Use 'setup init' to configure")
+        return
+    logger.log_info("Elasticsearch configured")
+
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(capture_dir,
+                                       '.metanet-checkpoint.json')
+    checkpoint = watch.CaptureCheckpoint(checkpoint_path)
+    checkpoint.load()
+    cache = pcap.load_hostname_cache(cache_file, cache_size)
+
+    logger.log_info("Watching captures, press Ctrl+C to stop...")
+    try:
+        es.index_packets(watch.watch_packets(
+            capture_dir, checkpoint,
+            pattern=pattern,
+            backend=backend,
+            cache=cache,
+            hosts=HostTable(cache_size),
+            poll_interval=poll_interval,
+            settle_time=settle_time,
+            once=once), checkpoint)
+    except KeyboardInterrupt:
+        logger.log_info("Watch interrupted")
+    cache.save()
+
+    logger.log_info(f"Watch captures stopped at {checkpoint}")
+
+
+@analyze_group.command('live')
+@click.option('-i', '--interface',
+              default=None,
+              help='Network interface to capture on')
+@click.option('--replay', 'replay_path',
+              type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Replay PCAP file through live pipeline instead of '
+              'capturing on interface')
+@click.option('--backend',
+              type=click.Choice(pcap.backends), default='tshark',
+              show_default=True,
+              help='Packet extraction backend used for --replay')
+@click.option('--queue-size',
+              type=click.IntRange(min=1), default=10000, show_default=True,
+              help='Maximum number of packets queued between stages')
+@click.option('--flush-size',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Bulk index when this many packets are buffered')
+@click.option('--flush-interval',
+              type=click.FloatRange(min=0), default=5, show_default=True,
+              help='Bulk index buffered packets at least this often '
+              '(seconds)')
+@click.option('--drop-when-full/--block-when-full',
+              default=None,
+              help='Drop packets or block capture when queue is full  '
+              '[default: drop for --interface, block for --replay]')
+@click.option('--cache-file', 'cache_file',
+              type=click.Path(dir_okay=False), default=None,
+              help='Persist hostname enrichment cache to file, so '
+              'subsequent runs start warm')
+@click.option('--cache-size', 'cache_size',
+              type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Maximum number of hostnames kept in enrichment cache')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def analyze_live(interface, replay_path, backend, queue_size, flush_size,
+                 flush_interval, drop_when_full, cache_file, cache_size,
+                 es_host, es_port):
+    '''Analyze live captured packets'''
+    if (interface is None) == (replay_path is None):
+        raise click.UsageError('Specify either --interface or --replay')
+
+    logger.log_info("Live analysis")
+    logger.log_info("Verify connection...")
+    try:
+        elastic.verify_connection(es_host, es_port)
+    except ConnectionError as ex:
+        raise click.ClickException(ex) from ex
+    logger.log_info("Elasticsearch available")
+
+    es = elastic.MetanetElastic(
+        hostname=es_host,
+        port=es_port)
+
+    logger.log_info("Verify Elasticsearch configuration...")
+    if not es.is_configured():
+        logger.log_error("Elasticsearch is not configured. "
+                         "Use 'setup init' to configure")
+        return
+    logger.log_info("Elasticsearch configured")
+
+    cache = pcap.load_hostname_cache(cache_file, cache_size)
+    hosts = HostTable(cache_size)
+    if replay_path is not None:
+        source = pcap.extract_packets(replay_path, backend=backend,
+                                      hosts=hosts)
+    else:
+        source = pcap.capture_packets(interface, hosts=hosts)
+    if drop_when_full is None:
+        drop_when_full = replay_path is None
+
+    pipeline = live.LivePipeline(source, es, cache,
+                                 queue_size=queue_size,
+                                 flush_size=flush_size,
+                                 flush_interval=flush_interval,
+                                 drop_when_full=drop_when_full)
+
+    logger.log_info("Capturing packets, press Ctrl+C to stop...")
+    completed = pipeline.run()
+    cache.save()
+
+    if not completed:
+        raise click.ClickException("Live analysis failed")
+    logger.log_info("Live analysis completed")
+
+
 @analyze_group.command('sample')
 @click.option('--from', 'from_datetime',
               type=click.DateTime(), required=True,
@@ -170,17 +604,70 @@ def analyze_pcap(pcap_path, es_host, es_port):
               type=click.DateTime(), required=True,
               help='Ending datetime for sample')
 @click.option('--density',
-              type=float, default=0.02, show_default=True,
+              type=click.FloatRange(min=0, min_open=True), default=0.02,
+              show_default=True,
               help='Minimum package count density for sample')
 @click.option('--interval-gen-range',
               nargs=2, type=int, default=(60, 600), show_default=True,
               help='MIN and MAX seconds for time interval when generating '
               'time interval for batches')
+@click.option('--model',
+              type=click.Choice(workload.models), default='batch',
+              show_default=True,
+              help='Traffic model: random batches to few domains, or page '
+              'loads over large host catalog')
+@click.option('--catalog-size', 'catalog_size',
+              type=click.IntRange(min=1), default=1000, show_default=True,
+              help='Number of sites, asset hosts and ad hosts (each) in '
+              'page loads catalog')
+@click.option('--zipf-exponent', 'zipf_exponent',
+              type=click.FloatRange(min=0), default=1.0, show_default=True,
+              help='Exponent of Zipf distributed host popularity')
+@click.option('--assets-per-page', 'assets_per_page',
+              type=click.FloatRange(min=0), default=8.0, show_default=True,
+              help='Mean number of asset hosts contacted per page load')
+@click.option('--ads-per-page', 'ads_per_page',
+              type=click.FloatRange(min=0), default=3.0, show_default=True,
+              help='Mean number of ad hosts contacted per page load')
+@click.option('--diurnal-amplitude', 'diurnal_amplitude',
+              type=click.FloatRange(0, 1), default=0.5, show_default=True,
+              help='Relative daily variation of page load rate')
+@click.option('--peak-hour', 'peak_hour',
+              type=click.FloatRange(0, 24), default=20, show_default=True,
+              help='Hour of day (UTC) with most page loads')
 @click.option('--plot',
               is_flag=True, default=False,
               help='Show graph of sample after generation completes')
+@click.option('--plot-output', 'plot_output',
+              type=click.Path(dir_okay=False), default=None,
+              help='Save graph into file (.png, .svg, .pdf) instead of '
+              'showing it, implies --plot')
 @click.option('--seed', type=int, default=None,
-              help='Seed value used in random generator')
+              help='Seed value used in random generator. Same seed gives '
+              'same sample for any number of workers')
+@click.option('--workers',
+              type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of worker processes generating sample chunks')
+@click.option('--cache-file', 'cache_file',
+              type=click.Path(dir_okay=False), default=None,
+              help='Persist hostname enrichment cache to file, so '
+              'subsequent runs start warm')
+@click.option('--cache-size', 'cache_size',
+              type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Maximum number of hostnames kept in enrichment cache')
+@click.option('--chunk-size', 'chunk_size',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Maximum number of documents per bulk request')
+@click.option('--chunk-mb', 'chunk_mb',
+              type=click.IntRange(min=1), default=10, show_default=True,
+              help='Maximum size of bulk request (MB)')
+@click.option('--index-threads', 'index_threads',
+              type=click.IntRange(min=1), default=2, show_default=True,
+              help='Number of concurrent bulk requests')
+@click.option('--max-retries', 'max_retries',
+              type=click.IntRange(min=0), default=5, show_default=True,
+              help='Retries with exponential backoff for documents '
+              'rejected because cluster is overloaded (429)')
 @click.option('--es-host', 'es_host',
               default='localhost',
               help='Elasticsearch host')
@@ -188,7 +675,11 @@ def analyze_pcap(pcap_path, es_host, es_port):
               default=9200,
               help='Elasticsearch port')
 def generate_sample(from_datetime, to_datetime, density, interval_gen_range,
-                    plot, seed, es_host, es_port):
+                    model, catalog_size, zipf_exponent, assets_per_page,
+                    ads_per_page, diurnal_amplitude, peak_hour, plot,
+                    plot_output, seed, workers, cache_file, cache_size,
+                    chunk_size, chunk_mb, index_threads, max_retries,
+                    es_host, es_port):
     '''Generate sample packages and analyze'''
     logger.log_info('Analize generated sample')
 
@@ -201,7 +692,11 @@ def generate_sample(from_datetime, to_datetime, density, interval_gen_range,
 
     es = elastic.MetanetElastic(
         hostname=es_host,
-        port=es_port)
+        port=es_port,
+        chunk_size=chunk_size,
+        max_chunk_bytes=chunk_mb * 1024 * 1024,
+        thread_count=index_threads,
+        max_retries=max_retries)
 
     logger.log_info("Verify Elasticsearch configuration...")
     if not es.is_configured():
@@ -211,27 +706,359 @@ def generate_sample(from_datetime, to_datetime, density, interval_gen_range,
     logger.log_info("Elasticsearch configured")
 
     logger.log_info("Generating packets...")
-    generator.batch_interval_generator_range = interval_gen_range
+    if seed is None:
+        seed = generator.random_seed()
+    logger.log_info(f"Using seed {seed}")
+    traffic_model = workload.create_model(
+        model, density, interval_gen_range, catalog_size, zipf_exponent,
+        assets_per_page, ads_per_page, diurnal_amplitude, peak_hour)
 
-    sample = generator.generate_sample(
-        from_timestamp=datetime.timestamp(from_datetime),
-        to_timestamp=datetime.timestamp(to_datetime),
-        desired_density=density,
-        seed=seed)
-    logger.log_info(f"Generated {len(sample['packets'])} packets")
+    def sample_chunks():
+        return generator.generate_chunks(
+            from_timestamp=datetime.timestamp(from_datetime),
+            to_timestamp=datetime.timestamp(to_datetime),
+            desired_density=density,
+            seed=seed,
+            workers=workers,
+            model=traffic_model)
+
+    cache = pcap.load_hostname_cache(cache_file, cache_size)
 
-    logger.log_info("Analyzing packets...")
-    pcap.analize_packets(sample['packets'])
-    
-    logger.log_info("Indexing packets...")
-    es.truncate()
-    es.index_packets(sample['packets'])
+    logger.log_info("Analyzing and indexing packets...")
+    with es.bulk_load():
+        es.index_packets(pcap.analize_packets(
+            generator.chunk_packets(sample_chunks(), traffic_model.hosts),
+            cache))
+    cache.save()
 
-    if plot:
-        plotter.plot_sample_packets(sample['packets'])
+    if plot or plot_output:
+        plotter.plot_sample_packets(generator.chunk_packets(
+            sample_chunks(), traffic_model.hosts), plot_output)
 
     logger.log_info("Process packets completed")
 
 
+##
+# Generate
+##
+
+
+@cli.group('generate')
+def generate_group():
+    '''Generate synthetic data'''
+    pass
+
+
+@generate_group.command('pcap')
+@click.option('-o', '--output', 'output_path',
+              type=click.Path(dir_okay=False), required=True,
+              help='Capture file path (.pcapng files are written as PCAPNG)')
+@click.option('--format', 'capture_format',
+              type=click.Choice(pcap_writer.formats), default=None,
+              help='Capture file format (default: guessed from file name)')
+@click.option('--size',
+              default=None,
+              help='Stop when capture reaches size (e.g. 500MB, 20GB)')
+@click.option('--packets', 'packet_count',
+              type=click.IntRange(min=1), default=None,
+              help='Stop after this many SYN packets')
+@click.option('--from', 'from_datetime',
+              type=click.DateTime(), default='2020-01-01', show_default=True,
+              help='Starting datetime for sample')
+@click.option('--to', 'to_datetime',
+              type=click.DateTime(), default=None,
+              help='Ending datetime for sample (default: until size or '
+              'packets limit is reached)')
+@click.option('--density',
+              type=click.FloatRange(min=0, min_open=True), default=100.0,
+              show_default=True,
+              help='Packets per second')
+@click.option('--interval-gen-range',
+              nargs=2, type=int, default=(60, 600), show_default=True,
+              help='MIN and MAX seconds for time interval when generating '
+              'time interval for batches')
+@click.option('--model',
+              type=click.Choice(workload.models), default='batch',
+              show_default=True,
+              help='Traffic model: random batches to few domains, or page '
+              'loads over large host catalog')
+@click.option('--catalog-size', 'catalog_size',
+              type=click.IntRange(min=1), default=1000, show_default=True,
+              help='Number of sites, asset hosts and ad hosts (each) in '
+              'page loads catalog')
+@click.option('--zipf-exponent', 'zipf_exponent',
+              type=click.FloatRange(min=0), default=1.0, show_default=True,
+              help='Exponent of Zipf distributed host popularity')
+@click.option('--assets-per-page', 'assets_per_page',
+              type=click.FloatRange(min=0), default=8.0, show_default=True,
+              help='Mean number of asset hosts contacted per page load')
+@click.option('--ads-per-page', 'ads_per_page',
+              type=click.FloatRange(min=0), default=3.0, show_default=True,
+              help='Mean number of ad hosts contacted per page load')
+@click.option('--diurnal-amplitude', 'diurnal_amplitude',
+              type=click.FloatRange(0, 1), default=0.5, show_default=True,
+              help='Relative daily variation of page load rate')
+@click.option('--peak-hour', 'peak_hour',
+              type=click.FloatRange(0, 24), default=20, show_default=True,
+              help='Hour of day (UTC) with most page loads')
+@click.option('--seed', type=int, default=None,
+              help='Seed value used in random generator')
+@click.option('--workers',
+              type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of worker processes generating sample chunks')
+def generate_pcap(output_path, capture_format, size, packet_count,
+                  from_datetime, to_datetime, density, interval_gen_range,
+                  model, catalog_size, zipf_exponent, assets_per_page,
+                  ads_per_page, diurnal_amplitude, peak_hour, seed, workers):
+    '''Write synthetic capture of TCP SYN packets and DNS answers'''
+    if size is None and packet_count is None and to_datetime is None:
+        raise click.UsageError('One of --size, --packets or --to is required')
+    try:
+        max_bytes = size and pcap_writer.parse_size(size)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint='--size') from ex
+
+    if seed is None:
+        seed = generator.random_seed()
+    logger.log_info(f"Using seed {seed}")
+
+    from_timestamp = datetime.timestamp(from_datetime)
+    # Open ended sample, generation stops at size or packets limit
+    to_timestamp = datetime.timestamp(to_datetime) if to_datetime \
+        else from_timestamp + 100 * 365 * 86400
+    traffic_model = workload.create_model(
+        model, density, interval_gen_range, catalog_size, zipf_exponent,
+        assets_per_page, ads_per_page, diurnal_amplitude, peak_hour)
+    chunks = generator.generate_chunks(
+        from_timestamp=from_timestamp,
+        to_timestamp=to_timestamp,
+        desired_density=density,
+        seed=seed,
+        workers=workers,
+        model=traffic_model)
+    pcap_writer.write_capture(output_path, chunks, traffic_model.hosts,
+                              capture_format, max_bytes, packet_count)
+
+
+##
+# Report
+##
+
+
+@cli.command('report')
+@click.argument('report_name', type=click.Choice(report.reports))
+@click.option('--from', 'from_datetime',
+              type=click.DateTime(), default=None,
+              help='Only packets captured at or after datetime')
+@click.option('--to', 'to_datetime',
+              type=click.DateTime(), default=None,
+              help='Only packets captured at or before datetime')
+@click.option('--top',
+              type=click.IntRange(min=1), default=None,
+              help='Print only N rows with most packets')
+@click.option('--interval',
+              default='1h', show_default=True,
+              help='Time bucket size of timeline report (e.g. 1m, 1h, 1d)')
+@click.option('--format', 'output_format',
+              type=click.Choice(['table', 'json']), default='table',
+              show_default=True,
+              help='Print table or JSON lines')
+@click.option('--page-size', 'page_size',
+              type=click.IntRange(min=1), default=1000, show_default=True,
+              help='Number of buckets requested at a time')
+@click.option('--es-host', 'es_host',
+              default='localhost',
+              help='Elasticsearch host')
+@click.option('--es-port', 'es_port',
+              default=9200,
+              help='Elasticsearch port')
+def print_report(report_name, from_datetime, to_datetime, top, interval,
+                 output_format, page_size, es_host, es_port):
+    '''Print report aggregated by Elasticsearch: flds (destination first
+    level domains), sources or timeline'''
+    try:
+        elastic.verify_connection(es_host, es_port)
+    except ConnectionError as ex:
+        raise click.ClickException(ex) from ex
+
+    es = elastic.MetanetElastic(hostname=es_host, port=es_port)
+    try:
+        rows = report.report_rows(
+            es, report_name,
+            from_time=from_datetime and datetime.timestamp(from_datetime),
+            to_time=to_datetime and datetime.timestamp(to_datetime),
+            top=top, interval=interval, page_size=page_size)
+        report.echo_rows(report_name, rows, output_format)
+    except elastic.ElasticsearchException as ex:
+        raise click.ClickException(ex) from ex
+
+
+##
+# Plot
+##
+
+
+@cli.command('plot')
+@click.option('-f', '--file', 'input_path',
+              type=click.Path(dir_okay=False), required=True,
+              help='Capture file or analyze output file (bulk output is '
+              'read from all of its parts)')
+@click.option('--input-format', 'input_format',
+              type=click.Choice(['capture'] + sinks.formats), default=None,
+              help='Input file format (default: guessed from file name)')
+@click.option('--backend',
+              type=click.Choice(pcap.backends), default='native',
+              show_default=True,
+              help='Packet extraction backend for capture files')
+@click.option('-o', '--output', 'output_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Save graph into file (.png, .svg, .pdf) instead of '
+              'showing it')
+@click.option('--style',
+              type=click.Choice(plotter.styles), default='lines',
+              show_default=True,
+              help='Packet rate lines or density raster per destination')
+@click.option('--bins',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Number of time bins')
+@click.option('--top',
+              type=click.IntRange(min=1), default=20, show_default=True,
+              help='Number of destinations with own series, others are '
+              'merged')
+def plot_packets(input_path, input_format, backend, output_path, style,
+                 bins, top):
+    '''Plot packets per destination over time'''
+    if input_format is None and input_path.lower().endswith(
+            ('.pcap', '.pcapng', '.cap')):
+        input_format = 'capture'
+
+    try:
+        if input_format == 'capture':
+            points = plotter.packet_points(
+                pcap.extract_packets(input_path, backend=backend))
+        else:
+            points = sinks.read_destinations(input_path, input_format)
+        plotter.plot_points(points, output_path, style=style, bins=bins,
+                            top=top, title=os.path.basename(input_path))
+    except (OSError, ValueError, ImportError) as ex:
+        raise click.ClickException(ex) from ex
+
+
+##
+# Bench
+##
+
+
+@cli.command('bench')
+@click.option('--size', 'sizes',
+              type=click.IntRange(min=1), multiple=True,
+              default=(10000, 100000), show_default=True,
+              help='Packets of generated capture, repeat for more sizes')
+@click.option('-f', '--fixture', 'fixtures',
+              type=click.Path(exists=True, dir_okay=False), multiple=True,
+              help='Capture file benchmarked besides generated ones, '
+              'repeat for more files')
+@click.option('--stage', 'selected',
+              type=click.Choice(bench.stages), multiple=True,
+              help='Run only these stages (extract always runs), repeat '
+              'for more stages')
+@click.option('--backend',
+              type=click.Choice(pcap.backends), default='native',
+              show_default=True,
+              help='Packet extraction backend')
+@click.option('--batch-size', 'batch_size',
+              type=click.IntRange(min=1), default=1000, show_default=True,
+              help='Items per batch for latency percentiles')
+@click.option('--chunk-size', 'chunk_size',
+              type=click.IntRange(min=1), default=500, show_default=True,
+              help='Maximum number of documents per bulk request')
+@click.option('--index-threads', 'index_threads',
+              type=click.IntRange(min=1), default=2, show_default=True,
+              help='Number of concurrent bulk requests')
+@click.option('--seed', type=int, default=1, show_default=True,
+              help='Seed of generated captures')
+@click.option('-o', '--output', 'output_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Write results as JSON')
+@click.option('--baseline', 'baseline_path',
+              type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Compare with results of previous run, exits with error '
+              'on regression')
+@click.option('--tolerance',
+              type=click.FloatRange(min=0), default=0.2, show_default=True,
+              help='Allowed relative throughput drop or peak RSS growth '
+              'against baseline')
+def run_bench(sizes, fixtures, selected, backend, batch_size, chunk_size,
+              index_threads, seed, output_path, baseline_path, tolerance):
+    '''Benchmark pipeline stages over generated and fixture captures,
+    indexing into local stand-in for Elasticsearch'''
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = bench.run(sizes, fixtures, selected, batch_size, seed,
+                        backend=backend, chunk_size=chunk_size,
+                        index_threads=index_threads)
+    bench.echo_results(results, baseline)
+
+    if output_path:
+        with open(output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.log_info(f'Results written to "{output_path}"')
+
+    if baseline is not None:
+        regressions = bench.compare(results, baseline, tolerance)
+        for input_name, stage, metric, previous, current in regressions:
+            logger.log_warning(f'Regression {input_name} {stage}: {metric} '
+                               f'{previous:.1f} -> {current:.1f}')
+        if regressions:
+            raise click.ClickException(
+                f'{len(regressions)} regressions against baseline')
+        logger.log_info('No regressions against baseline')
+
+
+##
+# Extract
+##
+
+
+@cli.command('extract')
+@click.option('-f', '--file', 'pcap_path',
+              type=click.Path(exists=True, dir_okay=False),
+              required=True,
+              help='PCAP file path')
+@click.option('--stream', 'tcp_stream',
+              type=click.IntRange(min=0), required=True,
+              help='tcp_stream number of indexed packet')
+@click.option('-o', '--output', 'output_path',
+              type=click.Path(dir_okay=False, writable=True),
+              required=True,
+              help='Output capture file path')
+@click.option('--index', 'index_path',
+              type=click.Path(dir_okay=False), default=None,
+              help='Frame index path (default: <file>.idx)')
+@click.option('--from', 'from_datetime',
+              type=click.DateTime(), default=None,
+              help='Copy only frames captured at or after datetime')
+@click.option('--to', 'to_datetime',
+              type=click.DateTime(), default=None,
+              help='Copy only frames captured at or before datetime')
+def extract_stream(pcap_path, tcp_stream, output_path, index_path,
+                   from_datetime, to_datetime):
+    '''Extract tcp_stream frames into new capture file using frame index'''
+    index_path = index_path or frame_index.default_index_path(pcap_path)
+    if not os.path.exists(index_path):
+        frame_index.build_frame_index(pcap_path, index_path)
+
+    try:
+        frame_index.extract_stream(
+            pcap_path, tcp_stream, output_path, index_path,
+            from_time=from_datetime and datetime.timestamp(from_datetime),
+            to_time=to_datetime and datetime.timestamp(to_datetime))
+    except ValueError as ex:
+        raise click.ClickException(ex) from ex
+
+
 if __name__ == "__main__":
     cli()
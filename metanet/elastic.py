@@ -1,12 +1,303 @@
+import os
 import json
+import time
+import contextlib
 import click
+import itertools
+import collections
 import simple_logger as logger
+import rollup
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from elasticsearch import Elasticsearch, ElasticsearchException
+from elasticsearch import TransportError
+from elasticsearch import helpers
+
+
+# Version of document schema, stored in index mapping _meta so indices
+# written with older schema can be found and migrated
+schema_version = 2
+
+# Packets are written to daily indices, rollups to single index
+packet_index_prefix = 'metanet-packets-'
+rollup_index_name = 'metanet-rollup'
+# Outdated index is copied into temporary index while it is migrated
+migrate_index_prefix = 'metanet-migrate-'
+
+
+def __endpoint(address, port, host):
+    endpoint = {'ip': address, 'port': port}
+    # Unknown values are left out instead of stored as nulls
+    if host.hostname:
+        endpoint['hostname'] = host.hostname
+    if host.domain:
+        endpoint['domain'] = host.domain
+    if host.subdomain:
+        endpoint['subdomain'] = host.subdomain
+    if host.fld:
+        endpoint['fld'] = host.fld
+    return endpoint
+
+
+def convert_to_document(packet):
+    '''Converts packet into ES document. Date parts (year, hour, ...) are
+    not stored, Kibana derives them from timestamp with scripted fields'''
+    return {
+        'datetime': {'timestamp': packet.timestamp},
+        'tcp_stream': packet.tcp_stream,
+        'source': __endpoint(packet.src_address, packet.src_port,
+                             packet.src),
+        'destination': __endpoint(packet.dst_address, packet.dst_port,
+                                  packet.dst),
+        'resource': {'type': packet.resource_type}
+    }
+
+
+def packet_mappings():
+    '''Mappings of packet indices. Hostnames are keywords (aggregatable
+    from doc_values) instead of analyzed text'''
+    endpoint = {
+        "properties": {
+            "ip": {"type": "ip"},
+            "port": {"type": "integer"},
+            "hostname": {"type": "keyword", "ignore_above": 253},
+            "domain": {"type": "keyword"},
+            "subdomain": {"type": "keyword"},
+            "fld": {"type": "keyword"}
+        }
+    }
+    return {
+        "_meta": {"schema_version": schema_version},
+        # Fields not listed are kept in _source but not indexed (mapping
+        # is not strict, such documents are not rejected)
+        "dynamic": False,
+        "properties": {
+            "datetime": {
+                "properties": {
+                    "timestamp": {
+                        "type": "date",
+                        "format": "epoch_second"
+                    }
+                }
+            },
+            "tcp_stream": {"type": "integer"},
+            "source": endpoint,
+            "destination": endpoint,
+            "resource": {
+                "properties": {
+                    "type": {"type": "keyword"}
+                }
+            }
+        }
+    }
+
+
+def document_id(packet):
+    '''Returns deterministic document ID for packets read from capture
+    file, so indexing same capture again overwrites its documents. Live and
+    generated packets have no ID'''
+    if packet.capture is None or packet.frame < 0:
+        return None
+    return f'{packet.capture}-{packet.frame}'
+
+
+def daily_index(timestamp, prefix=packet_index_prefix):
+    '''Returns name of daily index for packet timestamp (UTC date)'''
+    date = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return f'{prefix}{date:%Y.%m.%d}'
+
+
+def packet_action(packet, prefix=packet_index_prefix):
+    '''Returns bulk index action of packet'''
+    action = {'_index': daily_index(packet.timestamp, prefix),
+              '_source': convert_to_document(packet)}
+    packet_id = document_id(packet)
+    if packet_id is not None:
+        action['_id'] = packet_id
+    return action
+
+
+def rollup_action(rollup_id, document, index=rollup_index_name):
+    '''Returns bulk index action of rollup document'''
+    action = {'_index': index, '_source': document}
+    if rollup_id is not None:
+        action['_id'] = rollup_id
+    return action
+
+
+def is_transient_failure(item):
+    '''True if failed bulk item may succeed when retried (rejected,
+    server or connection error), False for document errors'''
+    status = next(iter(item.values())).get('status')
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+class IndexCheckpoint:
+    '''Number of capture packets acknowledged by ES. Chunks are
+    acknowledged in the order packets were read, so interrupted run can be
+    resumed by skipping that many packets. Checkpoint is only valid for same
+    capture read in same order (mode) by same backend.
+
+    Open rollup buckets of attached aggregator are saved with checkpoint,
+    so resumed run continues them instead of overwriting rollups with
+    counts of resumed packets only'''
+
+    save_interval = 10
+
+    def __init__(self, path, capture, mode, backend=None):
+        self.path = path
+        self.capture = capture
+        self.mode = mode
+        self.backend = backend
+        self.packets = 0
+        self.stalled = False
+        self.rollups = None
+        self.rollup_state = None
+        self.__saved = time.monotonic()
+
+    def load(self):
+        '''Loads checkpoint of the same capture. Raises ValueError if it
+        was written by run with another mode or backend'''
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as checkpoint_file:
+            data = json.load(checkpoint_file)
+        if data.get('capture') != self.capture:
+            logger.log_warning(f'Checkpoint "{self.path}" is for another '
+                               f'capture, ignoring')
+            return
+        if data.get('mode') != self.mode \
+                or data.get('backend') != self.backend:
+            raise ValueError(f'Checkpoint "{self.path}" was written by '
+                             f'{data.get("mode")} run with '
+                             f'{data.get("backend")} backend')
+        self.packets = data['packets']
+        self.rollup_state = data.get('rollups')
+        logger.log_debug(f'Loaded checkpoint: {self.packets} packets')
+
+    def attach(self, rollups):
+        '''Attaches rollup aggregator fed with acknowledged packets,
+        restoring its open buckets from loaded checkpoint'''
+        self.rollups = rollups
+        if self.rollup_state is not None:
+            rollups.restore(self.rollup_state)
+            self.rollup_state = None
+
+    def acknowledge(self, packets, retry_needed=False):
+        '''Advances checkpoint over next chunk of packets. Once chunk needs
+        retry (transient failures), checkpoint stays before it, with rollups
+        of packets before it. Called before acknowledged packets are fed to
+        rollup aggregator'''
+        if retry_needed and not self.stalled:
+            self.stalled = True
+            if self.rollups is not None:
+                self.rollup_state = self.rollups.state()
+            logger.log_warning(f'Documents failed to index, checkpoint '
+                               f'stays after {self.packets} packets')
+        if self.stalled:
+            return
+        self.packets += len(packets)
+
+    def rolls_up(self, packet):
+        '''Returns whether acknowledged packet is fed to rollup
+        aggregator'''
+        return True
+
+    def save_periodically(self):
+        '''Saves checkpoint if save_interval elapsed since last save'''
+        if time.monotonic() - self.__saved >= self.save_interval:
+            self.save()
+
+    def rollups_data(self):
+        '''Returns rollup state matching acknowledged packets'''
+        if self.stalled or self.rollups is None:
+            return self.rollup_state
+        return self.rollups.state()
+
+    def data(self):
+        '''Returns checkpoint as saved'''
+        return {'capture': self.capture,
+                'mode': self.mode,
+                'backend': self.backend,
+                'packets': self.packets,
+                'rollups': self.rollups_data()}
+
+    def save(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(self.data(), checkpoint_file)
+        os.replace(temp_path, self.path)
+        self.__saved = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def finish(self):
+        '''Called once all packets are indexed'''
+        self.remove()
+
+
+class IndexStats:
+    '''Bulk indexing counters and throughput'''
+
+    reported_errors = 10
+
+    def __init__(self):
+        self.indexed = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = collections.Counter()
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def add_error(self, item):
+        '''Records failed bulk item, reporting first few in detail'''
+        self.failed += 1
+        operation, result = next(iter(item.items()))
+        error = result.get('error') or result.get('exception')
+        if isinstance(error, dict):
+            reason = error.get('type', 'unknown')
+        else:
+            reason = str(error).split(':')[0]
+        self.errors[f'{result.get("status", "N/A")} {reason}'] += 1
+        if self.failed <= self.reported_errors:
+            logger.log_warning(f'Failed to {operation} document: '
+                               f'status={result.get("status", "N/A")} '
+                               f'error={error}')
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.indexed / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f'indexed={self.indexed} failed={self.failed} '
+                f'chunks={self.chunks} elapsed={self.elapsed:.1f}s '
+                f'rate={self.rate:.0f} docs/s')
+
+
+# Connections kept per host, enough for concurrent bulk requests
+client_pool_size = 32
+
+__clients = dict()
+
+
+def get_client(hostname, port):
+    '''Returns Elasticsearch client shared by everything talking to host'''
+    client = __clients.get((hostname, port))
+    if client is None:
+        client = Elasticsearch(hosts=[{'host': hostname, 'port': port}],
+                               maxsize=client_pool_size)
+        __clients[(hostname, port)] = client
+    return client
 
 
 def verify_connection(hostname, port):
-    es_client = Elasticsearch(
-        hosts=[{'host': hostname, 'port': port}])
+    es_client = get_client(hostname, port)
 
     logger.log_debug(f'Trying to connect to ES instance '
                      f'at {hostname}:{port}')
@@ -23,104 +314,285 @@ def verify_connection(hostname, port):
 
 
 def list_indices(hostname='localhost', port=9200):
-    es_client = Elasticsearch(
-        hosts=[{'host': hostname, 'port': port}])
+    es_client = get_client(hostname, port)
 
     indices = es_client.indices.get_alias('*')
     return indices
 
 
 class MetanetElastic:
-    def __init__(self, hostname='localhost', port=9200):
+    '''Packets are written to daily indices (metanet-packets-YYYY.MM.DD,
+    by packet UTC date) created from index template. Template adds every
+    daily index to read alias (index_name) which is queried by Kibana, so
+    old data can be dropped by deleting whole indices'''
+
+    def __init__(self, hostname='localhost', port=9200,
+                 chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                 thread_count=2, max_retries=5,
+                 initial_backoff=2, max_backoff=60):
         self.hostname = hostname
         self.port = port
         self.index_name = 'metanet'
-        self.__es_client = Elasticsearch(
-            hosts=[{'host': hostname, 'port': port}])
+        self.index_prefix = packet_index_prefix
+        self.template_name = 'metanet-packets'
+        self.rollup_index_name = rollup_index_name
+        self.rollups = rollup.RollupAggregator()
+        self.__rollup_index_ready = False
+        self.__late_packets = 0
+        # Daily indices of running bulk load (index -> created by the load)
+        self.__bulk_indices = None
+        self.replicas = 1
+        self.refresh_interval = '1s'
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.__es_client = get_client(hostname, port)
+
+    def index_for(self, timestamp):
+        '''Returns name of daily index for packet timestamp'''
+        return daily_index(timestamp, self.index_prefix)
+
+    def daily_indices(self):
+        '''Returns [(date, index name)] of existing daily indices'''
+        indices = []
+        for index in self.__es_client.indices.get(
+                f'{self.index_prefix}*', ignore_unavailable=True):
+            try:
+                date = datetime.strptime(index[len(self.index_prefix):],
+                                         '%Y.%m.%d').date()
+            except ValueError:
+                continue
+            indices.append((date, index))
+        return sorted(indices)
+
+    def __has_legacy_index(self):
+        '''True if read alias name is taken by single index created by
+        previous versions'''
+        return self.__es_client.indices.exists(self.index_name) \
+            and not self.__es_client.indices.exists_alias(
+                name=self.index_name)
 
     def is_configured(self):
-        if self.__es_client.indices.exists(self.index_name):
-            logger.log_debug(f"Existing index '{self.index_name}' found")
+        if self.__es_client.indices.exists_template(self.template_name):
+            logger.log_debug(f"Existing template '{self.template_name}' "
+                             f"found")
             return True
         else:
-            logger.log_debug(f"No existing index '{self.index_name}' found")
+            logger.log_debug(f"No existing template '{self.template_name}' "
+                             f"found")
             return False
 
     def configure(self, force_create=False):
-        logger.log_debug(f"Create ES index")
+        logger.log_debug(f"Create ES index template")
+
+        if self.is_configured() or self.__has_legacy_index():
+            logger.log_debug(f"Found existing configuration")
+            if not force_create:
+                logger.log_error("Setup aborted. Use --force to overwrite")
+                return
+            self.cleanup()
+
+        self.__put_template()
+        self.ensure_rollup_index()
 
-        index_mapping = {
+    def __put_template(self):
+        index_template = {
+            "index_patterns": [f'{self.index_prefix}*'],
             "settings": {
-                "index.mapping.ignore_malformed": True
+                "index.mapping.ignore_malformed": True,
+                "index.codec": "best_compression",
+                "index.number_of_replicas": self.replicas,
+                "index.refresh_interval": self.refresh_interval
             },
+            "aliases": {
+                self.index_name: {}
+            },
+            "mappings": packet_mappings()
+        }
+
+        self.__es_client.indices.put_template(self.template_name,
+                                              json.dumps(index_template))
+
+        logger.log_debug(f"Template '{self.template_name}' created: "
+                         f"{json.dumps(index_template)}")
+
+    def ensure_rollup_index(self):
+        '''Creates rollup index if missing (e.g. setup done by previous
+        version)'''
+        if self.__rollup_index_ready:
+            return
+        self.__rollup_index_ready = True
+        if self.__es_client.indices.exists(self.rollup_index_name):
+            return
+
+        rollup_mapping = {
             "mappings": {
                 "properties": {
-                    "datetime": {
-                        "properties": {
-                            "timestamp": {
-                                "type": "date",
-                                "format": "epoch_second"
-                            },
-                            "year": {"type": "integer"},
-                            "month": {"type": "integer"},
-                            "day": {"type": "integer"},
-                            "hour": {"type": "integer"},
-                            "minute": {"type": "integer"},
-                            "second": {"type": "integer"}
-                        }
-                    },
-                    "tcp_stream": {"type": "integer"},
-                    "source": {
-                        "properties": {
-                            "ip": {"type": "ip"},
-                            "port": {"type": "integer"},
-                            "hostname": {"type": "text"},
-                            "domain": {"type": "keyword"},
-                            "subdomain": {"type": "keyword"},
-                            "fld": {"type": "keyword"}
-                        }
+                    "timestamp": {
+                        "type": "date",
+                        "format": "epoch_second"
                     },
+                    "interval": {"type": "integer"},
                     "destination": {
                         "properties": {
-                            "ip": {"type": "ip"},
-                            "port": {"type": "integer"},
-                            "hostname": {"type": "text"},
-                            "domain": {"type": "keyword"},
-                            "subdomain": {"type": "keyword"},
                             "fld": {"type": "keyword"}
-                        },
+                        }
                     },
                     "resource": {
                         "properties": {
-                            "type": {"type": "keyword"},
-                            "category": {"type": "keyword"}
+                            "type": {"type": "keyword"}
                         }
-                    }
+                    },
+                    "packets": {"type": "long"},
+                    "sources": {"type": "integer"}
                 }
             }
         }
 
-        if self.__es_client.indices.exists(self.index_name):
-            logger.log_debug(f"Found existing index '{self.index_name}'")
-            if not force_create:
-                logger.log_error("Setup aborted. Use --force to overwrite")
-                return
-            logger.log_debug(f"Removing existing index '{self.index_name}'")
-            self.__es_client.indices.delete(self.index_name)
+        self.__es_client.indices.create(self.rollup_index_name,
+                                        json.dumps(rollup_mapping))
+
+        logger.log_debug(f"Index '{self.rollup_index_name}' created: "
+                         f"{json.dumps(rollup_mapping)}")
+
+    def __schema_version(self, index):
+        mappings = self.__es_client.indices.get_mapping(index)[index]
+        return mappings['mappings'].get('_meta', {}).get('schema_version', 1)
+
+    def outdated_indices(self):
+        '''Returns packet indices written with older document schema,
+        including single index created by previous versions'''
+        indices = [index for _, index in self.daily_indices()
+                   if self.__schema_version(index) < schema_version]
+        if self.__has_legacy_index():
+            indices.insert(0, self.index_name)
+        return indices
+
+    def migrate(self, request_timeout=3600):
+        '''Rewrites outdated indices into current schema. Each index is
+        copied (and converted) into temporary index, deleted and copied
+        back into daily indices by packet date. Data of migrated index is
+        not visible through alias until its migration completes.
+
+        Every copy is checked (failures, number of documents) before next
+        step. When copying back fails, temporary index is kept and next
+        migration resumes from it. Returns migrated index names'''
+        self.__put_template()
+        outdated = self.outdated_indices()
+        migrated = []
+        for temp_index in self.__es_client.indices.get(
+                f'{migrate_index_prefix}*', ignore_unavailable=True):
+            index = temp_index[len(migrate_index_prefix):]
+            if index not in outdated:
+                # Source index was already deleted
+                logger.log_info(f"Resuming migration of index '{index}'")
+                self.__copy_back(index, temp_index, request_timeout)
+                migrated.append(index)
 
-        self.__es_client.indices.create(self.index_name,
-                                        json.dumps(index_mapping))
+        for index in outdated:
+            temp_index = f'{migrate_index_prefix}{index}'
+            logger.log_info(f"Migrating index '{index}'")
+            self.__es_client.indices.delete(temp_index,
+                                            ignore_unavailable=True)
+            self.__es_client.indices.create(
+                temp_index, json.dumps({"mappings": packet_mappings()}))
+            self.__es_client.indices.refresh(index)
+            response = self.__es_client.reindex(json.dumps({
+                "source": {"index": index},
+                "dest": {"index": temp_index},
+                "script": {"lang": "painless",
+                           "source": self.__convert_script}
+            }), refresh=True, request_timeout=request_timeout)
+            try:
+                self.__check_reindex(response, index, temp_index)
+            except RuntimeError:
+                self.__es_client.indices.delete(temp_index)
+                raise
 
-        logger.log_debug(f"Index '{self.index_name}' created: "
-                         f"{json.dumps(index_mapping)}")
+            # Legacy index must be gone before alias of same name is added
+            # to daily indices
+            self.__es_client.indices.delete(index)
+            self.__copy_back(index, temp_index, request_timeout)
+            migrated.append(index)
+        return migrated
+
+    def __copy_back(self, index, temp_index, request_timeout):
+        '''Copies converted documents of index from temporary index into
+        daily indices and deletes temporary index'''
+        response = self.__es_client.reindex(json.dumps({
+            "source": {"index": temp_index},
+            "dest": {"index": f'{self.index_prefix}migrate'},
+            "script": {"lang": "painless",
+                       "source": self.__route_script,
+                       "params": {"prefix": self.index_prefix}}
+        }), refresh=True, request_timeout=request_timeout)
+        try:
+            self.__check_reindex(response, temp_index, 'daily indices')
+        except RuntimeError:
+            logger.log_error(f"Documents of index '{index}' are kept in "
+                             f"'{temp_index}', run 'indices migrate' again "
+                             f"to resume its migration")
+            raise
+        self.__es_client.indices.delete(temp_index)
+
+    def __check_reindex(self, response, source, destination):
+        '''Raises RuntimeError unless reindex wrote every document of
+        source'''
+        expected = self.__es_client.count(index=source)['count']
+        failures = response.get('failures') or []
+        written = response.get('created', 0) + response.get('updated', 0)
+        if failures or response.get('timed_out') or written != expected:
+            details = f', first failure: {failures[0]}' if failures else ''
+            raise RuntimeError(f"Copying {expected} documents of '{source}' "
+                               f"into {destination} failed: {written} "
+                               f"written, {len(failures)} failures{details}")
+
+    # Drops stored date parts, resource category and empty values
+    __convert_script = '''
+        for (part in ['year', 'month', 'day', 'hour', 'minute', 'second']) {
+            ctx._source.datetime.remove(part);
+        }
+        if (ctx._source.resource != null) {
+            ctx._source.resource.remove('category');
+        }
+        for (side in ['source', 'destination']) {
+            if (ctx._source[side] != null) {
+                ctx._source[side].values().removeIf(v -> v == null || v == '');
+            }
+        }
+    '''
+
+    # Routes document into daily index by its UTC date
+    __route_script = '''
+        long millis = (long) (ctx._source.datetime.timestamp * 1000);
+        ctx._index = params.prefix + Instant.ofEpochMilli(millis)
+            .atZone(ZoneOffset.UTC)
+            .format(DateTimeFormatter.ofPattern('yyyy.MM.dd'));
+    '''
 
     def cleanup(self):
         logger.log_debug(f"ES cleanup'")
-        if self.__es_client.indices.exists(self.index_name):
+        if self.__has_legacy_index():
             logger.log_debug(f"Removing index '{self.index_name}'")
             self.__es_client.indices.delete(self.index_name)
+
+        logger.log_debug(f"Removing indices '{self.index_prefix}*'")
+        self.__es_client.indices.delete(f'{self.index_prefix}*',
+                                        ignore_unavailable=True)
+
+        logger.log_debug(f"Removing index '{self.rollup_index_name}'")
+        self.__es_client.indices.delete(self.rollup_index_name,
+                                        ignore_unavailable=True)
+        self.__rollup_index_ready = False
+
+        if self.__es_client.indices.exists_template(self.template_name):
+            logger.log_debug(f"Removing template '{self.template_name}'")
+            self.__es_client.indices.delete_template(self.template_name)
         else:
-            logger.log_debug(f"Index '{self.index_name}' not found")
+            logger.log_debug(f"Template '{self.template_name}' not found")
 
         logger.log_debug("ES cleanup completed")
 
@@ -130,46 +602,263 @@ class MetanetElastic:
         self.configure()
         logger.log_debug("Index truncated")
 
-    def index_packets(self, packets):
-        logger.log_debug(f'Indexing {len(packets)} packets in ES')
-
-        def convert_to_document(packet):
-            return {
-                'datetime': {
-                    'timestamp': packet['timestamp'].timestamp(),
-                    'year': packet['timestamp'].year,
-                    'month': packet['timestamp'].month,
-                    'day': packet['timestamp'].day,
-                    'hour': packet['timestamp'].hour,
-                    'minute': packet['timestamp'].minute,
-                    'second': packet['timestamp'].second
-                },
-                'tcp_stream': packet['tcp_stream'],
-                'source': {
-                    'ip': packet['src']['ip'],
-                    'port': packet['src']['port'],
-                    'hostname': packet['src']['hostname'],
-                    'domain': packet['src']['domain'],
-                    'subdomain': packet['src']['subdomain'],
-                    'fld': packet['src']['fld']
-                },
-                'destination': {
-                    'ip': packet['dst']['ip'],
-                    'port': packet['dst']['port'],
-                    'hostname': packet['dst']['hostname'],
-                    'domain': packet['dst']['domain'],
-                    'subdomain': packet['dst']['subdomain'],
-                    'fld': packet['dst']['fld']
-                },
-                'resource': {
-                    'type': packet['metadata']['resource_type'],
-                    'category': None
-                }
-            }
+    def drop_older_than(self, days):
+        '''Deletes daily indices older than days. Returns dropped names'''
+        oldest = datetime.now(timezone.utc).date() - timedelta(days=days)
+        dropped = [index for date, index in self.daily_indices()
+                   if date < oldest]
+        for index in dropped:
+            logger.log_info(f"Dropping index '{index}'")
+            self.__es_client.indices.delete(index)
+
+        oldest_timestamp = datetime.combine(
+            oldest, datetime.min.time(), timezone.utc).timestamp()
+        self.__es_client.delete_by_query(
+            self.rollup_index_name,
+            json.dumps({"query": {"range": {
+                "timestamp": {"lt": int(oldest_timestamp)}}}}),
+            ignore_unavailable=True)
+        return dropped
+
+    def composite_buckets(self, sources, aggs=None, query=None,
+                          page_size=1000, request_timeout=300):
+        '''Yields buckets of composite aggregation over packets, requesting
+        page_size buckets at a time with after_key of previous page.
+        Documents are never fetched and only one page is held in memory'''
+        composite = {"size": page_size, "sources": sources}
+        aggregation = {"composite": composite}
+        if aggs:
+            aggregation["aggs"] = aggs
+        body = {"size": 0, "aggs": {"buckets": aggregation}}
+        if query:
+            body["query"] = query
+
+        while True:
+            result = self.__es_client.search(
+                json.dumps(body), self.index_name,
+                request_timeout=request_timeout)
+            page = result['aggregations']['buckets']
+            yield from page['buckets']
+            if len(page['buckets']) < page_size or 'after_key' not in page:
+                break
+            composite["after"] = page['after_key']
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        '''Creates daily indices written while bulk loading without refresh
+        and replicas, and restores template settings of those indices
+        afterwards. Existing indices (retained data, indices written by
+        concurrent runs) are left as they are'''
+        self.__bulk_indices = dict()
+        try:
+            yield self
+        finally:
+            created = [index for index, is_created
+                       in self.__bulk_indices.items() if is_created]
+            self.__bulk_indices = None
+            if created:
+                self.__es_client.indices.put_settings(
+                    json.dumps({"index.refresh_interval":
+                                self.refresh_interval,
+                                "index.number_of_replicas": self.replicas}),
+                    ','.join(created))
+                self.__es_client.indices.refresh(','.join(created))
+                logger.log_debug(f'Bulk load settings restored: {created}')
+
+    def __prepare_index(self, index):
+        '''Creates daily index with bulk load settings if it does not exist
+        yet, records whether it was created by this load'''
+        is_created = False
+        if not self.__es_client.indices.exists(index):
+            result = self.__es_client.indices.create(index, json.dumps({
+                "settings": {"index.refresh_interval": "-1",
+                             "index.number_of_replicas": 0}}), ignore=400)
+            # Index created concurrently by another run is not ours
+            is_created = 'error' not in result
+        self.__bulk_indices[index] = is_created
+
+    def __actions(self, packets):
+        for packet in packets:
+            action = packet_action(packet, self.index_prefix)
+            if self.__bulk_indices is not None \
+                    and action['_index'] not in self.__bulk_indices:
+                self.__prepare_index(action['_index'])
+            yield action
+
+    def __rollup_actions(self, rollups):
+        for rollup_id, document in rollups:
+            yield rollup_action(rollup_id, document, self.rollup_index_name)
+
+    def index_rollups(self, flush=False):
+        '''Indexes closed rollup buckets (all buckets when flushing)'''
+        late_packets = self.rollups.late_packets - self.__late_packets
+        if late_packets:
+            metrics.inc('rollup_late_packets', late_packets)
+            self.__late_packets += late_packets
+        rollups = self.rollups.flush() if flush else self.rollups.closed()
+        if not rollups:
+            return
+        self.ensure_rollup_index()
+        stats = IndexStats()
+        self.__collect(stats, [], self.__index_chunk(
+            list(self.__rollup_actions(rollups))))
+        logger.log_debug(f"Indexed {stats.indexed} rollups, "
+                         f"{stats.failed} failed")
+
+    def __bulk_requests(self, sizes, positions):
+        '''Splits positions into bulk requests of at most max_chunk_bytes
+        (and chunk_size documents)'''
+        request, size = [], 0
+        for position in positions:
+            line_size = sizes[position]
+            if request and (size + line_size > self.max_chunk_bytes
+                            or len(request) >= self.chunk_size):
+                yield request
+                request, size = [], 0
+            request.append(position)
+            size += line_size
+        if request:
+            yield request
+
+    def __index_chunk(self, chunk):
+        '''Sends chunk using bulk requests of at most max_chunk_bytes.
+        Documents rejected with 429 are retried with exponential backoff.
+        Returns (indexed, {position in chunk: failed item})'''
+        started = time.perf_counter()
+        serializer = self.__es_client.transport.serializer
+        lines, sizes = [], []
+        for action in chunk:
+            operation, document = helpers.expand_action(action)
+            line = f'{serializer.dumps(operation)}\n' \
+                   f'{serializer.dumps(document)}\n'
+            lines.append(line)
+            sizes.append(len(line.encode('utf-8')))
+
+        failed = dict()
+        positions = range(len(chunk))
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(self.max_backoff,
+                               self.initial_backoff * 2 ** (attempt - 1)))
+            rejected = []
+            for request in self.__bulk_requests(sizes, positions):
+                try:
+                    response = self.__es_client.bulk(
+                        ''.join(lines[position] for position in request))
+                    items = response['items']
+                except TransportError as ex:
+                    # Whole request failed (connection error, overload)
+                    items = [{'index': {'status': ex.status_code,
+                                        'error': ex.error,
+                                        'exception': ex}}] * len(request)
+                for position, item in zip(request, items):
+                    status = next(iter(item.values())).get('status')
+                    if isinstance(status, int) and 200 <= status < 300:
+                        failed.pop(position, None)
+                        continue
+                    failed[position] = item
+                    if status == 429:
+                        rejected.append(position)
+            if not rejected:
+                break
+            positions = rejected
+        metrics.observe('index', time.perf_counter() - started, len(chunk))
+        return len(chunk) - len(failed), failed
+
+    def __collect(self, stats, packets, result, checkpoint=None):
+        '''Records result of indexed chunk of packets. Checkpoint is
+        advanced over the chunk and indexed packets are rolled up'''
+        indexed, failed = result
+        stats.indexed += indexed
+        stats.chunks += 1
+        for item in failed.values():
+            stats.add_error(item)
+        metrics.inc('bulk_batches')
+        metrics.inc('documents_indexed', indexed)
+        metrics.inc('documents_failed', len(failed))
+        metrics.inc('bulk_rejections', sum(
+            next(iter(item.values())).get('status') == 429
+            for item in failed.values()))
+        if checkpoint is not None:
+            checkpoint.acknowledge(packets, any(
+                map(is_transient_failure, failed.values())))
+        for position, packet in enumerate(packets):
+            if position not in failed \
+                    and (checkpoint is None or checkpoint.rolls_up(packet)):
+                self.rollups.observe(packet)
+        if checkpoint is not None:
+            checkpoint.save_periodically()
+
+    @staticmethod
+    def __result(pending):
+        '''Returns (packets, result) of oldest pending chunk'''
+        chunk, future = pending.popleft()
+        return chunk, future.result()
+
+    def index_packets(self, packets, checkpoint=None):
+        '''Indexes packets from any iterable, consuming it incrementally.
+
+        Packets are sent in chunks of chunk_size documents by thread_count
+        threads. At most 2 * thread_count chunks are in flight, so slow
+        cluster slows down consuming packets instead of buffering them.
+        Progress is recorded in checkpoint, which is removed once all
+        packets are indexed. Returns IndexStats'''
+        logger.log_debug(f'Indexing packets in ES: '
+                         f'chunk_size={self.chunk_size} '
+                         f'max_chunk_bytes={self.max_chunk_bytes} '
+                         f'threads={self.thread_count}')
+
+        stats = IndexStats()
+        pending = collections.deque()
+        if checkpoint is not None:
+            checkpoint.attach(self.rollups)
+        try:
+            with click.progressbar(packets,
+                                   label='Indexing') as packets_bar, \
+                    ThreadPoolExecutor(self.thread_count) as executor:
+                packets = iter(packets_bar)
+                while True:
+                    chunk = list(itertools.islice(packets, self.chunk_size))
+                    if not chunk:
+                        break
+                    if len(pending) >= 2 * self.thread_count:
+                        self.__collect(stats, *self.__result(pending),
+                                       checkpoint)
+                    pending.append((chunk, executor.submit(
+                        self.__index_chunk, list(self.__actions(chunk)))))
+                    self.index_rollups()
+                while pending:
+                    self.__collect(stats, *self.__result(pending),
+                                   checkpoint)
+                self.index_rollups(flush=True)
+        except BaseException:
+            if checkpoint is not None:
+                checkpoint.save()
+                logger.log_info(f'Indexing interrupted, progress saved: '
+                                f'{checkpoint.packets} packets')
+            raise
+        if checkpoint is not None:
+            if checkpoint.stalled:
+                checkpoint.save()
+                logger.log_warning(f'Some documents failed transiently, run '
+                                   f'again to resume after '
+                                   f'{checkpoint.packets} packets')
+            else:
+                checkpoint.finish()
+        stats.finish()
 
-        with click.progressbar(packets, label='Indexing') as packets_bar:
-            for packet in packets_bar:
-                self.__es_client.index(index=self.index_name,
-                                       body=convert_to_document(packet))
+        for error, count in stats.errors.most_common():
+            logger.log_warning(f'{count} documents failed: {error}')
+        logger.log_info(f'Indexing completed: {stats}')
+        return stats
 
-        logger.log_debug("Indexing completed")
+    def bulk_index_packets(self, packets):
+        '''Indexes batch of packets in the calling thread.
+        Returns (indexed, failed) document counts'''
+        stats = IndexStats()
+        self.__collect(stats, packets, self.__index_chunk(
+            list(self.__actions(packets))))
+        self.index_rollups()
+        logger.log_debug(f"Bulk indexed {stats.indexed} packets, "
+                         f"{stats.failed} failed")
+        return stats.indexed, stats.failed
@@ -0,0 +1,250 @@
+'''Sidecar frame offset index of capture files.
+
+Index is SQLite database mapping (tcp_stream, time bucket) to byte range of
+capture file holding that stream's frames in that bucket. Extracting single
+stream seeks directly to those ranges and copies matching frames into new
+capture, instead of re-reading whole multi-GB capture.
+
+Streams are numbered as tshark (and analysis) numbers them, conversation
+reusing ports of earlier one is new stream. Stream owns frames of its
+conversation from its first frame up to first frame of the next stream of
+the same conversation.
+'''
+import os
+import json
+import sqlite3
+import collections
+import simple_logger as logger
+import pcap_native
+
+index_version = 2
+default_bucket_seconds = 60
+
+_schema = '''
+CREATE TABLE capture (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE headers (offset INTEGER, length INTEGER);
+CREATE TABLE streams (stream INTEGER PRIMARY KEY,
+                      address_a BLOB, port_a INTEGER,
+                      address_b BLOB, port_b INTEGER,
+                      start INTEGER);
+CREATE TABLE ranges (stream INTEGER, bucket INTEGER,
+                     start INTEGER, end INTEGER);
+'''
+
+
+def default_index_path(pcap_file_path):
+    return f'{pcap_file_path}.idx'
+
+
+def _capture_identity(pcap_file_path):
+    stat = os.stat(pcap_file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _flush_ranges(connection, ranges, before_bucket=None):
+    '''Writes ranges of buckets older than before_bucket (all if None).
+    Frames are time ordered (mostly), so older buckets are done'''
+    done = [key for key in ranges
+            if before_bucket is None or key[1] < before_bucket]
+    connection.executemany(
+        'INSERT INTO ranges VALUES (?, ?, ?, ?)',
+        ((stream, bucket, *ranges.pop((stream, bucket)))
+         for stream, bucket in done))
+
+
+class FrameIndexBuilder:
+    '''Writes frame offset index from TCP frames of capture as they are
+    read (see pcap_native.extract_packets index_builder), so index is
+    built while capture is analyzed instead of reading it again. Index is
+    written into temporary file, replaced by finish'''
+
+    def __init__(self, pcap_file_path, index_path=None,
+                 bucket_seconds=default_bucket_seconds):
+        self.pcap_file_path = pcap_file_path
+        self.index_path = index_path or default_index_path(pcap_file_path)
+        self.bucket_seconds = bucket_seconds
+        self.frame_count = 0
+        self.stream_count = 0
+        self.__temp_path = f'{self.index_path}.tmp'
+        if os.path.exists(self.__temp_path):
+            os.remove(self.__temp_path)
+        # Frames are added by extraction thread
+        self.__connection = sqlite3.connect(self.__temp_path,
+                                            check_same_thread=False)
+        self.__connection.executescript(_schema)
+        self.__ranges = dict()
+        self.__last_bucket = None
+
+    def add(self, offset, length, timestamp, key, stream, is_new):
+        '''Adds TCP frame of stream (conversation key), is_new is set for
+        first frame of stream'''
+        self.frame_count += 1
+        if is_new:
+            self.stream_count += 1
+            self.__connection.execute(
+                'INSERT INTO streams VALUES (?, ?, ?, ?, ?, ?)',
+                (stream, *key, offset))
+
+        bucket = int(timestamp // self.bucket_seconds)
+        if self.__last_bucket is None:
+            self.__last_bucket = bucket
+        elif bucket > self.__last_bucket:
+            _flush_ranges(self.__connection, self.__ranges, bucket - 1)
+            self.__last_bucket = bucket
+
+        byte_range = self.__ranges.get((stream, bucket))
+        if byte_range is None:
+            self.__ranges[(stream, bucket)] = [offset, offset + length]
+        else:
+            byte_range[1] = offset + length
+
+    def finish(self, capture):
+        '''Writes index once all frames of capture were added'''
+        connection = self.__connection
+        _flush_ranges(connection, self.__ranges)
+        connection.executemany('INSERT INTO headers VALUES (?, ?)',
+                               capture.state.headers)
+        metadata = dict(_capture_identity(self.pcap_file_path),
+                        version=index_version, format=capture.format,
+                        bucket_seconds=self.bucket_seconds)
+        connection.executemany(
+            'INSERT INTO capture VALUES (?, ?)',
+            ((key, json.dumps(value)) for key, value in metadata.items()))
+        connection.execute('CREATE INDEX ranges_stream ON ranges '
+                           '(stream, bucket)')
+        connection.execute('CREATE INDEX streams_key ON streams '
+                           '(address_a, port_a, address_b, port_b, start)')
+        connection.commit()
+        connection.close()
+        os.replace(self.__temp_path, self.index_path)
+
+        logger.log_info(f'Frame index "{self.index_path}" written: '
+                        f'{self.frame_count} TCP frames, '
+                        f'{self.stream_count} streams')
+
+    def abort(self):
+        '''Drops index of capture that was not read completely'''
+        self.__connection.close()
+        if os.path.exists(self.__temp_path):
+            os.remove(self.__temp_path)
+
+
+def build_frame_index(pcap_file_path, index_path=None,
+                      bucket_seconds=default_bucket_seconds):
+    '''Builds frame offset index of capture file by reading it on its
+    own. Returns index path'''
+    builder = FrameIndexBuilder(pcap_file_path, index_path, bucket_seconds)
+    logger.log_info(f'Building frame index "{builder.index_path}"')
+    collections.deque(pcap_native.extract_packets(
+        pcap_file_path, index_builder=builder), maxlen=0)
+    return builder.index_path
+
+
+def __open_index(pcap_file_path, index_path):
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f'Frame index "{index_path}" not found')
+
+    connection = sqlite3.connect(index_path)
+    metadata = {key: json.loads(value) for key, value
+                in connection.execute('SELECT key, value FROM capture')}
+    identity = _capture_identity(pcap_file_path)
+    if metadata.get('version') != index_version \
+            or metadata.get('size') != identity['size'] \
+            or metadata.get('mtime') != identity['mtime']:
+        connection.close()
+        raise ValueError(f'Frame index "{index_path}" is stale, rebuild it '
+                         f'with "analyze pcap --frame-index"')
+    return connection, metadata
+
+
+def __merge_ranges(ranges):
+    '''Merges overlapping or adjacent (start, end) byte ranges'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def extract_stream(pcap_file_path, stream, output_path, index_path=None,
+                   from_time=None, to_time=None):
+    '''Copies frames of tcp_stream into new capture file of same format,
+    optionally limited to [from_time, to_time] epoch seconds. Returns number
+    of copied frames'''
+    index_path = index_path or default_index_path(pcap_file_path)
+    connection, metadata = __open_index(pcap_file_path, index_path)
+    try:
+        row = connection.execute(
+            'SELECT address_a, port_a, address_b, port_b, start '
+            'FROM streams WHERE stream = ?', (stream,)).fetchone()
+        if row is None:
+            raise ValueError(f'Stream {stream} not found in capture')
+        *key, stream_start = row
+        # Frames of the same conversation from next stream on are not ours
+        stream_end, = connection.execute(
+            'SELECT MIN(start) FROM streams WHERE address_a = ? '
+            'AND port_a = ? AND address_b = ? AND port_b = ? AND start > ?',
+            (*key, stream_start)).fetchone()
+        if stream_end is None:
+            stream_end = float('inf')
+
+        bucket_seconds = metadata['bucket_seconds']
+        first_bucket = -2 ** 62 if from_time is None \
+            else int(from_time // bucket_seconds)
+        last_bucket = 2 ** 62 if to_time is None \
+            else int(to_time // bucket_seconds)
+        ranges = connection.execute(
+            'SELECT start, end FROM ranges WHERE stream = ? '
+            'AND bucket BETWEEN ? AND ?',
+            (stream, first_bucket, last_bucket)).fetchall()
+        headers = connection.execute(
+            'SELECT offset, length FROM headers ORDER BY offset').fetchall()
+    finally:
+        connection.close()
+
+    key = tuple(key)
+    frame_count = 0
+    with pcap_native.open_capture(pcap_file_path) as capture, \
+            open(output_path, 'wb') as output:
+        state = capture.state
+        headers_read = 0
+        for start, end in __merge_ranges(ranges):
+            # Replay headers preceding range, so byte order and interfaces
+            # are known before reading frames from the middle of capture
+            while headers_read < len(headers) \
+                    and headers[headers_read][0] < start:
+                offset, length = headers[headers_read]
+                output.write(capture.view[offset:offset + length])
+                if capture.format == 'pcapng':
+                    for _ in capture.frames(offset, offset + length):
+                        pass
+                headers_read += 1
+
+            frames = capture.frames(start, end)
+            try:
+                for offset, length, timestamp, linktype, data in frames:
+                    if not stream_start <= offset < stream_end:
+                        continue
+                    tcp = pcap_native.decode_tcp(linktype, data, state.names)
+                    del data
+                    if tcp is None or pcap_native.conversation_key(
+                            *tcp[:4]) != key:
+                        continue
+                    if from_time is not None and timestamp < from_time:
+                        continue
+                    if to_time is not None and timestamp > to_time:
+                        continue
+                    output.write(capture.view[offset:offset + length])
+                    frame_count += 1
+            finally:
+                frames.close()
+
+        if not ranges:
+            for offset, length in headers:
+                output.write(capture.view[offset:offset + length])
+
+    logger.log_info(f'Extracted {frame_count} frames of stream {stream} '
+                    f'to "{output_path}"')
+    return frame_count
@@ -1,10 +1,13 @@
-import click
+import collections
+import multiprocessing
 import simple_logger as logger
 import numpy as np
-from datetime import datetime
+from packet import Packet, HostTable, parse_ip
 
 # Settings
 batch_interval_generator_range = (60, 600)
+# Upper bound of batch density (packets per second within single batch)
+max_batch_density = 1 / 25
 domains = [
     ('google.com', '172.217.18.78'),
     ('youtube.com', '172.217.19.110'),
@@ -26,114 +29,232 @@ domains = [
 ]
 
 
-def __generate_packet(timestamp: int):
-    '''Generate packet for random domain for specified timestamp'''
+def _generate_batches(rng, start_from, start_to, end_limit, packet_count,
+                      interval_range, max_density):
+    '''Draws random batches (start, interval, packet count) starting in
+    [start_from, start_to) and ending before end_limit, until they hold at
+    least packet_count packets. Batches are drawn in vectors, sized by
+    expected number of batches still needed'''
+    empty = np.empty(0, dtype=np.int64)
+    starts, intervals, counts = [empty], [empty], [empty]
+    total = 0
+    expected_count = max(1.0, np.mean(interval_range) * max_density / 2)
+    while total < packet_count:
+        size = int((packet_count - total) / expected_count * 1.1) + 16
+        interval = rng.integers(interval_range[0], interval_range[1], size)
+        density = rng.random(size) * max_density
+        start = rng.integers(start_from, np.maximum(
+            np.minimum(start_to, end_limit - interval), start_from + 1))
+        # Batch can not hold more distinct timestamps than its interval
+        count = np.minimum(np.rint(density * interval).astype(np.int64),
+                           interval)
 
-    date_time = datetime.fromtimestamp(timestamp)
-    random_domain = domains[np.random.randint(0, len(domains))]
+        cumulative = total + np.cumsum(count)
+        taken = min(size, int(np.searchsorted(cumulative, packet_count)) + 1)
+        starts.append(start[:taken])
+        intervals.append(interval[:taken])
+        counts.append(count[:taken])
+        total = int(cumulative[taken - 1])
 
-    return {
-        'timestamp': datetime.fromtimestamp(timestamp),
-        'tcp_stream': -1,
-        'src': {
-            'ip': '127.0.0.1',
-            'hostname': '127.0.0.1',
-            'port': 13370,
-            'domain': None,
-            'subdomain': None,
-            'fld': None
-        },
-        'dst': {
-            'ip': random_domain[1],
-            'hostname': random_domain[0],
-            'port': 443,
-            'domain': None,
-            'subdomain': None,
-            'fld': None
-        },
-        'metadata': {
-            'resource_type': None
-        }
-    }
+    return (np.concatenate(starts), np.concatenate(intervals),
+            np.concatenate(counts))
 
 
-def __generate_batch_packets(from_timestamp: int,
-                             time_interval: int,
-                             packet_density: float):
-    '''Generate batch packets from specified timestamp, time interval and
-    packet density
-    '''
-    to_timestamp = from_timestamp + time_interval
-    packet_count = round(packet_density * time_interval)
+def _distinct_offsets(rng, intervals, counts):
+    '''Draws counts[i] distinct offsets in [0, intervals[i]) for every batch
+    (sampling without replacement). Offsets are drawn for all batches at
+    once, only offsets colliding within their batch are drawn again'''
+    batch = np.repeat(np.arange(len(counts)), counts)
+    limits = np.repeat(intervals, counts)
+    offsets = (rng.random(len(batch)) * limits).astype(np.int64)
+    stride = int(intervals.max(initial=1))
 
-    logger.log_debug(
-        f'=> Generating batch packets\n'
-        f'From     : {datetime.fromtimestamp(from_timestamp).isoformat()}\n'
-        f'To       : {datetime.fromtimestamp(to_timestamp).isoformat()}\n'
-        f'Interval : {time_interval}s\n'
-        f'Density  : {packet_density}\n'
-        f'Packets  : {packet_count}')
+    redraw = np.ones(len(batch), dtype=bool)
+    while redraw.any():
+        keys = batch * stride + offsets
+        order = np.argsort(keys, kind='stable')
+        redraw[:] = False
+        redraw[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+        offsets[redraw] = (rng.random(int(redraw.sum()))
+                           * limits[redraw]).astype(np.int64)
+    return batch, offsets
 
-    generated_timestamps = []
-    while len(generated_timestamps) < packet_count:
-        timestamp = np.random.randint(from_timestamp, to_timestamp)
-        if timestamp not in generated_timestamps:
-            generated_timestamps.append(timestamp)
 
-    generated_timestamps.sort()
+class BatchModel:
+    '''Traffic of random batches contacting uniformly chosen domains. Each
+    batch has random interval (from interval_range), density (up to
+    max_density) and distinct whole second timestamps'''
 
-    generated_packets = [__generate_packet(timestamp)
-                         for timestamp in generated_timestamps]
+    def __init__(self, density, interval_range=None, max_density=None):
+        self.density = density
+        self.interval_range = interval_range or batch_interval_generator_range
+        self.max_density = max_density or max_batch_density
+        self.hosts = domains
+        # Packets of batch started in window end up to this many seconds
+        # after window end
+        self.max_spill = self.interval_range[1]
 
-    return generated_packets
+    def generate(self, rng, window_from, window_to, to_timestamp):
+        '''Returns (timestamps, host indices) of packets of batches starting
+        in [window_from, window_to)'''
+        starts, intervals, counts = _generate_batches(
+            rng, window_from, window_to, to_timestamp,
+            self.density * (window_to - window_from), self.interval_range,
+            self.max_density)
+        batch, offsets = _distinct_offsets(rng, intervals, counts)
+        timestamps = starts[batch] + offsets
+        return timestamps, rng.integers(0, len(self.hosts), len(timestamps))
 
 
-def __generate_batch(sample_from_timestamp: int, sample_to_timestamp: int):
-    '''Generates random batch in specified timestamp limits'''
+def __init_window_worker(model):
+    global __worker_model
+    __worker_model = model
 
-    batch_interval = np.random.randint(batch_interval_generator_range[0],
-                                       batch_interval_generator_range[1])
-    batch_density = np.random.random_sample() / 25  # TODO: Check magic number
-    batch_from_timestamp = np.random.randint(sample_from_timestamp,
-                                             sample_to_timestamp
-                                             - batch_interval)
 
-    batch = __generate_batch_packets(batch_from_timestamp,
-                                     batch_interval,
-                                     batch_density)
+def __generate_window(window, model=None):
+    '''Generates packets of window using window's own random stream.
+    Returns (window end, sorted timestamps, host indices)'''
+    window_from, window_to, to_timestamp, seed_sequence = window
+    rng = np.random.default_rng(seed_sequence)
 
-    return {
-        'from_timestamp': batch_from_timestamp,
-        'time_interval': batch_interval,
-        'density': batch_density,
-        'packets': batch
-    }
+    timestamps, host_indices = (model or __worker_model).generate(
+        rng, window_from, window_to, to_timestamp)
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, host_indices = timestamps[order], host_indices[order]
+    in_sample = timestamps < to_timestamp
+    return window_to, timestamps[in_sample], host_indices[in_sample]
 
 
-def generate_sample(from_timestamp: int,
+def __generated_windows(windows, model, workers):
+    '''Generates windows in order. With more workers, windows are generated
+    by process pool with at most 2 * workers windows in flight, so slow
+    consumer slows down generation instead of buffering whole sample'''
+    if workers <= 1:
+        for window in windows:
+            yield __generate_window(window, model)
+        return
+
+    # Model (and its host catalog) is sent to each worker once
+    with multiprocessing.Pool(processes=workers,
+                              initializer=__init_window_worker,
+                              initargs=(model,)) as pool:
+        pending = collections.deque()
+        for window in windows:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(__generate_window, (window,)))
+        while pending:
+            yield pending.popleft().get()
+
+
+def random_seed():
+    '''Returns fresh seed, so sample generated without seed can be
+    reproduced when seed is logged'''
+    return int(np.random.SeedSequence().entropy)
+
+
+def generate_chunks(from_timestamp: int,
                     to_timestamp: int,
                     desired_density: float,
-                    seed: int = None):
-    '''Generates sample package in desired [from_timestamp, to_timestamp]
-    interval with desired density of packets
+                    seed: int = None,
+                    interval_range=None,
+                    workers: int = 1,
+                    chunk_seconds: int = 3600,
+                    model=None):
+    '''Generates sample packets in desired [from_timestamp, to_timestamp]
+    interval, yielding time ordered chunks of timestamp and host index
+    arrays (indices into model.hosts).
+
+    Packets are generated by traffic model, BatchModel with desired density
+    and interval_range by default. Sample is split into windows of
+    chunk_seconds generated independently, each with random stream spawned
+    from seed by window number, so same seed gives same sample for any
+    worker count. Packets may spill into next window, so at most one window
+    is held back. Memory use depends on chunk_seconds and workers, not
+    sample length
     '''
-    sample_interval = to_timestamp - from_timestamp
-    if seed is not None:
-        np.random.seed(seed)
+    model = model or BatchModel(desired_density, interval_range)
+    chunk_seconds = max(int(chunk_seconds), int(np.ceil(model.max_spill)))
+    from_timestamp, to_timestamp = int(from_timestamp), int(to_timestamp)
+    entropy = np.random.SeedSequence(seed).entropy
+
+    windows = ((window_from,
+                min(window_from + chunk_seconds, to_timestamp),
+                to_timestamp,
+                np.random.SeedSequence(entropy, spawn_key=(number,)))
+               for number, window_from in enumerate(
+                   range(from_timestamp, to_timestamp, chunk_seconds)))
 
-    def current_density(packets):
-        return len(packets)/sample_interval
+    held_timestamps = np.empty(0, dtype=np.int64)
+    held_domains = np.empty(0, dtype=np.int64)
+    for window_to, timestamps, domain_indices in __generated_windows(
+            windows, model, workers):
+        timestamps = np.concatenate((held_timestamps, timestamps))
+        domain_indices = np.concatenate((held_domains, domain_indices))
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, domain_indices = timestamps[order], domain_indices[order]
 
-    sample = []
-    while current_density(sample) < desired_density:
-        batch = __generate_batch(from_timestamp, to_timestamp)
-        sample.extend(batch['packets'])
+        ready = int(np.searchsorted(timestamps, window_to))
+        held_timestamps = timestamps[ready:]
+        held_domains = domain_indices[ready:]
+        yield {'timestamps': timestamps[:ready],
+               'domains': domain_indices[:ready]}
 
-    sample.sort(key=lambda x: x['timestamp'])
+    if len(held_timestamps):
+        yield {'timestamps': held_timestamps, 'domains': held_domains}
+
+
+def generate_sample(from_timestamp: int,
+                    to_timestamp: int,
+                    desired_density: float,
+                    seed: int = None,
+                    interval_range=None,
+                    model=None):
+    '''Generates whole sample as arrays of sorted timestamps and indices
+    into model hosts (see generate_chunks)
+    '''
+    chunks = list(generate_chunks(from_timestamp, to_timestamp,
+                                  desired_density, seed, interval_range,
+                                  model=model))
+    timestamps = np.concatenate([chunk['timestamps'] for chunk in chunks])
+    sample_interval = int(to_timestamp) - int(from_timestamp)
+
+    logger.log_debug(f'Generated {len(timestamps)} packets')
 
     return {
-        'from_timestamp': from_timestamp,
-        'to_timestamp': to_timestamp,
-        'density': current_density(sample),
-        'packets': sample
+        'from_timestamp': int(from_timestamp),
+        'to_timestamp': int(to_timestamp),
+        'density': len(timestamps) / sample_interval,
+        'timestamps': timestamps,
+        'domains': np.concatenate([chunk['domains'] for chunk in chunks])
     }
+
+
+def chunk_packets(chunks, hosts=None):
+    '''Yields Packet records of generated chunks in time order. hosts are
+    (hostname, address) of model that generated chunks'''
+    host_table = HostTable()
+    ip_version, src_ip = parse_ip('127.0.0.1')
+    src = host_table.get('127.0.0.1')
+    destinations = [(parse_ip(address)[1], host_table.get(hostname))
+                    for hostname, address in hosts or domains]
+
+    for chunk in chunks:
+        for timestamp, domain in zip(chunk['timestamps'].tolist(),
+                                     chunk['domains'].tolist()):
+            dst_ip, dst = destinations[domain]
+            yield Packet(timestamp=float(timestamp),
+                         frame=-1,
+                         tcp_stream=-1,
+                         ip_version=ip_version,
+                         src_ip=src_ip,
+                         src_port=13370,
+                         src=src,
+                         dst_ip=dst_ip,
+                         dst_port=443,
+                         dst=dst)
+
+
+def sample_packets(sample, hosts=None):
+    '''Yields Packet records of generated sample in time order'''
+    return chunk_packets([sample], hosts)
@@ -0,0 +1,177 @@
+import time
+import queue
+import threading
+import simple_logger as logger
+import pcap
+import metrics
+
+_end_of_stream = object()
+
+
+class LiveStats:
+    '''Counters shared by live pipeline stages'''
+
+    def __init__(self):
+        self.captured = 0
+        self.dropped = 0
+        self.enriched = 0
+        self.indexed = 0
+        self.failed = 0
+        self.flushes = 0
+        self.blocked_seconds = 0.0
+        self.__lock = threading.Lock()
+
+    def add(self, **counters):
+        with self.__lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def counters(self):
+        with self.__lock:
+            return {'captured': self.captured, 'dropped': self.dropped,
+                    'enriched': self.enriched, 'indexed': self.indexed,
+                    'failed': self.failed, 'flushes': self.flushes,
+                    'blocked_seconds': self.blocked_seconds}
+
+    def __str__(self):
+        return (f'captured={self.captured} dropped={self.dropped} '
+                f'enriched={self.enriched} indexed={self.indexed} '
+                f'failed={self.failed} flushes={self.flushes} '
+                f'blocked={self.blocked_seconds:.1f}s')
+
+
+class LivePipeline:
+    '''Streams packets through capture -> enrich -> index stages running in
+    separate threads connected by bounded queues.
+
+    When capture queue is full, packets are dropped (drop_when_full) or
+    capture blocks until enrichment catches up. Enrichment always blocks on
+    full index queue, so slow indexing propagates back to capture instead of
+    growing memory. Indexer flushes bulk requests when flush_size packets
+    are buffered or flush_interval seconds elapsed since last flush.
+    '''
+
+    def __init__(self, source, es, cache=None,
+                 queue_size=10000, flush_size=500, flush_interval=5.0,
+                 drop_when_full=True, stats_interval=30.0):
+        self.source = source
+        self.es = es
+        self.cache = cache
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.drop_when_full = drop_when_full
+        self.stats_interval = stats_interval
+        self.stats = LiveStats()
+        metrics.register_collector('live', self.stats.counters)
+        self.__capture_queue = queue.Queue(maxsize=queue_size)
+        self.__index_queue = queue.Queue(maxsize=queue_size)
+        self.__stop = threading.Event()
+        self.__errors = []
+        self.__batch = []
+
+    def __put_blocking(self, target_queue, item):
+        try:
+            target_queue.put_nowait(item)
+        except queue.Full:
+            blocked_from = time.monotonic()
+            target_queue.put(item)
+            self.stats.add(blocked_seconds=time.monotonic() - blocked_from)
+
+    def __capture(self):
+        try:
+            for packet in self.source:
+                if self.__stop.is_set():
+                    break
+                self.stats.add(captured=1)
+                if not self.drop_when_full:
+                    self.__put_blocking(self.__capture_queue, packet)
+                    continue
+                try:
+                    self.__capture_queue.put_nowait(packet)
+                except queue.Full:
+                    self.stats.add(dropped=1)
+        except Exception as ex:
+            self.__errors.append(ex)
+            logger.log_error(f'Capture failed: {ex}')
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+            self.__capture_queue.put(_end_of_stream)
+
+    def __queued_packets(self):
+        while True:
+            packet = self.__capture_queue.get()
+            if packet is _end_of_stream:
+                return
+            yield packet
+
+    def __enrich(self):
+        try:
+            for packet in pcap.analize_packets(self.__queued_packets(),
+                                               self.cache):
+                self.stats.add(enriched=1)
+                self.__put_blocking(self.__index_queue, packet)
+        except Exception as ex:
+            self.__errors.append(ex)
+            logger.log_error(f'Enrichment failed: {ex}')
+        finally:
+            self.__index_queue.put(_end_of_stream)
+
+    def __flush(self, batch):
+        if not batch:
+            return
+        try:
+            indexed, failed = self.es.bulk_index_packets(batch)
+        except Exception as ex:
+            logger.log_error(f'Bulk flush of {len(batch)} packets '
+                             f'failed: {ex}')
+            indexed, failed = 0, len(batch)
+        self.stats.add(indexed=indexed, failed=failed, flushes=1)
+        batch.clear()
+
+    def __index(self):
+        batch = self.__batch
+        flush_deadline = time.monotonic() + self.flush_interval
+        stats_deadline = time.monotonic() + self.stats_interval
+        while True:
+            now = time.monotonic()
+            if now >= stats_deadline:
+                logger.log_info(f'Live stats: {self.stats}')
+                stats_deadline = now + self.stats_interval
+            try:
+                packet = self.__index_queue.get(
+                    timeout=max(0.0, flush_deadline - now))
+            except queue.Empty:
+                packet = None
+
+            if packet is _end_of_stream:
+                self.__flush(batch)
+                self.es.index_rollups(flush=True)
+                return
+            if packet is not None:
+                batch.append(packet)
+            if len(batch) >= self.flush_size \
+                    or time.monotonic() >= flush_deadline:
+                self.__flush(batch)
+                flush_deadline = time.monotonic() + self.flush_interval
+
+    def run(self):
+        '''Runs pipeline until source is exhausted or stop is requested'''
+        capture_thread = threading.Thread(target=self.__capture,
+                                          name='capture', daemon=True)
+        enrich_thread = threading.Thread(target=self.__enrich,
+                                         name='enrich', daemon=True)
+        capture_thread.start()
+        enrich_thread.start()
+        try:
+            self.__index()
+        except KeyboardInterrupt:
+            logger.log_info('Stopping, flushing queued packets...')
+            self.__stop.set()
+            self.__index()
+
+        logger.log_info(f'Live stats: {self.stats}')
+        return not self.__errors
+
+    def stop(self):
+        self.__stop.set()
@@ -0,0 +1,262 @@
+'''Run metrics: counters and stage timers.
+
+Counters are added in bulk (per bulk batch, at the end of stream) or read
+from collectors on export, and stages are timed per chunk of work, so
+instrumentation adds no per-packet cost. Only timing of streamed stages
+(time spent producing each packet, see timed) costs per packet and is done
+only when metrics are enabled.
+
+Metrics are exported as JSON summary or Prometheus text file (e.g. for
+node_exporter textfile collector) at the end of run, and periodically in
+long-running modes. Worker processes of parallel capture analysis return
+their counters (see drain) to be added to counters of main process.
+'''
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import simple_logger as logger
+
+formats = ['json', 'prometheus']
+prefix = 'metanet'
+
+descriptions = {
+    'packets_extracted': 'Packets read from captures and live capture',
+    'packets_incomplete': 'Packets skipped because of missing fields',
+    'hostname_cache_hits': 'Hostname enrichments served from cache',
+    'hostname_cache_misses': 'Hostnames enriched by lookup',
+    'tld_lookup_failures': 'Hostnames without known TLD',
+    'documents_indexed': 'Documents (packets and rollups) indexed',
+    'documents_failed': 'Documents (packets and rollups) failed to index',
+    'rollup_late_packets': 'Indexed packets not rolled up because their '
+                           'rollup bucket was already closed',
+    'bulk_batches': 'Bulk indexing batches sent',
+    'bulk_rejections': 'Documents rejected because cluster is overloaded '
+                       '(429) after all retries',
+    'live_captured': 'Live packets captured',
+    'live_dropped': 'Live packets dropped because enrichment was behind',
+    'live_enriched': 'Live packets enriched',
+    'live_indexed': 'Live packets indexed',
+    'live_failed': 'Live packets failed to index',
+    'live_flushes': 'Live bulk flushes',
+    'live_blocked_seconds': 'Seconds live capture waited for enrichment'
+}
+
+enabled = False
+
+__lock = threading.Lock()
+__counters = dict()
+__stages = dict()
+__collectors = dict()
+__started = time.time()
+
+
+def inc(name, value=1):
+    '''Adds value to counter'''
+    with __lock:
+        __counters[name] = __counters.get(name, 0) + value
+
+
+def drain():
+    '''Returns counters and resets them, so worker process can hand over
+    counters of its task'''
+    with __lock:
+        counters = dict(__counters)
+        __counters.clear()
+    return counters
+
+
+def register_collector(name, collect):
+    '''Registers collect() returning dict of counters kept elsewhere (e.g.
+    by long-running pipeline), read whenever metrics are exported. Counters
+    are prefixed with name'''
+    with __lock:
+        __collectors[name] = collect
+
+
+def observe(stage, seconds, items=1):
+    '''Adds seconds spent in stage processing items'''
+    with __lock:
+        totals = __stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += items
+
+
+@contextlib.contextmanager
+def timer(stage, items=1):
+    '''Times block as stage processing items'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, items)
+
+
+def timed(items, stage):
+    '''Returns items, timing how long producing each of them takes as stage
+    when metrics are enabled'''
+    if not enabled:
+        return items
+    return __timed(iter(items), stage)
+
+
+def __timed(iterator, stage):
+    seconds, count = 0.0, 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - started
+            count += 1
+            yield item
+    finally:
+        observe(stage, seconds, count)
+
+
+def snapshot():
+    '''Returns current metrics as dict'''
+    with __lock:
+        counters = dict(__counters)
+        for name, collect in __collectors.items():
+            counters.update((f'{name}_{counter}', value)
+                            for counter, value in collect().items())
+        return {
+            'started': __started,
+            'elapsed': time.time() - __started,
+            'counters': dict(sorted(counters.items())),
+            'stages': {stage: {'seconds': seconds, 'items': items}
+                       for stage, (seconds, items)
+                       in sorted(__stages.items())}
+        }
+
+
+def prometheus_text(metrics=None):
+    '''Formats metrics in Prometheus text exposition format'''
+    metrics = metrics or snapshot()
+    lines = []
+    for name, value in metrics['counters'].items():
+        metric = f'{prefix}_{name}_total'
+        lines.append(f'# HELP {metric} {descriptions.get(name, name)}')
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+
+    for metric, field, description in (
+            ('stage_seconds_total', 'seconds',
+             'Time spent in stage, summed over threads'),
+            ('stage_items_total', 'items', 'Items processed by stage')):
+        if not metrics['stages']:
+            break
+        lines.append(f'# HELP {prefix}_{metric} {description}')
+        lines.append(f'# TYPE {prefix}_{metric} counter')
+        for stage, totals in metrics['stages'].items():
+            lines.append(f'{prefix}_{metric}{{stage="{stage}"}} '
+                         f'{totals[field]}')
+
+    lines.append(f'# HELP {prefix}_run_start_time_seconds Start of run')
+    lines.append(f'# TYPE {prefix}_run_start_time_seconds gauge')
+    lines.append(f'{prefix}_run_start_time_seconds {metrics["started"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_for(path):
+    '''Returns export format implied by file name'''
+    return 'prometheus' if path.endswith('.prom') else 'json'
+
+
+def write(path, export_format=None):
+    '''Writes metrics into file. File is replaced atomically, so readers
+    never see partially written file'''
+    metrics = snapshot()
+    if (export_format or format_for(path)) == 'prometheus':
+        content = prometheus_text(metrics)
+    else:
+        content = json.dumps(metrics, indent=2)
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as metrics_file:
+        metrics_file.write(content)
+    os.replace(temporary_path, path)
+
+
+class Instrumentation:
+    '''Instrumentation of single run: metrics export (at the end and every
+    interval seconds when interval is set), cProfile stats written into
+    profile_path and tracemalloc top allocation sites logged at the end'''
+
+    top_allocations = 10
+
+    def __init__(self, metrics_path=None, export_format=None, interval=None,
+                 profile_path=None, trace_memory=False):
+        self.metrics_path = metrics_path
+        self.export_format = export_format
+        self.interval = interval
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.__profiler = None
+        self.__stop = threading.Event()
+        self.__exporter = None
+
+    def start(self):
+        global enabled
+        enabled = self.metrics_path is not None
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_path:
+            self.__profiler = cProfile.Profile()
+            self.__profiler.enable()
+        if self.metrics_path and self.interval:
+            self.__exporter = threading.Thread(target=self.__export_loop,
+                                               name='metrics-export',
+                                               daemon=True)
+            self.__exporter.start()
+        return self
+
+    def __export_loop(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                write(self.metrics_path, self.export_format)
+            except OSError as ex:
+                logger.log_warning('Failed to write metrics: %s', ex)
+
+    def finish(self):
+        self.__stop.set()
+        if self.__exporter is not None:
+            self.__exporter.join()
+        # Reported before profile summary, which allocates a lot itself
+        if self.trace_memory:
+            self.__log_allocations()
+        if self.__profiler is not None:
+            self.__profiler.disable()
+            self.__profiler.dump_stats(self.profile_path)
+            if logger.is_enabled(logger.DEBUG):
+                summary = io.StringIO()
+                pstats.Stats(self.__profiler, stream=summary) \
+                    .sort_stats('cumulative').print_stats(15)
+                logger.log_debug('Profile summary:\n%s', summary.getvalue())
+            logger.log_info('Profile written to "%s"', self.profile_path)
+        if self.metrics_path:
+            write(self.metrics_path, self.export_format)
+            logger.log_info('Metrics written to "%s"', self.metrics_path)
+        logger.log_debug('Metrics: %s', json.dumps(snapshot()))
+
+    def __log_allocations(self):
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False,
+                               '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ]).statistics('lineno')
+        tracemalloc.stop()
+        logger.log_info('Traced memory: current=%.1f MiB peak=%.1f MiB',
+                        current / 1024 / 1024, peak / 1024 / 1024)
+        for statistic in statistics[:self.top_allocations]:
+            logger.log_info('%s', statistic)
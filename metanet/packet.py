@@ -0,0 +1,126 @@
+import functools
+import ipaddress
+
+
+@functools.lru_cache(maxsize=65536)
+def format_ip(ip_version, ip):
+    '''Formats integer packed IP address as string'''
+    if ip_version == 6:
+        return str(ipaddress.IPv6Address(ip))
+    return str(ipaddress.IPv4Address(ip))
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_ip(address):
+    '''Returns (ip_version, integer packed IP) for IP address string'''
+    ip = ipaddress.ip_address(address)
+    return ip.version, int(ip)
+
+
+class Host:
+    '''Hostname with its enrichment data. Hosts are interned in HostTable,
+    so all packets with same hostname share single Host instance and
+    enrichment is done once per hostname'''
+
+    __slots__ = ('hostname', 'domain', 'subdomain', 'fld', 'resource_type')
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.domain = None
+        self.subdomain = None
+        self.fld = None
+        self.resource_type = None
+
+    @property
+    def is_enriched(self):
+        return self.resource_type is not None
+
+    def __repr__(self):
+        return (f'Host({self.hostname!r}, domain={self.domain!r}, '
+                f'subdomain={self.subdomain!r}, fld={self.fld!r}, '
+                f'resource_type={self.resource_type!r})')
+
+
+class HostTable:
+    '''Dictionary encoding of hostnames. Hostnames are lowercased.
+
+    Table holds at most capacity hostnames (spellings), when full it is
+    cleared, so long-running capture does not grow it without bound.
+    Packets keep their Host instances, hosts seen again after clearing are
+    enriched again (from hostname cache)'''
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.__hosts = dict()
+        self.__aliases = dict()
+
+    def __len__(self):
+        return len(self.__hosts)
+
+    def __iter__(self):
+        return iter(self.__hosts.values())
+
+    def get(self, hostname):
+        '''Returns interned Host for hostname'''
+        host = self.__aliases.get(hostname)
+        if host is None:
+            if len(self.__aliases) >= self.capacity:
+                self.__hosts.clear()
+                self.__aliases.clear()
+            lower_hostname = hostname.lower()
+            host = self.__hosts.get(lower_hostname)
+            if host is None:
+                host = Host(lower_hostname)
+                self.__hosts[lower_hostname] = host
+            self.__aliases[hostname] = host
+        return host
+
+
+class Packet:
+    '''TCP SYN packet record.
+
+    timestamp is epoch seconds, frame is 1-based frame number in capture
+    file, IP addresses are integer packed (ip_version tells how to format
+    them) and src/dst are interned Host instances. capture is identity of
+    capture file packet was read from (None for live and generated packets).
+    '''
+
+    __slots__ = ('timestamp', 'frame', 'tcp_stream', 'ip_version',
+                 'src_ip', 'src_port', 'src',
+                 'dst_ip', 'dst_port', 'dst', 'capture')
+
+    def __init__(self, timestamp, frame, tcp_stream, ip_version,
+                 src_ip, src_port, src,
+                 dst_ip, dst_port, dst, capture=None):
+        self.timestamp = timestamp
+        self.frame = frame
+        self.tcp_stream = tcp_stream
+        self.ip_version = ip_version
+        self.src_ip = src_ip
+        self.src_port = src_port
+        self.src = src
+        self.dst_ip = dst_ip
+        self.dst_port = dst_port
+        self.dst = dst
+        self.capture = capture
+
+    @property
+    def src_address(self):
+        return format_ip(self.ip_version, self.src_ip)
+
+    @property
+    def dst_address(self):
+        return format_ip(self.ip_version, self.dst_ip)
+
+    @property
+    def resource_type(self):
+        return self.dst.resource_type
+
+    def __repr__(self):
+        return (f'Packet(timestamp={self.timestamp!r}, '
+                f'frame={self.frame!r}, '
+                f'tcp_stream={self.tcp_stream!r}, '
+                f'src={self.src_address}:{self.src_port} '
+                f'{self.src.hostname!r}, '
+                f'dst={self.dst_address}:{self.dst_port} '
+                f'{self.dst.hostname!r})')
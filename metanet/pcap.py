@@ -1,11 +1,21 @@
-import click
 import subprocess
 import simple_logger as logger
 import os
-import json
 import tld
 import re
-from datetime import datetime
+import time
+import heapq
+import tempfile
+import hashlib
+import itertools
+import functools
+import multiprocessing
+import pcap_native
+import metrics
+import pipeline
+from classifier import DomainClassifier, CompiledDomainClassifier
+from cache import HostnameCache
+from packet import Packet, HostTable, parse_ip
 
 __blacklist_hosts_path = os.path.abspath(os.path.join(
     os.path.abspath(__file__), '../resources/domain-lists/_all.txt'))
@@ -16,121 +26,547 @@ __assets_hosts_path = os.path.abspath(os.path.join(
 __ads_hosts_path = os.path.abspath(os.path.join(
     os.path.abspath(__file__), '../resources/domain-lists/ads/_all.txt'))
 
+__resource_lists = [
+    ('asset', __assets_hosts_path),
+    ('ads', __ads_hosts_path)
+]
 
-def __extract_packets(pcap_file_path,
-                      filter="tcp.flags.syn==1 and tcp.flags.ack==0"):
+__classifier_index_path = os.path.abspath(os.path.join(
+    os.path.abspath(__file__), '../resources/domain-lists/_index.bin'))
 
+
+syn_filter = "tcp.flags.syn==1 and tcp.flags.ack==0"
+
+# Packet extraction backends: tshark dissector or native PCAP/PCAPNG reader
+backends = ['tshark', 'native']
+
+__tshark_fields = ['frame.time_epoch',
+                   'frame.number',
+                   'tcp.stream',
+                   'ip.src',
+                   'ip.src_host',
+                   'ipv6.src',
+                   'ipv6.src_host',
+                   'tcp.srcport',
+                   'ip.dst',
+                   'ip.dst_host',
+                   'ipv6.dst',
+                   'ipv6.dst_host',
+                   'tcp.dstport']
+
+# Fields of all TCP frames read to log conversations (see ConversationLog)
+__tshark_log_fields = ['tcp.flags.syn',
+                       'tcp.flags.ack',
+                       'tcp.seq_raw']
+
+# Frames of conversations logged by tshark
+__tshark_log_filter = 'tcp'
+
+
+def __tshark_command(source_args, filter, log=False):
+    command = ["tshark",
+               *source_args,
+               "-Tfields",
+               "-Eseparator=/t",
+               "-Eoccurrence=f",
+               "-Eheader=n",
+               "-NmnNtdv",
+               f"-Y{filter}"]
+    command.extend(f"-e{field}" for field in __tshark_fields)
+    if log:
+        command.extend(f"-e{field}" for field in __tshark_log_fields)
+    return command
+
+
+def __address_bytes(address):
+    ip_version, ip = parse_ip(address)
+    return ip.to_bytes(4 if ip_version == 4 else 16, 'big')
+
+
+def __log_conversation(fields, tracker, log):
+    '''Records conversation event of TCP frame from tshark output in log.
+    Returns True for SYN packet'''
+    (_, frame, _,
+     src_ip, src_host, src_ipv6, src_ipv6_host, src_port,
+     dst_ip, dst_host, dst_ipv6, dst_ipv6_host, dst_port,
+     syn, ack, sequence) = fields
+    if not src_ip:
+        src_ip, src_host = src_ipv6, src_ipv6_host
+        dst_ip, dst_host = dst_ipv6, dst_ipv6_host
+    if not all([frame, src_ip, src_port, dst_ip, dst_port]):
+        return False
+    # Booleans are 1/0 or True/False depending on tshark version
+    syn = syn in ('1', 'True') and ack not in ('1', 'True')
+    sequence = int(sequence) if sequence else None
+    src, dst = __address_bytes(src_ip), __address_bytes(dst_ip)
+    key = pcap_native.conversation_key(src, int(src_port),
+                                       dst, int(dst_port))
+    stream_count = tracker.stream_count
+    tracker.stream(key, syn, sequence)
+    if syn or tracker.stream_count != stream_count:
+        log.events.append((int(frame), key, syn, sequence))
+    for address, host, ip in ((src, src_host, src_ip),
+                              (dst, dst_host, dst_ip)):
+        if host and host != ip:
+            log.names[address] = host
+    return syn
+
+
+def __read_packets(lines, hosts, log=None):
+    '''Yields packets from tshark -Tfields output lines. When log is
+    given, lines are of all TCP frames (with __tshark_log_fields), their
+    conversations are recorded in log and only SYN packets are yielded'''
+    field_count = len(__tshark_fields)
+    if log is not None:
+        field_count += len(__tshark_log_fields)
+        tracker = pcap_native.ConversationTracker()
+    packet_count = incomplete_count = 0
+    try:
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != field_count:
+                logger.log_debug('Skipping incomplete packet: %s', fields)
+                incomplete_count += 1
+                continue
+            if log is not None:
+                if not __log_conversation(fields, tracker, log):
+                    continue
+                fields = fields[:len(__tshark_fields)]
+
+            (time_epoch, frame, tcp_stream,
+             src_ip, src_host, src_ipv6, src_ipv6_host, src_port,
+             dst_ip, dst_host, dst_ipv6, dst_ipv6_host, dst_port) = fields
+            if not src_ip:
+                src_ip, src_host = src_ipv6, src_ipv6_host
+                dst_ip, dst_host = dst_ipv6, dst_ipv6_host
+
+            if not all([time_epoch, frame, tcp_stream, src_ip, src_host,
+                        src_port, dst_ip, dst_host, dst_port]):
+                logger.log_debug('Skipping incomplete packet: %s', fields)
+                incomplete_count += 1
+                continue
+
+            ip_version, src_ip = parse_ip(src_ip)
+            _, dst_ip = parse_ip(dst_ip)
+            packet_count += 1
+            yield Packet(float(time_epoch), int(frame), int(tcp_stream),
+                         ip_version,
+                         src_ip, int(src_port), hosts.get(src_host),
+                         dst_ip, int(dst_port), hosts.get(dst_host))
+    finally:
+        metrics.inc('packets_extracted', packet_count)
+        metrics.inc('packets_incomplete', incomplete_count)
+
+
+def __stream_tshark_packets(source_args, filter, hosts, log=None):
+    '''Streams packets from tshark. Packets are yielded as tshark outputs
+    them, so memory usage does not depend on capture size. Conversations
+    are recorded in log if given (see __read_packets)
+    '''
+    command = __tshark_command(source_args, filter, log is not None)
+    # Warnings (e.g. of malformed capture) go to file, pipe read only after
+    # stdout ends could fill up and block tshark
+    with tempfile.TemporaryFile('w+') as stderr_file, \
+            subprocess.Popen(command,
+                             stdout=subprocess.PIPE,
+                             stderr=stderr_file,
+                             text=True,
+                             bufsize=1) as tshark_process:
+        packet_count = 0
+        try:
+            for packet in __read_packets(tshark_process.stdout, hosts,
+                                         log):
+                packet_count += 1
+                yield packet
+        finally:
+            if tshark_process.poll() is None:
+                tshark_process.terminate()
+
+        if tshark_process.wait() != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(tshark_process.returncode,
+                                                command,
+                                                stderr=stderr_file.read())
+
+    logger.log_debug(f'Extracted {packet_count} packets')
+
+
+def __extract_packets_tshark(pcap_file_path, filter, hosts, log=None):
     logger.log_debug(f'Extract "{pcap_file_path}" packets using "{filter}"')
+    return __stream_tshark_packets([f"-r{os.path.abspath(pcap_file_path)}"],
+                                   filter, hosts, log)
+
+
+def __extract_packets_native(pcap_file_path, hosts, log=None,
+                             index_builder=None):
+    packet_count = 0
+    try:
+        for (time_epoch, frame, tcp_stream, ip_version,
+             src_ip, src_host, src_port,
+             dst_ip, dst_host, dst_port) in \
+                pcap_native.extract_packets(pcap_file_path, log,
+                                            index_builder):
+            packet_count += 1
+            yield Packet(time_epoch, frame, tcp_stream, ip_version,
+                         src_ip, src_port, hosts.get(src_host),
+                         dst_ip, dst_port, hosts.get(dst_host))
+    finally:
+        metrics.inc('packets_extracted', packet_count)
+
+
+def extract_packets(pcap_file_path, filter=syn_filter, backend='tshark',
+                    hosts=None, index_builder=None):
+    '''Streams packets from PCAP file using selected backend. Native
+    backend supports only default SYN filter. Hostnames are interned in
+    hosts table. Native backend writes frame index while reading capture
+    when index_builder is given'''
+    if hosts is None:
+        hosts = HostTable()
+    if backend == 'native':
+        if filter != syn_filter:
+            raise ValueError('Native backend supports only SYN filter')
+        return metrics.timed(
+            __extract_packets_native(pcap_file_path, hosts,
+                                     index_builder=index_builder),
+            'extract')
+    if index_builder is not None:
+        raise ValueError('Frame index is written only by native backend')
+    return metrics.timed(
+        __extract_packets_tshark(pcap_file_path, filter, hosts), 'extract')
+
+
+def capture_packets(interface, filter=syn_filter, hosts=None):
+    '''Streams packets captured live on network interface using tshark.
+    Output is flushed after every packet'''
+    if hosts is None:
+        hosts = HostTable()
+    logger.log_debug(f'Capture "{interface}" packets using "{filter}"')
+    return __stream_tshark_packets([f"-i{interface}", "-l"], filter, hosts)
+
+
+def compile_resource_classifier(index_path=None):
+    '''Builds resource classifier from assets and ads domain lists and
+    writes its compiled index. Assets take precedence over ads'''
+    classifier = DomainClassifier.from_files(__resource_lists)
+    classifier.save(index_path or __classifier_index_path, lists_signature())
+    return classifier
+
+
+def load_resource_classifier():
+    '''Loads resource classifier from compiled domain lists index. Index is
+    rebuilt from text lists if it is missing or stale'''
+    classifier = CompiledDomainClassifier.open(__classifier_index_path,
+                                               lists_signature())
+    if classifier is not None:
+        logger.log_debug(f'Using compiled domain lists index '
+                         f'"{__classifier_index_path}"')
+        return classifier
+
+    logger.log_debug('Compiled domain lists index missing or stale, '
+                     'building from lists')
+    try:
+        return compile_resource_classifier()
+    except OSError as ex:
+        logger.log_warning(f'Failed to write domain lists index: {ex}')
+        return DomainClassifier.from_files(__resource_lists)
+
+
+def lists_signature():
+    '''Identifies current domain lists, used to invalidate persisted
+    enrichment data'''
+    return ';'.join(f'{os.path.getsize(path)}:{os.path.getmtime(path)}'
+                    for _, path in __resource_lists)
+
+
+def load_hostname_cache(path=None, capacity=100000):
+    '''Creates hostname cache, loading entries from path if provided'''
+    cache = HostnameCache(capacity, path, lists_signature())
+    cache.load()
+    return cache
+
+
+def capture_identity(pcap_file_path, sample_size=1024 * 1024):
+    '''Returns identity of capture file content, derived from its size and
+    first and last sample_size bytes. Copied or renamed capture keeps
+    its identity'''
+    digest = hashlib.sha1()
+    size = os.path.getsize(pcap_file_path)
+    digest.update(str(size).encode())
+    with open(pcap_file_path, 'rb') as pcap_file:
+        digest.update(pcap_file.read(sample_size))
+        if size > sample_size:
+            pcap_file.seek(max(sample_size, size - sample_size))
+            digest.update(pcap_file.read(sample_size))
+    return digest.hexdigest()[:20]
+
+
+def tag_capture(packets, capture):
+    '''Sets capture identity of packets'''
+    for packet in packets:
+        packet.capture = capture
+        yield packet
+
+
+def analize_packets_from_file(pcap_file_path, workers=1, cache=None,
+                              backend='tshark', queue_size=10000,
+                              capture=None, skip=0, index_builder=None):
+    '''Analyzes packets from PCAP file. With more than one worker, capture
+    is split into shards that are extracted and analyzed in parallel.
+    Otherwise extraction and enrichment run in their own threads connected
+    by queues of queue_size packets, overlapping with consumer (indexing).
 
-    tshark_result = subprocess.run(["tshark",
-                                    f"-r{os.path.abspath(pcap_file_path)}",
-                                    f"-Tjson",
-                                    f"-eframe.time_epoch",
-                                    f"-eip.src",
-                                    f"-eip.src_host",
-                                    f"-eip.dst",
-                                    f"-eip.dst_host",
-                                    f"-etcp.srcport",
-                                    f"-etcp.dstport",
-                                    f"-etcp.stream",
-                                    f"-NmnNtdv",
-                                    f"{filter}"
-                                    ],
-                                   capture_output=True,
-                                   text=True,
-                                   check=True)
-
-    tshark_packets = json.loads(tshark_result.stdout)
-
-    def convert_packet(packet):
-        return {
-            'timestamp': datetime.fromtimestamp(
-                float(packet['_source']['layers']['frame.time_epoch'][0])),
-            'tcp_stream': int(packet['_source']['layers']['tcp.stream'][0]),
-            'src': {
-                'ip': packet['_source']['layers']['ip.src'][0],
-                'hostname': str.lower(
-                    packet['_source']['layers']['ip.src_host'][0]),
-                'port': int(packet['_source']['layers']['tcp.srcport'][0]),
-                'domain': None,
-                'subdomain': None,
-                'fld': None
-            },
-            'dst': {
-                'ip': packet['_source']['layers']['ip.dst'][0],
-                'hostname': str.lower(
-                    packet['_source']['layers']['ip.dst_host'][0]),
-                'port': int(packet['_source']['layers']['tcp.dstport'][0]),
-                'domain': None,
-                'subdomain': None,
-                'fld': None
-            },
-            'metadata': {
-                'resource_type': None
-            }
-        }
-
-    packets = [convert_packet(packet) for packet in tshark_packets]
-    logger.log_debug(f'Extracted {len(packets)} packets')
-
-    return packets
-
-
-def analize_packets_from_file(pcap_file_path):
-    packets = __extract_packets(pcap_file_path)
-    return analize_packets(packets)
-
-
-def analize_packets(packets):
-    logger.log_debug("Analize packets from file")
+    Packets are tagged with capture identity. First skip packets are
+    dropped (already processed by interrupted run). Frame index is written
+    by index_builder while capture is read (native backend, single worker)
+    '''
+    if capture is None:
+        capture = capture_identity(pcap_file_path)
+
+    if workers > 1:
+        if index_builder is not None:
+            raise ValueError('Frame index is not written by parallel '
+                             'analysis')
+        packets = __analize_packets_parallel(pcap_file_path, workers, cache,
+                                             backend)
+        return tag_capture(itertools.islice(packets, skip, None), capture)
+
+    packets = extract_packets(pcap_file_path, backend=backend,
+                              index_builder=index_builder)
+    packets = pipeline.buffered(
+        tag_capture(itertools.islice(packets, skip, None), capture),
+        'extract', queue_size)
+    return pipeline.buffered(analize_packets(packets, cache),
+                             'enrich', queue_size)
+
+
+# Frames per shard when processing PCAP file in parallel
+shard_frames = 250000
+
+
+def __split_capture(pcap_file_path, shard_dir, backend):
+    '''Splits capture into consecutive frame range shard files, natively
+    for native backend, using editcap otherwise. Returns shard paths in
+    frame order'''
+    logger.log_debug(f'Split "{pcap_file_path}" into shards of '
+                     f'{shard_frames} frames')
+
+    if backend == 'native':
+        shard_paths = pcap_native.split_capture(pcap_file_path, shard_dir,
+                                                shard_frames)
+    else:
+        subprocess.run(["editcap",
+                        f"-c{shard_frames}",
+                        os.path.abspath(pcap_file_path),
+                        os.path.join(shard_dir, 'shard.pcapng')],
+                       capture_output=True,
+                       check=True)
+        shard_paths = sorted(os.path.join(shard_dir, file_name)
+                             for file_name in os.listdir(shard_dir))
+    logger.log_debug(f'Created {len(shard_paths)} shards')
+    return shard_paths
+
+
+__worker_cache = None
+
+
+def __init_shard_worker(cache_path, cache_capacity):
+    global __worker_cache
+    __worker_cache = load_hostname_cache(cache_path, cache_capacity)
+    # Counters inherited from parent (fork) are not counted again
+    metrics.drain()
+
+
+def __analize_shard(shard_path, backend):
+    '''Worker: extracts and analyzes single shard. Returns (packets,
+    conversation log of shard, counters of shard)'''
+    log = pcap_native.ConversationLog()
+    if backend == 'native':
+        packets = __extract_packets_native(shard_path, HostTable(), log)
+    else:
+        # tshark numbers streams of shard on its own, conversations are
+        # logged from its output of all TCP frames
+        packets = metrics.timed(__extract_packets_tshark(
+            shard_path, __tshark_log_filter, HostTable(), log), 'extract')
+    packets = list(analize_packets(packets, __worker_cache))
+    return packets, log, metrics.drain()
+
+
+def __count_shards(shard_results):
+    '''Adds counters of shards to counters of this process as shards
+    arrive'''
+    for packets, log, counters in shard_results:
+        for name, value in counters.items():
+            metrics.inc(name, value)
+        yield packets, log
+
+
+def __resolve_host(host, address, ip, ip_version, names, hosts):
+    '''Returns host resolved by names of previous shards when hostname was
+    not resolved in shard'''
+    if host.hostname != address:
+        return host
+    name = names.get(ip.to_bytes(4 if ip_version == 4 else 16, 'big'))
+    return host if name is None else hosts.get(name)
+
+
+def __renumber_streams(shard_results):
+    '''Maps shard local tcp_stream and frame numbers into global ones.
+
+    Conversation logs of shards are replayed in order through single
+    tracker, so streams are numbered as when capture is read at once
+    (conversations continuing across shard boundary keep their stream,
+    reused ports start new one). Hostnames not resolved in shard are
+    resolved by names of previous shards. Frames are offset by shard size.
+    '''
+    tracker = pcap_native.ConversationTracker()
+    names = dict()
+    hosts = HostTable()
+
+    for shard_index, (packets, log) in enumerate(shard_results):
+        frame_offset = shard_index * shard_frames
+        streams = dict()
+        for frame, key, syn, sequence in log.events:
+            stream = tracker.stream(key, syn, sequence)
+            if syn:
+                streams[frame] = stream
+
+        for packet in packets:
+            stream = streams.get(packet.frame)
+            if stream is None:
+                # Frame not decoded by native reader gets own stream
+                stream = tracker.stream((shard_index, packet.frame),
+                                        False, None)
+            packet.tcp_stream = stream
+            packet.src = __resolve_host(packet.src, packet.src_address,
+                                        packet.src_ip, packet.ip_version,
+                                        names, hosts)
+            packet.dst = __resolve_host(packet.dst, packet.dst_address,
+                                        packet.dst_ip, packet.ip_version,
+                                        names, hosts)
+            packet.frame += frame_offset
+
+        names.update(log.names)
+        yield packets
+
+
+def __merge_shards(shard_results):
+    '''Merges ordered shard results in timestamp order. Packets are held
+    back only until next shard arrives, so at most two shards are kept in
+    memory'''
+    def timestamp_key(packet):
+        return packet.timestamp
+
+    pending = []
+    for packets in shard_results:
+        packets.sort(key=timestamp_key)
+        if packets:
+            boundary = packets[0].timestamp
+            ready = 0
+            while ready < len(pending) \
+                    and pending[ready].timestamp <= boundary:
+                ready += 1
+            yield from pending[:ready]
+            pending = list(heapq.merge(pending[ready:], packets,
+                                       key=timestamp_key))
+
+    yield from pending
+
+
+def __analize_packets_parallel(pcap_file_path, workers, cache, backend):
+    logger.log_debug(f'Analize "{pcap_file_path}" using {workers} workers')
+    if cache is None:
+        cache = HostnameCache()
+
+    with tempfile.TemporaryDirectory(prefix='metanet-shards-') as shard_dir:
+        shard_paths = __split_capture(pcap_file_path, shard_dir, backend)
+        # Stale classifier index is rebuilt here, before workers open it
+        load_resource_classifier()
+
+        # Workers start from persisted cache, parent cache learns entries
+        # from analyzed packets so it can be persisted after the run. Hosts
+        # resolved by names of previous shards are enriched by parent
+        with multiprocessing.Pool(processes=workers,
+                                  initializer=__init_shard_worker,
+                                  initargs=(cache.path,
+                                            cache.capacity)) as pool:
+            shard_results = __count_shards(pool.imap(
+                functools.partial(__analize_shard, backend=backend),
+                shard_paths))
+            for packet in analize_packets(
+                    __merge_shards(__renumber_streams(shard_results)),
+                    cache):
+                for host in (packet.src, packet.dst):
+                    cache.put(host.hostname, (host.domain,
+                                              host.subdomain,
+                                              host.fld,
+                                              host.resource_type))
+                yield packet
+
+    logger.log_debug('Parallel analize completed')
+
+
+__ipv4_regex = re.compile(r'^(\d{1,3}\.){3}\d{1,3}')
+
+
+def lookup_tld(hostname):
+    '''Returns (domain, subdomain, fld) of hostname, Nones for addresses
+    and hostnames without known TLD'''
+    try:
+        if __ipv4_regex.match(hostname):
+            logger.log_debug('TLD lookup skipped: %s', hostname)
+            return None, None, None
+
+        tld_result = tld.get_tld(url=hostname,
+                                 fix_protocol=True,
+                                 as_object=True)
+        return tld_result.domain, tld_result.subdomain, tld_result.fld
+    except tld.exceptions.TldDomainNotFound:
+        metrics.inc('tld_lookup_failures')
+        logger.log_error('TLD lookup failed: %s', hostname)
+        return None, None, None
+
+
+def analize_packets(packets, cache=None):
+    '''Enriches packet hosts with TLD data and resource type. Packets are
+    consumed and yielded one at a time, so any packet iterable (including
+    streamed tshark output) can be analyzed in constant memory.
+    Enrichment results are memoized per hostname in cache
+    '''
+    logger.log_debug("Analize packets")
 
     logger.log_debug("Loading hosts lists")
-    asset_hosts = [line.strip() for line in open(__assets_hosts_path, 'r')]
-    ads_hosts = [line.strip() for line in open(__ads_hosts_path, 'r')]
-    ipv4_regex = r'^(\d{1,3}\.){3}\d{1,3}'
-
-    def analize_packet(packet):
-        def fill_tld_data(field):
-            try:
-                lookup_hostname = packet[field]['hostname']
-
-                if re.match(ipv4_regex, lookup_hostname):
-                    logger.log_debug(
-                        f'TLD lookup skipped: [{field}] {lookup_hostname}')
-                    return
-
-                tld_result = tld.get_tld(url=lookup_hostname,
-                                         fix_protocol=True,
-                                         as_object=True)
-                packet[field]['domain'] = tld_result.domain
-                packet[field]['subdomain'] = tld_result.subdomain
-                packet[field]['fld'] = tld_result.fld
-            except tld.exceptions.TldDomainNotFound:
-                logger.log_error(
-                    f'TLD lookup failed: [{field}] {lookup_hostname}')
-
-        def fill_resource_type():
-            is_asset = any(asset_host in packet['dst']['hostname']
-                           for asset_host in asset_hosts)
-            if is_asset:
-                packet['metadata']['resource_type'] = 'asset'
-                return
-
-            is_ad = any(ads_host in packet['dst']['hostname']
-                        for ads_host in ads_hosts)
-            if is_ad:
-                packet['metadata']['resource_type'] = 'ads'
-                return
-
-            packet['metadata']['resource_type'] = 'other'
-
-        fill_tld_data('src')
-        fill_tld_data('dst')
-        fill_resource_type()
-
-    with click.progressbar(packets) as packets_bar:
-        for packet in packets_bar:
-            analize_packet(packet)
-
-    logger.log_debug("Analize packets completed")
-    return packets
+    resource_classifier = load_resource_classifier()
+    if cache is None:
+        cache = HostnameCache()
+
+    hits, misses = cache.hits, cache.misses
+    enrich_seconds = 0.0
+
+    def enrich_host(host):
+        nonlocal enrich_seconds
+        started = time.perf_counter()
+        entry = cache.get(host.hostname)
+        if entry is None:
+            entry = (*lookup_tld(host.hostname),
+                     resource_classifier.classify(host.hostname))
+            cache.put(host.hostname, entry)
+        host.domain, host.subdomain, host.fld, host.resource_type = entry
+        enrich_seconds += time.perf_counter() - started
+
+    packet_count = 0
+    try:
+        for packet in packets:
+            # Hosts are shared between packets, so each is enriched once
+            if not packet.src.is_enriched:
+                enrich_host(packet.src)
+            if not packet.dst.is_enriched:
+                enrich_host(packet.dst)
+            packet_count += 1
+            yield packet
+    finally:
+        metrics.observe('analyze', enrich_seconds, packet_count)
+        metrics.inc('hostname_cache_hits', cache.hits - hits)
+        metrics.inc('hostname_cache_misses', cache.misses - misses)
+
+    logger.log_debug("Analize packets completed: %d packets", packet_count)
+    logger.log_debug("Hostname cache: %s", cache.stats())
@@ -0,0 +1,536 @@
+'''Pure Python PCAP/PCAPNG reader used as tshark-free extraction backend.
+
+Capture file is memory-mapped and packet headers are decoded in place with
+struct.unpack_from over memoryview slices, so packet data is never copied.
+Only SYN-without-ACK TCP packets over IPv4/IPv6 are reported. Hostnames are
+resolved from DNS answers and pcapng name resolution blocks seen earlier in
+the capture, and tcp_stream numbers follow tshark conversation numbering.
+'''
+import os
+import mmap
+import contextlib
+import socket
+import struct
+import simple_logger as logger
+
+PCAP_MAGIC_MICRO = 0xa1b2c3d4
+PCAP_MAGIC_NANO = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_OBSOLETE_PACKET = 0x00000002
+PCAPNG_NAME_RESOLUTION = 0x00000004
+PCAPNG_ENHANCED_PACKET = 0x00000006
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+IPV6_AUTHENTICATION_HEADER = 51
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+DNS_PORT = 53
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+DNS_CLASS_IN = 1
+
+
+class CaptureFormatError(ValueError):
+    '''Raised when file is not a supported PCAP/PCAPNG capture'''
+
+
+def __network_layer(linktype, data):
+    '''Returns (ip_version, offset) of network layer or None'''
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype, = struct.unpack_from('>H', data, offset)
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype, = struct.unpack_from('>H', data, offset)
+        offset += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype, = struct.unpack_from('>H', data, 14)
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype, = struct.unpack_from('>H', data, 0)
+        offset = 20
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        family = data[0] or data[3]
+        if family == 2:
+            return 4, 4
+        if family in (10, 24, 28, 30):
+            return 6, 4
+        return None
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return data[0] >> 4, 0
+    else:
+        return None
+
+    if ethertype == ETHERTYPE_IPV4:
+        return 4, offset
+    if ethertype == ETHERTYPE_IPV6:
+        return 6, offset
+    return None
+
+
+def __transport_layer(ip_version, data, offset):
+    '''Returns (protocol, src, dst, transport_offset) or None. Addresses are
+    returned as bytes. Non-first fragments are ignored'''
+    if ip_version == 4:
+        header_length = (data[offset] & 0x0f) * 4
+        fragment, = struct.unpack_from('>H', data, offset + 6)
+        if fragment & 0x1fff:
+            return None
+        protocol = data[offset + 9]
+        src = bytes(data[offset + 12:offset + 16])
+        dst = bytes(data[offset + 16:offset + 20])
+        return protocol, src, dst, offset + header_length
+
+    if ip_version == 6:
+        protocol = data[offset + 6]
+        src = bytes(data[offset + 8:offset + 24])
+        dst = bytes(data[offset + 24:offset + 40])
+        offset += 40
+        while True:
+            if protocol in IPV6_EXTENSION_HEADERS:
+                header_length = (data[offset + 1] + 1) * 8
+            elif protocol == IPV6_FRAGMENT_HEADER:
+                fragment, = struct.unpack_from('>H', data, offset + 2)
+                if fragment >> 3:
+                    return None
+                header_length = 8
+            elif protocol == IPV6_AUTHENTICATION_HEADER:
+                header_length = (data[offset + 1] + 2) * 4
+            else:
+                return protocol, src, dst, offset
+            protocol = data[offset]
+            offset += header_length
+
+    return None
+
+
+def __read_dns_name(data, offset, depth=0):
+    '''Reads (possibly compressed) DNS name. Returns (name, next_offset)'''
+    labels = []
+    next_offset = None
+    while True:
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if depth > 16:
+                raise ValueError('DNS name compression loop')
+            pointer, = struct.unpack_from('>H', data, offset)
+            if next_offset is None:
+                next_offset = offset + 2
+            offset = pointer & 0x3fff
+            depth += 1
+            continue
+        if length == 0:
+            offset += 1
+            break
+        labels.append(bytes(data[offset + 1:offset + 1 + length])
+                      .decode('ascii', 'replace'))
+        offset += 1 + length
+
+    return '.'.join(labels), offset if next_offset is None else next_offset
+
+
+def __read_dns_answers(data, names):
+    '''Adds A/AAAA answers from DNS response in data to names'''
+    flags, questions, answers = struct.unpack_from('>HHH', data, 2)
+    if not flags & 0x8000:
+        return
+
+    offset = 12
+    for _ in range(questions):
+        _, offset = __read_dns_name(data, offset)
+        offset += 4
+
+    for _ in range(answers):
+        name, offset = __read_dns_name(data, offset)
+        record_type, record_class, _, length = \
+            struct.unpack_from('>HHIH', data, offset)
+        offset += 10
+        if record_class == DNS_CLASS_IN and (
+                (record_type == DNS_TYPE_A and length == 4)
+                or (record_type == DNS_TYPE_AAAA and length == 16)):
+            names[bytes(data[offset:offset + length])] = name
+        offset += length
+
+
+def __read_name_resolution_block(data, endian, names):
+    '''Adds pcapng name resolution block records to names'''
+    offset = 0
+    while offset + 4 <= len(data):
+        record_type, length = struct.unpack_from(f'{endian}HH', data, offset)
+        if record_type == 0:
+            break
+        value = data[offset + 4:offset + 4 + length]
+        address_length = 4 if record_type == 1 else 16
+        if record_type in (1, 2) and length > address_length:
+            hostnames = bytes(value[address_length:]).split(b'\0')
+            if hostnames[0]:
+                names[bytes(value[:address_length])] = \
+                    hostnames[0].decode('ascii', 'replace')
+        offset += 4 + ((length + 3) & ~3)
+
+
+class CaptureState:
+    '''Reader state shared between reads of capture ranges: byte order,
+    pcapng interfaces, resolved names and header (file header, section and
+    interface description blocks) locations as (offset, length)'''
+
+    def __init__(self):
+        self.endian = '<'
+        self.interfaces = []
+        self.names = dict()
+        self.headers = []
+
+
+def _read_pcap(view, state, start=None, end=None):
+    '''Yields (offset, length, timestamp, linktype, data) of records in
+    classic PCAP file'''
+    for endian in ('<', '>'):
+        magic, = struct.unpack_from(f'{endian}I', view, 0)
+        if magic in (PCAP_MAGIC_MICRO, PCAP_MAGIC_NANO):
+            break
+    resolution = 1e-6 if magic == PCAP_MAGIC_MICRO else 1e-9
+    linktype, = struct.unpack_from(f'{endian}I', view, 20)
+    linktype &= 0x0fffffff
+    state.endian = endian
+
+    if start is None:
+        state.headers.append((0, 24))
+        start = 24
+    end = len(view) if end is None else min(end, len(view))
+
+    record_header = struct.Struct(f'{endian}IIII')
+    offset = start
+    while offset + record_header.size <= end:
+        seconds, fraction, captured_length, _ = \
+            record_header.unpack_from(view, offset)
+        length = record_header.size + captured_length
+        data_offset = offset + record_header.size
+        yield (offset, length, seconds + fraction * resolution, linktype,
+               view[data_offset:data_offset + captured_length])
+        offset += length
+
+
+def __timestamp_resolution(options, endian):
+    '''Returns (resolution, offset) from pcapng interface options'''
+    resolution = 1e-6
+    timestamp_offset = 0
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(f'{endian}HH', options, offset)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            value = options[offset + 4]
+            resolution = 2.0 ** -(value & 0x7f) if value & 0x80 \
+                else 10.0 ** -value
+        elif code == 14 and length == 8:
+            timestamp_offset, = struct.unpack_from(f'{endian}q', options,
+                                                   offset + 4)
+        offset += 4 + ((length + 3) & ~3)
+    return resolution, timestamp_offset
+
+
+def _read_pcapng(view, state, start=None, end=None):
+    '''Yields (offset, length, timestamp, linktype, data) of packet blocks
+    in PCAPNG file'''
+    offset = 0 if start is None else start
+    end = len(view) if end is None else min(end, len(view))
+
+    while offset + 12 <= end:
+        block_type, = struct.unpack_from(f'{state.endian}I', view, offset)
+        if block_type == PCAPNG_SECTION_HEADER:
+            magic, = struct.unpack_from('<I', view, offset + 8)
+            state.endian = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            state.interfaces = []
+        endian = state.endian
+
+        block_length, = struct.unpack_from(f'{endian}I', view, offset + 4)
+        if block_length < 12 or offset + block_length > len(view):
+            logger.log_warning(f'Truncated pcapng block at offset {offset}')
+            return
+        body = view[offset + 8:offset + block_length - 4]
+
+        if block_type == PCAPNG_SECTION_HEADER:
+            state.headers.append((offset, block_length))
+        elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            state.headers.append((offset, block_length))
+            linktype, = struct.unpack_from(f'{endian}H', body, 0)
+            resolution, timestamp_offset = \
+                __timestamp_resolution(body[8:], endian)
+            state.interfaces.append((linktype, resolution, timestamp_offset))
+        elif block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET):
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured_length = \
+                    struct.unpack_from(f'{endian}IIII', body, 0)
+            else:
+                interface, _, high, low, captured_length = \
+                    struct.unpack_from(f'{endian}HHIII', body, 0)
+            linktype, resolution, timestamp_offset = \
+                state.interfaces[interface]
+            timestamp = ((high << 32) | low) * resolution + timestamp_offset
+            yield (offset, block_length, timestamp, linktype,
+                   body[20:20 + captured_length])
+        elif block_type == PCAPNG_NAME_RESOLUTION:
+            __read_name_resolution_block(body, endian, state.names)
+
+        offset += block_length
+
+
+def __format_address(address):
+    family = socket.AF_INET if len(address) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, address)
+
+
+def decode_tcp(linktype, data, names):
+    '''Decodes frame. Returns (src, src_port, dst, dst_port, sequence,
+    flags) for TCP frames or None. Addresses are bytes. DNS answers found in
+    other frames are added to names'''
+    try:
+        network = __network_layer(linktype, data)
+        if network is None:
+            return None
+        ip_version, ip_offset = network
+        transport = __transport_layer(ip_version, data, ip_offset)
+        if transport is None:
+            return None
+        protocol, src, dst, offset = transport
+
+        if protocol == IPPROTO_UDP:
+            src_port, = struct.unpack_from('>H', data, offset)
+            if src_port == DNS_PORT:
+                __read_dns_answers(data[offset + 8:], names)
+            return None
+        if protocol != IPPROTO_TCP:
+            return None
+
+        src_port, dst_port, sequence = \
+            struct.unpack_from('>HHI', data, offset)
+        return src, src_port, dst, dst_port, sequence, data[offset + 13]
+    except (struct.error, IndexError, ValueError):
+        return None
+
+
+def is_syn(flags):
+    '''True for SYN without ACK'''
+    return flags & (TCP_SYN | TCP_ACK) == TCP_SYN
+
+
+def conversation_key(src, src_port, dst, dst_port):
+    '''Direction independent conversation key'''
+    if (src, src_port) < (dst, dst_port):
+        return src, src_port, dst, dst_port
+    return dst, dst_port, src, src_port
+
+
+class ConversationTracker:
+    '''Assigns tcp_stream numbers the way tshark does: each new
+    conversation gets next number, and SYN with different initial sequence
+    number on known conversation (port reuse) starts a new one'''
+
+    def __init__(self):
+        self.stream_count = 0
+        self.__conversations = dict()
+
+    def stream(self, key, syn, sequence):
+        conversation = self.__conversations.get(key)
+        if conversation is None or (syn and conversation[1] is not None
+                                    and conversation[1] != sequence):
+            conversation = [self.stream_count, None]
+            self.__conversations[key] = conversation
+            self.stream_count += 1
+        if syn:
+            conversation[1] = sequence
+        return conversation[0]
+
+
+class ConversationLog:
+    '''Frames of capture part that can change ConversationTracker state,
+    as (frame, key, syn, sequence) events: first frame of each conversation
+    and SYNs. names are hostnames resolved in capture part.
+
+    Replaying logs of consecutive capture parts (e.g. shards processed in
+    parallel) through single tracker numbers their streams exactly as when
+    whole capture is read at once'''
+
+    def __init__(self):
+        self.events = []
+        self.names = dict()
+
+
+class Capture:
+    '''Memory-mapped PCAP/PCAPNG capture file'''
+
+    def __init__(self, view):
+        self.view = view
+        self.state = CaptureState()
+        magic = view[:4].tobytes()
+        if magic in (struct.pack('<I', PCAP_MAGIC_MICRO),
+                     struct.pack('>I', PCAP_MAGIC_MICRO),
+                     struct.pack('<I', PCAP_MAGIC_NANO),
+                     struct.pack('>I', PCAP_MAGIC_NANO)):
+            self.format = 'pcap'
+            self.__reader = _read_pcap
+        elif magic == struct.pack('<I', PCAPNG_SECTION_HEADER):
+            self.format = 'pcapng'
+            self.__reader = _read_pcapng
+        else:
+            raise CaptureFormatError('Not a PCAP/PCAPNG file')
+
+    def frames(self, start=None, end=None):
+        '''Yields (offset, length, timestamp, linktype, data) of frames.
+        When reading from start offset, headers must be read first so
+        reader state (byte order, interfaces) is known'''
+        return self.__reader(self.view, self.state, start, end)
+
+
+@contextlib.contextmanager
+def open_capture(pcap_file_path):
+    '''Memory-maps capture file and yields Capture'''
+    if os.path.getsize(pcap_file_path) < 24:
+        raise CaptureFormatError(f'"{pcap_file_path}" is not a capture file')
+
+    with open(pcap_file_path, 'rb') as pcap_file, \
+            mmap.mmap(pcap_file.fileno(), 0,
+                      access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            yield Capture(view)
+        except CaptureFormatError as ex:
+            raise CaptureFormatError(
+                f'"{pcap_file_path}" is not a PCAP/PCAPNG file') from ex
+        finally:
+            view.release()
+
+
+def extract_packets(pcap_file_path, log=None, index_builder=None):
+    '''Yields (timestamp, frame, tcp_stream, ip_version, src_ip, src_host,
+    src_port, dst_ip, dst_host, dst_port) for every SYN-without-ACK packet in
+    capture file. IP addresses are integer packed, unresolved hostnames are
+    formatted IP addresses. Conversations are recorded in log if given.
+    TCP frames are added to frame index builder if given, index is finished
+    once whole capture is read (dropped otherwise)
+    '''
+    logger.log_debug(f'Extract "{pcap_file_path}" packets using native '
+                     f'reader')
+
+    with open_capture(pcap_file_path) as capture:
+        names = capture.state.names
+        addresses = dict()
+        tracker = ConversationTracker()
+        packet_count = 0
+
+        def address_info(address):
+            '''Returns (integer packed address, hostname)'''
+            info = addresses.get(address)
+            if info is None:
+                info = (int.from_bytes(address, 'big'),
+                        __format_address(address))
+                addresses[address] = info
+            return info[0], names.get(address, info[1])
+
+        frames = capture.frames()
+        is_read = False
+        try:
+            for frame, (offset, length, timestamp, linktype, data) \
+                    in enumerate(frames, 1):
+                tcp = decode_tcp(linktype, data, names)
+                del data
+                if tcp is None:
+                    continue
+
+                src, src_port, dst, dst_port, sequence, flags = tcp
+                syn = is_syn(flags)
+                key = conversation_key(src, src_port, dst, dst_port)
+                stream_count = tracker.stream_count
+                tcp_stream = tracker.stream(key, syn, sequence)
+                if log is not None and (
+                        syn or tracker.stream_count != stream_count):
+                    log.events.append((frame, key, syn, sequence))
+                if index_builder is not None:
+                    index_builder.add(offset, length, timestamp, key,
+                                      tcp_stream,
+                                      tracker.stream_count != stream_count)
+                if not syn:
+                    continue
+
+                src_ip, src_host = address_info(src)
+                dst_ip, dst_host = address_info(dst)
+                packet_count += 1
+                yield (timestamp, frame, tcp_stream,
+                       4 if len(src) == 4 else 6,
+                       src_ip, src_host, src_port,
+                       dst_ip, dst_host, dst_port)
+            is_read = True
+        finally:
+            frames.close()
+            if log is not None:
+                log.names = dict(names)
+            if index_builder is not None:
+                if is_read:
+                    index_builder.finish(capture)
+                else:
+                    index_builder.abort()
+
+    logger.log_debug(f'Extracted {packet_count} packets')
+
+
+def __write_shard(capture, path, start, end):
+    '''Writes frames in [start, end) byte range of capture into new capture
+    file, preceded by headers read before them'''
+    with open(path, 'wb') as shard:
+        for offset, length in capture.state.headers:
+            if offset < start:
+                shard.write(capture.view[offset:offset + length])
+        shard.write(capture.view[start:end])
+
+
+def split_capture(pcap_file_path, shard_dir, shard_frames):
+    '''Splits capture into shard files of shard_frames consecutive frames
+    (as editcap -c does), in same format as capture. Returns shard paths in
+    frame order'''
+    shard_paths = []
+    with open_capture(pcap_file_path) as capture:
+        extension = capture.format
+        start = end = 0
+        frame_count = 0
+        frames = capture.frames()
+        try:
+            for offset, length, _, _, data in frames:
+                del data
+                frame_count += 1
+                end = offset + length
+                if frame_count % shard_frames == 0:
+                    shard_paths.append(os.path.join(
+                        shard_dir,
+                        f'shard-{len(shard_paths):05d}.{extension}'))
+                    __write_shard(capture, shard_paths[-1], start, end)
+                    start = end
+        finally:
+            frames.close()
+
+        if frame_count % shard_frames:
+            shard_paths.append(os.path.join(
+                shard_dir, f'shard-{len(shard_paths):05d}.{extension}'))
+            __write_shard(capture, shard_paths[-1], start, end)
+    return shard_paths
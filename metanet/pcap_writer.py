@@ -0,0 +1,312 @@
+'''Synthetic PCAP/PCAPNG capture writer.
+
+Writes generated samples (see generator.generate_chunks) as real captures,
+so extraction, enrichment and indexing can be load-tested end to end with
+reproducible inputs. Every packet is Ethernet/IPv4 TCP SYN from client to
+host of the sample. Each chunk starts with DNS responses resolving hosts
+contacted in it, so tshark and native backend resolve hostnames as in
+real captures.
+
+SYN frames have fixed layout, so whole chunk is built as NumPy record
+array (including IP and TCP checksums) and written with single call,
+which keeps writing multi-GB captures disk bound.
+'''
+import ipaddress
+import struct
+import contextlib
+import click
+import numpy as np
+import simple_logger as logger
+
+formats = ['pcap', 'pcapng']
+
+client_address = '10.0.0.2'
+resolver_address = '10.0.0.1'
+client_mac = b'\x00\x11\x22\x33\x44\x55'
+gateway_mac = b'\x66\x77\x88\x99\xaa\xbb'
+dns_ttl = 300
+
+# Frames are written in slices of at most this many packets
+write_slice = 262144
+
+__size_units = {'': 1, 'B': 1, 'K': 2**10, 'KB': 2**10, 'M': 2**20,
+                'MB': 2**20, 'G': 2**30, 'GB': 2**30, 'T': 2**40, 'TB': 2**40}
+
+__syn_fields = [
+    ('eth_dst', 'S6'), ('eth_src', 'S6'), ('ethertype', '>u2'),
+    ('ip_version', 'u1'), ('ip_tos', 'u1'), ('ip_length', '>u2'),
+    ('ip_id', '>u2'), ('ip_fragment', '>u2'), ('ip_ttl', 'u1'),
+    ('ip_protocol', 'u1'), ('ip_checksum', '>u2'),
+    ('ip_src', '>u4'), ('ip_dst', '>u4'),
+    ('src_port', '>u2'), ('dst_port', '>u2'),
+    ('sequence', '>u4'), ('acknowledgment', '>u4'),
+    ('data_offset', 'u1'), ('flags', 'u1'), ('window', '>u2'),
+    ('tcp_checksum', '>u2'), ('urgent', '>u2')
+]
+syn_length = 54
+
+_pcap_syn = np.dtype(
+    [('seconds', '<u4'), ('microseconds', '<u4'),
+     ('captured_length', '<u4'), ('original_length', '<u4')]
+    + __syn_fields)
+
+_pcapng_syn = np.dtype(
+    [('block_type', '<u4'), ('block_length', '<u4'), ('interface', '<u4'),
+     ('timestamp_high', '<u4'), ('timestamp_low', '<u4'),
+     ('captured_length', '<u4'), ('original_length', '<u4')]
+    + __syn_fields
+    + [('padding', 'S2'), ('block_length_trailer', '<u4')])
+
+
+def parse_size(size):
+    '''Parses size with optional unit suffix (e.g. 500MB, 10G) into bytes'''
+    value = size.strip().upper()
+    number = value.rstrip('KMGTB')
+    unit = value[len(number):]
+    try:
+        return int(float(number) * __size_units[unit])
+    except (ValueError, KeyError) as ex:
+        raise ValueError(f'Invalid size "{size}"') from ex
+
+
+def format_for(path):
+    '''Returns capture format implied by file name'''
+    return 'pcapng' if path.lower().endswith('.pcapng') else 'pcap'
+
+
+def checksum(header):
+    '''Internet checksum of bytes'''
+    if len(header) % 2:
+        header += b'\0'
+    total = sum(struct.unpack(f'>{len(header) // 2}H', header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def ipv4_packet(src, dst, protocol, payload):
+    header = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0,
+                         64, protocol, 0, src, dst)
+    header = header[:10] + struct.pack('>H', checksum(header)) + header[12:]
+    return header + payload
+
+
+def ethernet_frame(payload, src=gateway_mac, dst=client_mac):
+    return dst + src + b'\x08\x00' + payload
+
+
+def dns_response(hostname, address, ttl=dns_ttl):
+    '''DNS response with single A record resolving hostname'''
+    name = b''.join(bytes([len(label)]) + label.encode()
+                    for label in hostname.split('.')) + b'\0'
+    return struct.pack('>HHHHHH', 1, 0x8180, 1, 1, 0, 0) \
+        + name + struct.pack('>HH', 1, 1) \
+        + b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, ttl, 4) + address
+
+
+def dns_frame(hostname, address):
+    '''Ethernet frame of DNS response from resolver to client'''
+    udp = dns_response(hostname, address)
+    udp = struct.pack('>HHHH', 53, 40000, 8 + len(udp), 0) + udp
+    return ethernet_frame(ipv4_packet(
+        ipaddress.IPv4Address(resolver_address).packed,
+        ipaddress.IPv4Address(client_address).packed, 17, udp))
+
+
+def _fold(total):
+    '''Folds 32-bit sums into 16-bit one's complement checksums'''
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _spread_timestamps(timestamps):
+    '''Returns (seconds, microseconds). Packets sharing same whole second
+    are spread evenly over it, keeping their order'''
+    if np.issubdtype(timestamps.dtype, np.floating):
+        seconds = np.floor(timestamps).astype(np.int64)
+        return seconds, np.minimum(np.rint(
+            (timestamps - seconds) * 1e6).astype(np.int64), 999999)
+
+    seconds = timestamps.astype(np.int64)
+    count = len(seconds)
+    starts = np.flatnonzero(np.r_[True, seconds[1:] != seconds[:-1]])
+    lengths = np.diff(np.r_[starts, count])
+    position = np.arange(count) - np.repeat(starts, lengths)
+    return seconds, position * 1000000 // np.repeat(lengths, lengths)
+
+
+class CaptureWriter:
+    '''Streams TCP SYN packets into PCAP or PCAPNG file.
+
+    hosts is list of (hostname, IPv4 address) indexed by packet host
+    indices'''
+
+    def __init__(self, path, hosts, file_format='pcap'):
+        self.path = path
+        self.file_format = file_format
+        self.frames = 0
+        self.bytes = 0
+        self.__hostnames = [hostname for hostname, _ in hosts]
+        self.__addresses = np.array(
+            [int(ipaddress.IPv4Address(address)) for _, address in hosts],
+            dtype=np.uint32)
+        self.__client = int(ipaddress.IPv4Address(client_address))
+        self.__syn_dtype = _pcap_syn if file_format == 'pcap' \
+            else _pcapng_syn
+        self.__file = open(path, 'wb')
+        self.__write(self.__file_header())
+
+    @property
+    def frame_size(self):
+        '''Size of SYN frame record in file'''
+        return self.__syn_dtype.itemsize
+
+    def __write(self, data):
+        self.__file.write(data)
+        self.bytes += len(data)
+
+    def __file_header(self):
+        if self.file_format == 'pcap':
+            return struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+        section = struct.pack('<IIIHHq', 0x0a0d0d0a, 28, 0x1a2b3c4d, 1, 0,
+                              -1) + struct.pack('<I', 28)
+        interface = struct.pack('<IIHHI', 1, 20, 1, 0, 65535) \
+            + struct.pack('<I', 20)
+        return section + interface
+
+    def __write_frame(self, seconds, microseconds, frame):
+        if self.file_format == 'pcap':
+            header = struct.pack('<IIII', seconds, microseconds,
+                                 len(frame), len(frame))
+            self.__write(header + frame)
+            return
+        padded = frame + b'\0' * (-len(frame) % 4)
+        timestamp = seconds * 1000000 + microseconds
+        block_length = 32 + len(padded)
+        self.__write(struct.pack('<IIIIIII', 6, block_length, 0,
+                                 timestamp >> 32, timestamp & 0xffffffff,
+                                 len(frame), len(frame))
+                     + padded + struct.pack('<I', block_length))
+
+    def __syn_records(self, seconds, microseconds, host_indices):
+        count = len(seconds)
+        records = np.zeros(count, dtype=self.__syn_dtype)
+        if self.file_format == 'pcap':
+            records['seconds'] = seconds
+            records['microseconds'] = microseconds
+        else:
+            timestamps = seconds * 1000000 + microseconds
+            records['block_type'] = 6
+            records['block_length'] = self.__syn_dtype.itemsize
+            records['block_length_trailer'] = self.__syn_dtype.itemsize
+            records['timestamp_high'] = timestamps >> 32
+            records['timestamp_low'] = timestamps & 0xffffffff
+        records['captured_length'] = syn_length
+        records['original_length'] = syn_length
+
+        # Frame numbers make ports, IP IDs and sequence numbers unique
+        numbers = np.arange(self.frames, self.frames + count,
+                            dtype=np.uint64)
+        destinations = self.__addresses[host_indices].astype(np.uint64)
+        client = np.uint64(self.__client)
+        ip_id = numbers & 0xffff
+        src_port = 1024 + numbers % 64512
+        sequence = (numbers * 2654435761) & 0xffffffff
+
+        records['eth_dst'] = gateway_mac
+        records['eth_src'] = client_mac
+        records['ethertype'] = 0x0800
+        records['ip_version'] = 0x45
+        records['ip_length'] = 40
+        records['ip_id'] = ip_id
+        records['ip_ttl'] = 64
+        records['ip_protocol'] = 6
+        records['ip_src'] = client
+        records['ip_dst'] = destinations
+        records['src_port'] = src_port
+        records['dst_port'] = 443
+        records['sequence'] = sequence
+        records['data_offset'] = 0x50
+        records['flags'] = 0x02
+        records['window'] = 65535
+
+        addresses = (client >> 16) + (client & 0xffff) \
+            + (destinations >> 16) + (destinations & 0xffff)
+        records['ip_checksum'] = _fold(
+            0x4500 + 40 + ip_id + 0x4006 + addresses)
+        # Pseudo header (addresses, protocol, TCP length) and TCP header
+        records['tcp_checksum'] = _fold(
+            addresses + 6 + 20 + src_port + 443
+            + (sequence >> 16) + (sequence & 0xffff) + 0x5002 + 65535)
+        return records
+
+    def write_chunk(self, timestamps, host_indices, limit=None):
+        '''Writes packets of chunk (sorted timestamps and host indices),
+        preceded by DNS responses for its hosts. At most limit bytes are
+        written. Returns number of written packets'''
+        if not len(timestamps):
+            return 0
+        seconds, microseconds = _spread_timestamps(np.asarray(timestamps))
+        host_indices = np.asarray(host_indices)
+
+        for host in np.unique(host_indices).tolist():
+            self.__write_frame(int(seconds[0]), int(microseconds[0]),
+                               dns_frame(self.__hostnames[host],
+                                         int(self.__addresses[host])
+                                         .to_bytes(4, 'big')))
+            self.frames += 1
+
+        count = len(seconds)
+        if limit is not None:
+            count = min(count, max(0, limit - self.bytes)
+                        // self.frame_size)
+        for start in range(0, count, write_slice):
+            end = min(start + write_slice, count)
+            self.__write(self.__syn_records(
+                seconds[start:end], microseconds[start:end],
+                host_indices[start:end]).tobytes())
+            self.frames += end - start
+        return count
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_capture(path, chunks, hosts, file_format=None, max_bytes=None,
+                  max_packets=None):
+    '''Streams generated chunks ({'timestamps', 'domains'} arrays) into
+    capture file until chunks are exhausted or file reaches max_bytes or
+    max_packets SYN packets. Returns (packets, bytes) written'''
+    file_format = file_format or format_for(path)
+    packets = 0
+    length = max_bytes or max_packets
+    progress = contextlib.nullcontext() if length is None \
+        else click.progressbar(length=length, label='Writing capture')
+    with CaptureWriter(path, hosts, file_format) as writer, progress:
+        for chunk in chunks:
+            timestamps, domains = chunk['timestamps'], chunk['domains']
+            if max_packets is not None:
+                timestamps = timestamps[:max_packets - packets]
+                domains = domains[:max_packets - packets]
+            written_bytes = writer.bytes
+            written = writer.write_chunk(timestamps, domains, max_bytes)
+            packets += written
+            if length is not None:
+                progress.update(written if max_bytes is None
+                                else writer.bytes - written_bytes)
+            if written < len(timestamps) \
+                    or max_packets is not None and packets >= max_packets \
+                    or max_bytes is not None \
+                    and writer.bytes + writer.frame_size > max_bytes:
+                break
+
+    logger.log_info(f'Wrote {packets} packets ({writer.frames} frames, '
+                    f'{writer.bytes / 2**20:.1f} MiB) to "{path}"')
+    return packets, writer.bytes
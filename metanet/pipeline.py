@@ -0,0 +1,95 @@
+import time
+import queue
+import threading
+import simple_logger as logger
+
+_end_of_stream = object()
+
+
+class _StageError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class BufferedStage:
+    '''Iterates source in background thread, handing items over bounded
+    queue. Chaining stages (extract -> enrich -> index) lets them run
+    concurrently, so run time approaches the slowest stage instead of the
+    sum of all stages. When consumer falls behind, producer blocks on full
+    queue instead of buffering more items.
+
+    Items are passed in batches of batch_size to keep queue overhead low.
+    Exceptions raised by source are re-raised in consumer.
+    '''
+
+    join_timeout = 5.0
+
+    def __init__(self, source, name, queue_size=10000, batch_size=256):
+        self.source = source
+        self.name = name
+        self.batch_size = batch_size
+        self.produced = 0
+        self.blocked_seconds = 0.0
+        self.__queue = queue.Queue(maxsize=max(1, queue_size // batch_size))
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__produce,
+                                         name=name, daemon=True)
+
+    def __put(self, item):
+        '''Puts item, returns False if consumer stopped'''
+        blocked_from = None
+        while not self.__stop.is_set():
+            try:
+                self.__queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                if blocked_from is None:
+                    blocked_from = time.monotonic()
+        if blocked_from is not None:
+            self.blocked_seconds += time.monotonic() - blocked_from
+        return not self.__stop.is_set()
+
+    def __produce(self):
+        batch = []
+        try:
+            for item in self.source:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self.produced += len(batch)
+                    if not self.__put(batch):
+                        return
+                    batch = []
+            self.produced += len(batch)
+            if batch and not self.__put(batch):
+                return
+            self.__put(_end_of_stream)
+        except Exception as ex:
+            self.__put(_StageError(ex))
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+
+    def __iter__(self):
+        self.__thread.start()
+        waited = 0.0
+        try:
+            while True:
+                waiting_from = time.monotonic()
+                batch = self.__queue.get()
+                waited += time.monotonic() - waiting_from
+                if batch is _end_of_stream:
+                    break
+                if isinstance(batch, _StageError):
+                    raise batch.exception
+                yield from batch
+        finally:
+            self.__stop.set()
+            self.__thread.join(timeout=self.join_timeout)
+            logger.log_debug(f'Stage {self.name}: {self.produced} items, '
+                             f'producer blocked {self.blocked_seconds:.1f}s, '
+                             f'consumer waited {waited:.1f}s')
+
+
+def buffered(source, name, queue_size=10000):
+    '''Returns iterable running source in its own thread'''
+    return iter(BufferedStage(source, name, queue_size))
@@ -1,29 +1,161 @@
-import matplotlib.pylab as plt
-import random
+'''Plots of packets over time per destination.
 
+Packets are reduced to (timestamp, destination) points kept in compact
+arrays and binned with NumPy histograms, so rendering cost depends on
+number of bins and series, not packets. Only top destinations by packet
+count get own series, rest is merged into "other". Plots are rendered
+without display (Agg canvas) into PNG/SVG/PDF file, or shown in window.
+'''
+import zlib
+from array import array
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+import simple_logger as logger
 
-def plot_sample_packets(packets, on_same_axis=False):
-    '''Displays scatter plot for sample packets.
-    on_same_axis controls if domain packets are grouped or not
-    '''
-    colors = ['b', 'g', 'r', 'c', 'y', 'k', 'm']
+styles = ['lines', 'raster']
 
-    groups = dict()
+__palette = colormaps['tab20'].colors
+other_color = '0.6'
+
+
+def destination_color(destination):
+    '''Color of destination, same in every plot and run'''
+    return __palette[zlib.crc32(destination.encode()) % len(__palette)]
+
+
+def packet_points(packets):
+    '''Yields (timestamp, destination) of Packet records. Destination is
+    hostname or address when hostname is unknown'''
     for packet in packets:
-        groups.setdefault(packet['dst']['hostname'], []).append(packet)
+        yield packet.timestamp, packet.dst.hostname or packet.dst_address
+
+
+class PacketBins:
+    '''Collects (timestamp, destination) points and bins them per
+    destination. Points take 12 bytes each, destinations are interned'''
+
+    def __init__(self):
+        self.destinations = []
+        self.__indices = dict()
+        self.__timestamps = array('d')
+        self.__destinations = array('i')
+
+    def __len__(self):
+        return len(self.__timestamps)
+
+    def add(self, timestamp, destination):
+        index = self.__indices.get(destination)
+        if index is None:
+            index = self.__indices[destination] = len(self.destinations)
+            self.destinations.append(destination)
+        self.__timestamps.append(timestamp)
+        self.__destinations.append(index)
+
+    def extend(self, points):
+        for timestamp, destination in points:
+            self.add(timestamp, destination)
+        return self
+
+    def histogram(self, bins=500, top=20):
+        '''Returns (bin edges, series names, counts) where counts has row
+        of packets per bin for each of top destinations (by packet count)
+        followed by row of remaining destinations, if there are any'''
+        timestamps = np.frombuffer(self.__timestamps, dtype=np.float64)
+        destinations = np.frombuffer(self.__destinations, dtype=np.int32)
+        if not len(timestamps):
+            return np.zeros(bins + 1), [], np.zeros((0, bins))
+
+        totals = np.bincount(destinations, minlength=len(self.destinations))
+        ranked = np.argsort(-totals, kind='stable')[:top]
+        rows = np.full(len(self.destinations), len(ranked))
+        rows[ranked] = np.arange(len(ranked))
+        series = len(ranked) + (len(self.destinations) > len(ranked))
+
+        low, high = timestamps.min(), timestamps.max()
+        edges = np.linspace(low, max(high, low + 1), bins + 1)
+        counts, _, _ = np.histogram2d(
+            rows[destinations], timestamps,
+            bins=(np.arange(series + 1), edges))
+        names = [self.destinations[index] for index in ranked]
+        if series > len(ranked):
+            names.append('other')
+        return edges, names, counts
+
+
+def __datetimes(timestamps):
+    return np.asarray(np.round(np.asarray(timestamps) * 1000),
+                      dtype=np.int64).astype('datetime64[ms]')
+
+
+def __render_lines(axes, edges, names, counts):
+    width = edges[1] - edges[0]
+    times = __datetimes(edges)
+    for name, row in zip(names, counts):
+        if name == 'other':
+            axes.stairs(row / width, times, label=name, color=other_color,
+                        linestyle='--')
+        else:
+            axes.stairs(row / width, times, label=name,
+                        color=destination_color(name))
+    axes.set_ylabel('packets/s')
+    axes.grid(alpha=0.3)
+    axes.legend(loc='upper left', bbox_to_anchor=(1.01, 1),
+                fontsize='small', frameon=False)
+
+
+def __render_raster(axes, edges, names, counts):
+    # Empty bins are left blank, counts span orders of magnitude
+    image = axes.pcolormesh(__datetimes(edges), np.arange(len(names) + 1),
+                            np.ma.masked_equal(counts, 0),
+                            norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)),
+                            cmap='viridis')
+    axes.set_yticks(np.arange(len(names)) + 0.5, names, fontsize='small')
+    axes.invert_yaxis()
+    axes.figure.colorbar(image, ax=axes, label='packets per bin')
+
+
+__renderers = {
+    'lines': __render_lines,
+    'raster': __render_raster
+}
+
+
+def render(figure, packet_bins, style='lines', bins=500, top=20,
+           title=None):
+    '''Draws binned packets into matplotlib figure'''
+    edges, names, counts = packet_bins.histogram(bins, top)
+    axes = figure.add_subplot()
+    if names:
+        __renderers[style](axes, edges, names, counts)
+    axes.set_title(title or f'{len(packet_bins)} packets, '
+                   f'{len(packet_bins.destinations)} destinations')
+    figure.autofmt_xdate()
+    return figure
+
+
+def plot_points(points, output_path=None, style='lines', bins=500, top=20,
+                title=None, size=(12, 6), dpi=100):
+    '''Plots (timestamp, destination) points from any source. Plot is
+    saved to output_path (format by extension, e.g. .png, .svg) or shown
+    in window when output_path is not given'''
+    packet_bins = PacketBins().extend(points)
+    logger.log_debug(f'Plotting {len(packet_bins)} packets')
 
-    index = 0
-    for group in groups.keys():
-        group_items = groups[group]
-        if not group_items:
-            continue
+    if output_path is None:
+        import matplotlib.pyplot as plt
+        render(plt.figure(figsize=size, dpi=dpi), packet_bins, style, bins,
+               top, title)
+        plt.show()
+        return
 
-        x_axis = [packet['timestamp'].timestamp() for packet in group_items]
-        y_axis = [index] * len(group_items)
+    figure = Figure(figsize=size, dpi=dpi, layout='constrained')
+    render(figure, packet_bins, style, bins, top, title)
+    figure.savefig(output_path)
+    logger.log_info(f'Plot saved to "{output_path}"')
 
-        plt.plot(x_axis, y_axis, f"{random.choice(colors)}.")
-        if not on_same_axis:
-            index += 1
 
-    plt.grid()
-    plt.show()
+def plot_sample_packets(packets, output_path=None, **options):
+    '''Plots Packet records (see plot_points)'''
+    plot_points(packet_points(packets), output_path, **options)
@@ -0,0 +1,129 @@
+'''Triage reports over indexed packets.
+
+Reports are computed by Elasticsearch with composite aggregations paged by
+after_key (see MetanetElastic.composite_buckets), so rows are streamed
+page by page and raw documents never leave the cluster. Top N rows are
+selected with bounded heap, memory does not grow with number of buckets.
+'''
+import json
+import heapq
+import click
+from datetime import datetime, timezone
+
+reports = ['flds', 'sources', 'timeline']
+
+# Column name and width of table output, per report
+__columns = {
+    'flds': [('fld', 40), ('packets', 12), ('sources', 9),
+             ('ads_ratio', 10), ('asset_ratio', 12)],
+    'sources': [('source', 40), ('packets', 12), ('flds', 9),
+                ('ads_ratio', 10), ('asset_ratio', 12)],
+    'timeline': [('time', 20), ('packets', 12), ('sources', 9),
+                 ('ads_ratio', 10), ('asset_ratio', 12)]
+}
+
+
+def __ratio_aggs():
+    '''Per bucket counts of packets to ad and asset hosts'''
+    return {
+        'ads': {'filter': {'term': {'resource.type': 'ads'}}},
+        'asset': {'filter': {'term': {'resource.type': 'asset'}}}
+    }
+
+
+def __ratios(bucket):
+    packets = bucket['doc_count'] or 1
+    return {'ads_ratio': bucket['ads']['doc_count'] / packets,
+            'asset_ratio': bucket['asset']['doc_count'] / packets}
+
+
+def __time_query(from_time, to_time):
+    if from_time is None and to_time is None:
+        return None
+    time_range = {'format': 'epoch_second'}
+    if from_time is not None:
+        time_range['gte'] = int(from_time)
+    if to_time is not None:
+        time_range['lte'] = int(to_time)
+    return {'range': {'datetime.timestamp': time_range}}
+
+
+def __fld_rows(es, query, page_size, interval):
+    aggs = dict(__ratio_aggs(),
+                sources={'cardinality': {'field': 'source.ip'}})
+    for bucket in es.composite_buckets(
+            [{'fld': {'terms': {'field': 'destination.fld',
+                                'missing_bucket': True}}}],
+            aggs, query, page_size):
+        yield dict(fld=bucket['key']['fld'], packets=bucket['doc_count'],
+                   sources=bucket['sources']['value'], **__ratios(bucket))
+
+
+def __source_rows(es, query, page_size, interval):
+    aggs = dict(__ratio_aggs(),
+                flds={'cardinality': {'field': 'destination.fld'}})
+    for bucket in es.composite_buckets(
+            [{'source': {'terms': {'field': 'source.ip'}}}],
+            aggs, query, page_size):
+        yield dict(source=bucket['key']['source'],
+                   packets=bucket['doc_count'],
+                   flds=bucket['flds']['value'], **__ratios(bucket))
+
+
+def __timeline_rows(es, query, page_size, interval):
+    aggs = dict(__ratio_aggs(),
+                sources={'cardinality': {'field': 'source.ip'}})
+    for bucket in es.composite_buckets(
+            [{'time': {'date_histogram': {'field': 'datetime.timestamp',
+                                          'fixed_interval': interval}}}],
+            aggs, query, page_size):
+        time = datetime.fromtimestamp(bucket['key']['time'] / 1000,
+                                      tz=timezone.utc)
+        yield dict(time=f'{time:%Y-%m-%dT%H:%M:%S}',
+                   packets=bucket['doc_count'],
+                   sources=bucket['sources']['value'], **__ratios(bucket))
+
+
+__row_generators = {
+    'flds': __fld_rows,
+    'sources': __source_rows,
+    'timeline': __timeline_rows
+}
+
+
+def report_rows(es, report, from_time=None, to_time=None, top=None,
+                interval='1h', page_size=1000):
+    '''Yields report rows (dicts) in key order, or top rows by number of
+    packets in descending order'''
+    rows = __row_generators[report](es, __time_query(from_time, to_time),
+                                    page_size, interval)
+    if top is None:
+        return rows
+    return iter(heapq.nlargest(top, rows, key=lambda row: row['packets']))
+
+
+def __format_value(value, width):
+    if value is None:
+        return f'{"-":<{width}}'
+    if isinstance(value, str):
+        return f'{value:<{width}}'
+    if isinstance(value, float):
+        return f'{value:>{width}.3f}'
+    return f'{value:>{width}}'
+
+
+def echo_rows(report, rows, output_format='table'):
+    '''Prints rows as they arrive, as table or JSON lines'''
+    if output_format == 'json':
+        for row in rows:
+            click.echo(json.dumps(row))
+        return
+
+    columns = __columns[report]
+    # Key column is text, others are numbers aligned to the right
+    click.echo(' '.join(f'{name:<{width}}' if index == 0
+                        else f'{name:>{width}}'
+                        for index, (name, width) in enumerate(columns)))
+    for row in rows:
+        click.echo(' '.join(__format_value(row[name], width)
+                            for name, width in columns))
@@ -11,4 +11,7 @@ echo '=> Build ads...'
 echo '=> Combining...'
 cat */_all.txt | rev | sort | uniq | rev > _all.txt
 
+echo '=> Compiling index...'
+python3 ../.. lists compile
+
 echo '=> DONE'
\ No newline at end of file
@@ -0,0 +1,130 @@
+import uuid
+import collections
+import simple_logger as logger
+
+
+class RollupAggregator:
+    '''Pre-aggregates packets into per-interval rollup documents: packet
+    count and number of distinct sources per destination fld and resource
+    type. Dashboards aggregating rollups read orders of magnitude fewer
+    documents than raw packets.
+
+    Buckets of capture are closed once its packets newer than bucket end +
+    lateness are observed, or all at once when packets of another capture
+    follow (captures are read one after another), so memory is bounded by
+    number of open buckets. Packets of already closed buckets are dropped
+    (counted in late_packets), so every rollup document is written once
+    with complete counts.
+
+    Rollup document IDs are derived from capture identity, so rollups of
+    same capture are overwritten when it is analyzed again. Packets without
+    capture (live, generated) get identity of aggregator (run).
+    '''
+
+    # Closed captures whose bounds are remembered to drop their late packets
+    max_captures = 1000
+
+    def __init__(self, interval=60, lateness=120):
+        self.interval = interval
+        self.lateness = lateness
+        self.run_id = uuid.uuid4().hex[:20]
+        self.late_packets = 0
+        self.__buckets = collections.defaultdict(
+            lambda: collections.defaultdict(lambda: [0, set()]))
+        # capture -> [watermark, start of first open bucket]
+        self.__captures = collections.OrderedDict()
+        self.__current = None
+
+    def observe(self, packet):
+        bucket = int(packet.timestamp // self.interval) * self.interval
+        bounds = self.__captures.get(packet.capture)
+        if bounds is None:
+            bounds = self.__captures[packet.capture] = [None, None]
+        elif bounds[1] is not None and bucket < bounds[1]:
+            self.late_packets += 1
+            return
+        self.__current = packet.capture
+        counters = self.__buckets[(bucket, packet.capture)][
+            (packet.dst.fld, packet.resource_type)]
+        counters[0] += 1
+        counters[1].add(packet.src_ip)
+        if bounds[0] is None or packet.timestamp > bounds[0]:
+            bounds[0] = packet.timestamp
+
+    def __documents(self, key):
+        bucket, capture = key
+        for (fld, resource_type), (packets, sources) \
+                in self.__buckets.pop(key).items():
+            document = {
+                'timestamp': bucket,
+                'interval': self.interval,
+                'destination': {'fld': fld},
+                'resource': {'type': resource_type},
+                'packets': packets,
+                'sources': len(sources)
+            }
+            document_id = f'{capture or self.run_id}-{bucket}-' \
+                          f'{fld}-{resource_type}'
+            yield document_id, document
+
+    def closed(self):
+        '''Returns (document ID, document) of buckets that will not receive
+        more packets'''
+        for capture, bounds in self.__captures.items():
+            if bounds[0] is None:
+                continue
+            if capture == self.__current:
+                limit = bounds[0] - self.lateness - self.interval
+            else:
+                limit = bounds[0] + self.interval
+            if bounds[1] is None or limit > bounds[1]:
+                bounds[1] = limit
+
+        documents = []
+        for key in [key for key in self.__buckets
+                    if key[0] < self.__captures[key[1]][1]]:
+            documents.extend(self.__documents(key))
+
+        while len(self.__captures) > self.max_captures:
+            capture = next(iter(self.__captures))
+            if capture == self.__current:
+                break
+            del self.__captures[capture]
+        return documents
+
+    def flush(self):
+        '''Returns (document ID, document) of all buckets'''
+        documents = []
+        for key in list(self.__buckets):
+            documents.extend(self.__documents(key))
+        logger.log_debug(f'Flushed {len(documents)} rollup documents')
+        return documents
+
+    def state(self):
+        '''Returns open buckets as JSON serializable state, so interrupted
+        run can continue them (see restore)'''
+        return {
+            'run_id': self.run_id,
+            'current': self.__current,
+            'captures': [[capture, *bounds]
+                         for capture, bounds in self.__captures.items()],
+            'buckets': [[bucket, capture, fld, resource_type,
+                         packets, sorted(sources)]
+                        for (bucket, capture), counters
+                        in self.__buckets.items()
+                        for (fld, resource_type), (packets, sources)
+                        in counters.items()]
+        }
+
+    def restore(self, state):
+        '''Replaces open buckets with state returned by state()'''
+        self.run_id = state['run_id']
+        self.__current = state['current']
+        self.__captures.clear()
+        for capture, watermark, closed_before in state['captures']:
+            self.__captures[capture] = [watermark, closed_before]
+        self.__buckets.clear()
+        for bucket, capture, fld, resource_type, packets, sources \
+                in state['buckets']:
+            self.__buckets[(bucket, capture)][(fld, resource_type)] = \
+                [packets, set(sources)]
@@ -1,28 +1,77 @@
+import json
 import click
 from datetime import datetime
 
+# Messages below level are dropped before they are formatted. Message
+# arguments are %-formatted only when message is logged, so hot paths should
+# pass them separately: log_debug('Lookup failed: %s', hostname)
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+formats = ['text', 'json']
+
 verbose = False
+level = INFO
+log_format = 'text'
+
+__level_tags = {DEBUG: 'DBG', INFO: 'INF', WARNING: 'WRN', ERROR: 'ERR'}
+__level_names = {value: name for name, value in levels.items()}
+__level_styles = {DEBUG: {'dim': True}, INFO: {},
+                  WARNING: {'fg': 'yellow'}, ERROR: {'fg': 'red'}}
+
+
+def configure(level_name='info', output_format='text', verbose_logging=False):
+    '''Sets minimal level and output format (text lines or JSON lines).
+    Verbose logging enables debug messages regardless of level'''
+    global verbose, level, log_format
+    verbose = verbose_logging
+    level = DEBUG if verbose_logging else levels[level_name]
+    log_format = output_format
+
+
+def is_enabled(message_level):
+    '''True if messages of level are logged, for guarding expensive
+    message arguments'''
+    return message_level >= level or (verbose and message_level == DEBUG)
+
+
+def __emit(message_level, message, args, fields):
+    if args:
+        message = message % args
+    now = datetime.now().isoformat()
+    if log_format == 'json':
+        click.echo(json.dumps({'time': now,
+                               'level': __level_names[message_level],
+                               'message': str(message), **fields},
+                              default=str))
+        return
+    if fields:
+        message = f'{message} ' + ' '.join(
+            f'{name}={value}' for name, value in fields.items())
+    click.secho(f'[{now}][{__level_tags[message_level]}] {message}',
+                **__level_styles[message_level])
 
 
-def log_info(message):
-    click.secho(f'[{datetime.now().isoformat()}][INF] {message}')
+def log_info(message, *args, **fields):
+    if level <= INFO:
+        __emit(INFO, message, args, fields)
 
 
-def log_warning(message):
-    click.secho(f'[{datetime.now().isoformat()}][WRN] {message}',
-                fg='yellow')
+def log_warning(message, *args, **fields):
+    if level <= WARNING:
+        __emit(WARNING, message, args, fields)
 
 
-def log_error(message):
-    click.secho(f'[{datetime.now().isoformat()}][ERR] {message}',
-                fg='red')
+def log_error(message, *args, **fields):
+    __emit(ERROR, message, args, fields)
 
 
-def log_debug(message):
-    if verbose:
-        click.secho(f'[{datetime.now().isoformat()}][DBG] {message}',
-                    dim=True)
+def log_debug(message, *args, **fields):
+    if verbose or level <= DEBUG:
+        __emit(DEBUG, message, args, fields)
 
 
-def log(message):
-    log_info(message)
+def log(message, *args, **fields):
+    log_info(message, *args, **fields)
@@ -0,0 +1,309 @@
+'''Offline output sinks for analyzed packets.
+
+Sinks stream packets into files instead of Elasticsearch, so captures can
+be analyzed without a cluster (e.g. on air-gapped workstation) and loaded
+later. Files ending with .gz are gzip compressed.
+
+- ndjson: one document per line, same layout as indexed documents
+- bulk: ready-to-POST _bulk request bodies including rollups, split into
+  parts of at most max_bytes
+- parquet/arrow: flat columnar table written in row groups (needs pyarrow)
+
+Packets can be read back from any format (see read_destinations), e.g. for
+plotting.
+'''
+import os
+import glob
+import gzip
+import json
+import time
+import click
+import simple_logger as logger
+import elastic
+import rollup
+
+formats = ['ndjson', 'bulk', 'parquet', 'arrow']
+
+
+def format_for(path):
+    '''Returns output format implied by file name'''
+    name = os.path.basename(path).lower()
+    if name.endswith('.parquet'):
+        return 'parquet'
+    if name.endswith(('.arrow', '.feather')):
+        return 'arrow'
+    if '.bulk' in name:
+        return 'bulk'
+    return 'ndjson'
+
+
+def part_path(path, part):
+    '''Returns path of numbered part, part number is inserted before
+    extensions: out.bulk.gz -> out-00000.bulk.gz'''
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition('.')
+    return os.path.join(directory, f'{stem}-{part:05d}{dot}{extensions}')
+
+
+def part_paths(path):
+    '''Returns existing numbered parts of path, in order'''
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition('.')
+    return sorted(glob.glob(os.path.join(
+        glob.escape(directory),
+        f'{glob.escape(stem)}-{"[0-9]" * 5}{dot}{glob.escape(extensions)}')))
+
+
+def _open_output(path):
+    if path.endswith('.gz'):
+        # Lower level than default 9, compression would be slowest stage
+        return gzip.open(path, 'wb', compresslevel=6)
+    return open(path, 'wb')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+        return pyarrow
+    except ImportError as ex:
+        raise ImportError('Parquet and Arrow files require pyarrow, '
+                          'install it with "pip install pyarrow"') from ex
+
+
+class _Sink:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NdjsonSink(_Sink):
+    '''Writes packet documents, one JSON object per line'''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.__file = _open_output(path)
+
+    def write(self, packet):
+        self.__file.write(
+            f'{json.dumps(elastic.convert_to_document(packet))}\n'.encode())
+        self.count += 1
+
+    def close(self):
+        self.__file.close()
+
+
+class BulkSink(_Sink):
+    '''Writes _bulk request bodies (action and document lines) of packets
+    and their rollups. Output is split into part files of at most max_bytes
+    (uncompressed), each of them posted as single request'''
+
+    rollup_check_interval = 10000
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.parts = []
+        self.rollups = rollup.RollupAggregator()
+        self.__file = None
+        self.__size = 0
+
+    def __next_part(self):
+        if self.__file is not None:
+            self.__file.close()
+        else:
+            # Parts of previous (larger) run would be loaded with ours
+            for stale_path in part_paths(self.path):
+                logger.log_debug(f'Removing stale part "{stale_path}"')
+                os.remove(stale_path)
+        self.parts.append(part_path(self.path, len(self.parts)))
+        self.__file = _open_output(self.parts[-1])
+        self.__size = 0
+
+    def __write_action(self, action):
+        metadata = {'_index': action['_index']}
+        if '_id' in action:
+            metadata['_id'] = action['_id']
+        data = (f'{json.dumps({"index": metadata})}\n'
+                f'{json.dumps(action["_source"])}\n').encode()
+        if self.__file is None \
+                or self.__size and self.__size + len(data) > self.max_bytes:
+            self.__next_part()
+        self.__file.write(data)
+        self.__size += len(data)
+
+    def __write_rollups(self, rollups):
+        for rollup_id, document in rollups:
+            self.__write_action(elastic.rollup_action(rollup_id, document))
+
+    def write(self, packet):
+        self.rollups.observe(packet)
+        self.__write_action(elastic.packet_action(packet))
+        self.count += 1
+        if self.count % self.rollup_check_interval == 0:
+            self.__write_rollups(self.rollups.closed())
+
+    def close(self):
+        self.__write_rollups(self.rollups.flush())
+        if self.__file is not None:
+            self.__file.close()
+
+
+class ColumnarSink(_Sink):
+    '''Writes packets as flat table, row_group_size rows at a time, into
+    Parquet (zstd compressed, dictionary encoded) or Arrow IPC file'''
+
+    def __init__(self, path, file_format='parquet', row_group_size=65536):
+        pyarrow = _import_pyarrow()
+        self.path = path
+        self.row_group_size = row_group_size
+        self.count = 0
+        self.__pyarrow = pyarrow
+
+        endpoint = [('ip', pyarrow.string()), ('port', pyarrow.int32()),
+                    ('hostname', pyarrow.string()),
+                    ('domain', pyarrow.string()),
+                    ('subdomain', pyarrow.string()),
+                    ('fld', pyarrow.string())]
+        self.__schema = pyarrow.schema(
+            [('timestamp', pyarrow.timestamp('us', tz='UTC')),
+             ('frame', pyarrow.int64()),
+             ('tcp_stream', pyarrow.int64()),
+             ('capture', pyarrow.string())]
+            + [(f'src_{name}', kind) for name, kind in endpoint]
+            + [(f'dst_{name}', kind) for name, kind in endpoint]
+            + [('resource_type', pyarrow.string())])
+        self.__rows = []
+
+        if file_format == 'parquet':
+            self.__writer = pyarrow.parquet.ParquetWriter(
+                path, self.__schema, compression='zstd')
+            self.__write_batch = lambda batch: self.__writer.write_table(
+                pyarrow.Table.from_batches([batch]))
+        else:
+            self.__writer = pyarrow.ipc.new_file(path, self.__schema)
+            self.__write_batch = self.__writer.write_batch
+
+    def write(self, packet):
+        src, dst = packet.src, packet.dst
+        self.__rows.append((
+            round(packet.timestamp * 1000000), packet.frame,
+            packet.tcp_stream, packet.capture,
+            packet.src_address, packet.src_port, src.hostname or None,
+            src.domain, src.subdomain, src.fld,
+            packet.dst_address, packet.dst_port, dst.hostname or None,
+            dst.domain, dst.subdomain, dst.fld,
+            packet.resource_type))
+        self.count += 1
+        if len(self.__rows) >= self.row_group_size:
+            self.__flush()
+
+    def __flush(self):
+        if not self.__rows:
+            return
+        columns = zip(*self.__rows)
+        self.__write_batch(self.__pyarrow.record_batch(
+            [self.__pyarrow.array(values, field.type)
+             for values, field in zip(columns, self.__schema)],
+            schema=self.__schema))
+        self.__rows = []
+
+    def close(self):
+        self.__flush()
+        self.__writer.close()
+
+
+def open_sink(path, output_format=None, max_bytes=10 * 1024 * 1024,
+              row_group_size=65536):
+    '''Creates sink writing into path, format is guessed from file name if
+    not given. Raises ImportError if format needs missing pyarrow'''
+    output_format = output_format or format_for(path)
+    if output_format == 'bulk':
+        return BulkSink(path, max_bytes)
+    if output_format in ('parquet', 'arrow'):
+        return ColumnarSink(path, output_format, row_group_size)
+    return NdjsonSink(path)
+
+
+def write_packets(packets, sink):
+    '''Streams packets from any iterable into sink and closes it.
+    Returns number of written packets'''
+    started = time.monotonic()
+    with sink, click.progressbar(packets, label='Writing') as packets_bar:
+        for packet in packets_bar:
+            sink.write(packet)
+    elapsed = max(time.monotonic() - started, 1e-9)
+    logger.log_info(f'Wrote {sink.count} packets to "{sink.path}" '
+                    f'({sink.count / elapsed:.0f} packets/s)')
+    return sink.count
+
+
+def _open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def __document_destination(document):
+    destination = document['destination']
+    return (document['datetime']['timestamp'],
+            destination.get('hostname') or destination['ip'])
+
+
+def __read_ndjson(paths):
+    for path in paths:
+        with _open_input(path) as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield __document_destination(json.loads(line))
+
+
+def __read_bulk(paths):
+    for path in paths:
+        with _open_input(path) as input_file:
+            for action_line in input_file:
+                document = json.loads(next(input_file))
+                # Rollups are interleaved with packet documents
+                action = json.loads(action_line)['index']
+                if action['_index'] != elastic.rollup_index_name:
+                    yield __document_destination(document)
+
+
+def __read_columnar(path, file_format):
+    pyarrow = _import_pyarrow()
+    columns = ['timestamp', 'dst_ip', 'dst_hostname']
+    if file_format == 'parquet':
+        batches = pyarrow.parquet.ParquetFile(path).iter_batches(
+            columns=columns)
+    else:
+        reader = pyarrow.ipc.open_file(path)
+        batches = (reader.get_batch(index).select(columns)
+                   for index in range(reader.num_record_batches))
+    for batch in batches:
+        rows = batch.to_pydict()
+        for timestamp, address, hostname in zip(
+                rows['timestamp'], rows['dst_ip'], rows['dst_hostname']):
+            yield timestamp.timestamp(), hostname or address
+
+
+def read_destinations(path, input_format=None):
+    '''Yields (timestamp, destination) of packets written into path by
+    sink. Destination is hostname or address when hostname is unknown.
+    Bulk output is read from all of its parts'''
+    input_format = input_format or format_for(path)
+    if input_format in ('parquet', 'arrow'):
+        return __read_columnar(path, input_format)
+
+    paths = [path]
+    if not os.path.exists(path):
+        paths = part_paths(path)
+        if not paths:
+            raise FileNotFoundError(f'"{path}" does not exist')
+    if input_format == 'bulk':
+        return __read_bulk(paths)
+    return __read_ndjson(paths)
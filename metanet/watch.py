@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import fnmatch
+import simple_logger as logger
+import elastic
+import pcap
+
+
+class CaptureCheckpoint(elastic.IndexCheckpoint):
+    '''Progress of capture files in directory.
+
+    Each file (by name) records its inode, size and frame of last packet
+    acknowledged by ES, and is complete once all packets read from it were
+    acknowledged. File that grew since is read again from that frame, file
+    with different inode (replaced) is read from start. Entries of files
+    that no longer exist are dropped.
+
+    When packets of file fail transiently (after all retries), only that
+    file stalls: it stays incomplete at its last acknowledged frame and is
+    re-queued to be read again from there (see requeue). Packets of other
+    files keep advancing their entries.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path, None, 'watch')
+        self.files = dict()
+        self.__names = dict()
+        self.__last_frames = dict()
+        # capture -> first frame of its failed chunk, acknowledgements of
+        # capture are ignored until the file is read again up to it
+        self.__stalls = dict()
+        self.__requeued = []
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logger.log_debug(f'No checkpoint found at "{self.path}"')
+            return
+        with open(self.path, 'r') as checkpoint_file:
+            data = json.load(checkpoint_file)
+        if 'files' not in data:
+            logger.log_warning(f'Checkpoint "{self.path}" has unsupported '
+                               f'format, ignoring')
+            return
+        self.files = data['files']
+        self.rollup_state = data.get('rollups')
+        logger.log_debug(f'Loaded checkpoint: {self}')
+
+    def data(self):
+        return {'files': self.files, 'rollups': self.rollups_data()}
+
+    def finish(self):
+        '''Watch checkpoint is kept for next run'''
+        self.save()
+
+    def entry(self, name, inode):
+        '''Returns entry of file or None if file is not known (or was
+        replaced)'''
+        entry = self.files.get(name)
+        if entry is None or entry['inode'] != inode:
+            return None
+        return entry
+
+    def prune(self, names):
+        '''Drops entries of files not in names'''
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+        captures = {entry['capture'] for entry in self.files.values()}
+        for capture in list(self.__stalls):
+            if capture not in captures:
+                del self.__stalls[capture]
+
+    def begin(self, name, inode, size, capture):
+        '''Starts reading file, returns frame to continue after'''
+        entry = self.entry(name, inode)
+        if entry is None:
+            entry = {'inode': inode, 'frame': 0, 'capture': capture}
+            self.files[name] = entry
+        entry['size'] = size
+        entry['complete'] = False
+        self.__names[entry['capture']] = name
+        return entry['frame']
+
+    def end(self, name, last_frame):
+        '''Marks file read up to last_frame. File is complete once packet
+        with that frame is acknowledged'''
+        entry = self.files[name]
+        if entry['frame'] >= last_frame:
+            entry['complete'] = True
+        else:
+            self.__last_frames[name] = last_frame
+
+    def acknowledge(self, packets, retry_needed=False):
+        if retry_needed:
+            self.__stall(packets)
+            return
+        for packet in packets:
+            stall_frame = self.__stalls.get(packet.capture)
+            if stall_frame is not None:
+                if packet.frame > stall_frame:
+                    # Indexed by read that failed, file is read again
+                    continue
+                del self.__stalls[packet.capture]
+            name = self.__names.get(packet.capture)
+            entry = self.files.get(name)
+            if entry is None or entry['capture'] != packet.capture:
+                continue
+            entry['frame'] = packet.frame
+            if packet.frame >= self.__last_frames.get(name, float('inf')):
+                entry['complete'] = True
+                del self.__last_frames[name]
+
+    def __stall(self, packets):
+        '''Stalls files of packets of chunk that needs retry'''
+        first_frames = dict()
+        for packet in packets:
+            first_frames.setdefault(packet.capture, packet.frame)
+        for capture, frame in first_frames.items():
+            stall_frame = self.__stalls.get(capture)
+            if stall_frame is not None and frame > stall_frame:
+                # Chunk of read that already failed
+                continue
+            name = self.__names.get(capture)
+            entry = self.files.get(name)
+            if entry is None or entry['capture'] != capture:
+                continue
+            self.__stalls[capture] = frame
+            entry['complete'] = False
+            self.__requeued.append(name)
+            logger.log_warning(f'Packets of "{name}" failed to index, '
+                               f'reading it again from frame '
+                               f'{entry["frame"] + 1}')
+
+    def rolls_up(self, packet):
+        return packet.capture not in self.__stalls
+
+    def requeue(self):
+        '''Returns names of stalled files to be read again from their last
+        acknowledged frame'''
+        names, self.__requeued = self.__requeued, []
+        return names
+
+    def __str__(self):
+        complete = sum(entry['complete'] for entry in self.files.values())
+        return f'files={len(self.files)} complete={complete}'
+
+
+def __list_captures(directory, pattern):
+    '''Returns [(stat, name, path)] of capture files ordered by mtime'''
+    captures = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+            captures.append((entry.stat(), entry.name, entry.path))
+    captures.sort(key=lambda capture: (capture[0].st_mtime, capture[1]))
+    return captures
+
+
+def __completed_captures(directory, pattern, read, settle_time):
+    '''Returns captures that have unread data and are completed. Capture
+    is completed when newer capture exists (writer rotated to next file) or
+    it was not modified for settle_time seconds. read maps name to
+    (inode, size) read so far'''
+    captures = __list_captures(directory, pattern)
+    completed = []
+    for index, (stat, name, path) in enumerate(captures):
+        if read.get(name) == (stat.st_ino, stat.st_size):
+            continue
+        is_newest = index == len(captures) - 1
+        if is_newest and time.time() - stat.st_mtime < settle_time:
+            continue
+        completed.append((stat, name, path))
+    return completed, {name for _, name, _ in captures}
+
+
+def watch_packets(directory, checkpoint, pattern='*.pcap*', backend='tshark',
+                  cache=None, hosts=None, poll_interval=5, settle_time=30,
+                  once=False):
+    '''Yields analyzed packets from capture files in directory as they are
+    completed. Checkpoint is advanced as packets are acknowledged by
+    indexer, so only packets that were not indexed before are yielded.
+    Hostnames of all captures are interned in hosts table. Watches until
+    interrupted unless once is set'''
+    logger.log_debug(f'Watching "{directory}" for "{pattern}" captures')
+
+    # (inode, size) and last frame of files read in this run, acknowledged
+    # progress in checkpoint may still be behind
+    read = {name: (entry['inode'], entry['size'])
+            for name, entry in checkpoint.files.items()
+            if entry['complete']}
+    read_frames = dict()
+    while True:
+        for name in checkpoint.requeue():
+            read.pop(name, None)
+            read_frames.pop(name, None)
+        completed, names = __completed_captures(directory, pattern, read,
+                                                settle_time)
+        checkpoint.prune(names)
+        for stat, name, path in completed:
+            entry = checkpoint.entry(name, stat.st_ino)
+            capture = entry['capture'] if entry is not None \
+                else pcap.capture_identity(path)
+            start_frame = checkpoint.begin(name, stat.st_ino, stat.st_size,
+                                           capture)
+            if read.get(name, (None,))[0] == stat.st_ino:
+                start_frame = max(start_frame, read_frames.get(name, 0))
+            logger.log_info(f'Processing "{name}" '
+                            f'from frame {start_frame + 1}')
+
+            packets = pcap.extract_packets(path, backend=backend,
+                                           hosts=hosts)
+            packets = (packet for packet in packets
+                       if packet.frame > start_frame)
+            packets = pcap.tag_capture(packets, capture)
+            last_frame = start_frame
+            for packet in pcap.analize_packets(packets, cache):
+                last_frame = packet.frame
+                yield packet
+
+            checkpoint.end(name, last_frame)
+            read[name] = (stat.st_ino, stat.st_size)
+            read_frames[name] = last_frame
+            if cache is not None:
+                cache.save()
+
+        if once:
+            break
+        time.sleep(poll_interval)
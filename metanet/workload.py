@@ -0,0 +1,159 @@
+'''Traffic models for sample generation resembling real browsing.
+
+BatchModel (see generator) contacts handful of domains uniformly.
+PageLoadModel draws page loads with diurnal rate from catalog of thousands
+of hosts with Zipf distributed popularity, each page load fanning out to
+asset and ad hosts, so hostname cardinality and ads/assets mix of
+generated samples and captures resemble real traffic.
+'''
+import os
+import ipaddress
+import numpy as np
+import simple_logger as logger
+import generator
+from classifier import DomainClassifier
+
+models = ['batch', 'pages']
+
+_lists_path = os.path.abspath(os.path.join(
+    os.path.abspath(__file__), '../resources/domain-lists'))
+
+# Synthetic host addresses are assigned sequentially from this network
+catalog_network = ipaddress.IPv4Network('23.0.0.0/8')
+
+
+def _read_list(path):
+    with open(path) as list_file:
+        return [line.strip() for line in list_file
+                if line.strip() and not line.startswith('#')]
+
+
+def zipf_cdf(count, exponent):
+    '''Cumulative distribution of Zipf popularity over count ranks'''
+    weights = np.arange(1, count + 1, dtype=np.float64) ** -exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def _draw_ranks(rng, cdf, count):
+    '''Draws count ranks (0 is most popular) from cumulative distribution'''
+    return np.minimum(np.searchsorted(cdf, rng.random(count), side='right'),
+                      len(cdf) - 1)
+
+
+class Catalog:
+    '''Hosts contacted by page loads: sites, asset hosts (subdomains of
+    assets list domains) and ad hosts (sampled from ads list), so
+    enrichment classifies them as in real traffic. Hosts of each kind are
+    ordered by popularity rank. Catalog is same for same sizes and seed.
+
+    hosts is list of (hostname, address), kinds are (start, end) ranges
+    of hosts'''
+
+    def __init__(self, sites=1000, asset_hosts=1000, ad_hosts=1000, seed=0):
+        rng = np.random.default_rng(seed)
+        site_names = [hostname for hostname, _ in generator.domains][:sites]
+        site_names += [f'www.site{index}.com'
+                       for index in range(len(site_names), sites)]
+
+        asset_entries = _read_list(os.path.join(_lists_path, 'assets',
+                                                '_all.txt'))
+        asset_domains = [entry for entry in asset_entries if '.' in entry]
+        # Ad hosts also matching assets list are classified as assets
+        assets_classifier = DomainClassifier()
+        assets_classifier.add('asset', asset_entries)
+        asset_names = [
+            f'cdn{index}.{asset_domains[index % len(asset_domains)]}'
+            for index in range(asset_hosts)]
+
+        ad_domains = [domain for domain in _read_list(
+            os.path.join(_lists_path, 'ads', '_all.txt'))
+            if assets_classifier.match_rank(domain) is None]
+        ad_names = [ad_domains[index] for index in rng.choice(
+            len(ad_domains), min(ad_hosts, len(ad_domains)), replace=False)]
+
+        known = dict(generator.domains)
+        first_address = int(catalog_network.network_address) + 1
+        self.hosts = [
+            (hostname, known.get(hostname) or str(ipaddress.IPv4Address(
+                first_address + index)))
+            for index, hostname in enumerate(
+                site_names + asset_names + ad_names)]
+        self.sites = (0, len(site_names))
+        self.assets = (self.sites[1], self.sites[1] + len(asset_names))
+        self.ads = (self.assets[1], self.assets[1] + len(ad_names))
+        logger.log_debug(f'Catalog: {len(site_names)} sites, '
+                         f'{len(asset_names)} asset hosts, '
+                         f'{len(ad_names)} ad hosts')
+
+
+class PageLoadModel:
+    '''Page loads arrive as Poisson process with diurnal rate peaking at
+    peak_hour (UTC) and lowest 12 hours later, rate varies by
+    diurnal_amplitude (0 - constant, 1 - no traffic at lowest). Each page
+    load contacts site and, within burst_seconds, Poisson distributed
+    number of asset and ad hosts. Sites and hosts are picked by Zipf
+    popularity with zipf_exponent. Mean packet rate over day is density'''
+
+    def __init__(self, density, catalog, zipf_exponent=1.0,
+                 assets_per_page=8.0, ads_per_page=3.0,
+                 diurnal_amplitude=0.5, peak_hour=20, burst_seconds=2.0):
+        self.hosts = catalog.hosts
+        self.page_rate = density / (1 + assets_per_page + ads_per_page)
+        self.assets_per_page = assets_per_page
+        self.ads_per_page = ads_per_page
+        self.diurnal_amplitude = min(max(diurnal_amplitude, 0.0), 1.0)
+        self.peak_hour = peak_hour
+        self.burst_seconds = burst_seconds
+        self.max_spill = burst_seconds
+        self.__kinds = [(start, zipf_cdf(end - start, zipf_exponent))
+                        for start, end
+                        in (catalog.sites, catalog.assets, catalog.ads)
+                        if end > start]
+
+    def rate(self, timestamps):
+        '''Page loads per second at timestamps'''
+        hours = (np.asarray(timestamps) % 86400) / 3600
+        return self.page_rate * (1 + self.diurnal_amplitude * np.cos(
+            2 * np.pi * (hours - self.peak_hour) / 24))
+
+    def __hosts(self, rng, kind, count):
+        start, cdf = self.__kinds[kind]
+        return start + _draw_ranks(rng, cdf, count)
+
+    def generate(self, rng, window_from, window_to, to_timestamp):
+        '''Returns (timestamps, host indices) of page loads starting in
+        [window_from, window_to) and their bursts'''
+        length = window_to - window_from
+        # Non-homogeneous Poisson process by thinning peak rate process
+        peak_rate = self.page_rate * (1 + self.diurnal_amplitude)
+        candidates = window_from + rng.random(
+            rng.poisson(peak_rate * length)) * length
+        pages = candidates[rng.random(len(candidates)) * peak_rate
+                           < self.rate(candidates)]
+
+        timestamps = [pages]
+        host_indices = [self.__hosts(rng, 0, len(pages))]
+        for kind, per_page in ((1, self.assets_per_page),
+                               (2, self.ads_per_page)):
+            if kind >= len(self.__kinds):
+                continue
+            counts = rng.poisson(per_page, len(pages))
+            total = int(counts.sum())
+            timestamps.append(np.repeat(pages, counts)
+                              + rng.random(total) * self.burst_seconds)
+            host_indices.append(self.__hosts(rng, kind, total))
+        return np.concatenate(timestamps), np.concatenate(host_indices)
+
+
+def create_model(name, density, interval_range=None, catalog_size=1000,
+                 zipf_exponent=1.0, assets_per_page=8.0, ads_per_page=3.0,
+                 diurnal_amplitude=0.5, peak_hour=20):
+    '''Creates traffic model by name. catalog_size is number of hosts of
+    each kind (sites, asset hosts, ad hosts) of page loads model'''
+    if name == 'pages':
+        catalog = Catalog(catalog_size, catalog_size, catalog_size)
+        return PageLoadModel(density, catalog, zipf_exponent,
+                             assets_per_page, ads_per_page,
+                             diurnal_amplitude, peak_hour)
+    return generator.BatchModel(density, interval_range)
@@ -0,0 +1,70 @@
+'''Builders of small captures with hand-made TCP conversations'''
+import struct
+import ipaddress
+import pcap_writer
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+client = '10.0.0.2'
+
+
+def tcp_frame(src, src_port, dst, dst_port, sequence, flags):
+    '''Ethernet frame of IPv4 TCP segment without payload'''
+    segment = struct.pack('>HHIIBBHHH', src_port, dst_port, sequence, 0,
+                          0x50, flags, 65535, 0, 0)
+    return pcap_writer.ethernet_frame(pcap_writer.ipv4_packet(
+        ipaddress.IPv4Address(src).packed, ipaddress.IPv4Address(dst).packed,
+        6, segment))
+
+
+def write_pcap(path, frames):
+    '''Writes (timestamp, frame) pairs as classic PCAP file'''
+    with open(path, 'wb') as capture:
+        capture.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0,
+                                  65535, 1))
+        for timestamp, frame in frames:
+            seconds = int(timestamp)
+            capture.write(struct.pack(
+                '<IIII', seconds, round((timestamp - seconds) * 1e6),
+                len(frame), len(frame)))
+            capture.write(frame)
+
+
+def conversations_capture(path):
+    '''Writes capture of conversations spanning many frames: handshakes,
+    segments of open conversations interleaved with new ones, SYN
+    retransmissions, reused client ports and hosts resolved by DNS answers
+    long before they are contacted. Returns number of frames'''
+    hosts = [(f'host{index}.example.com', f'93.184.216.{index}')
+             for index in range(1, 9)]
+    frames = [pcap_writer.dns_frame(hostname,
+                                    ipaddress.IPv4Address(address).packed)
+              for hostname, address in hosts[:6]]
+
+    open_conversations = []
+    for index in range(60):
+        _, server = hosts[index % len(hosts)]
+        # Ports repeat, so later conversations reuse 4-tuples
+        port = 40000 + index % 16
+        sequence = 1000 * index + 1
+        frames.append(tcp_frame(client, port, server, 443, sequence,
+                                TCP_SYN))
+        if index % 7 == 3:
+            # Retransmitted SYN
+            frames.append(tcp_frame(client, port, server, 443, sequence,
+                                    TCP_SYN))
+        frames.append(tcp_frame(server, 443, client, port, 5000,
+                                TCP_SYN | TCP_ACK))
+        open_conversations.append((port, server, sequence))
+        for port, server, sequence in open_conversations[-4:]:
+            frames.append(tcp_frame(client, port, server, 443,
+                                    sequence + 1, TCP_ACK))
+        if index == 30:
+            frames.extend(pcap_writer.dns_frame(
+                hostname, ipaddress.IPv4Address(address).packed)
+                for hostname, address in hosts[6:])
+
+    write_pcap(path, ((1577836800 + index * 0.5, frame)
+                      for index, frame in enumerate(frames)))
+    return len(frames)
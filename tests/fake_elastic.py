@@ -0,0 +1,123 @@
+'''In-memory stand-in for Elasticsearch client, speaking just enough of API
+used by MetanetElastic'''
+import json
+import itertools
+from elasticsearch.serializer import JSONSerializer
+
+
+class FakeTransport:
+    serializer = JSONSerializer()
+
+
+class FakeIndices:
+    def __init__(self, client):
+        self.client = client
+        self.created = []
+        self.settings = []
+
+    def exists(self, index):
+        return index in self.client.documents
+
+    def exists_alias(self, name):
+        return False
+
+    def exists_template(self, name):
+        return name in self.client.templates
+
+    def put_template(self, name, body):
+        self.client.templates[name] = json.loads(body)
+
+    def create(self, index, body=None, ignore=()):
+        if index in self.client.documents:
+            if 400 in (ignore if isinstance(ignore, tuple) else (ignore,)):
+                return {'error': {'type': 'resource_already_exists'}}
+            raise ValueError(f'Index {index} exists')
+        self.client.documents[index] = dict()
+        settings = json.loads(body).get('settings', {}) if body else {}
+        self.client.index_settings[index] = dict(settings)
+        self.created.append((index, settings))
+        return {'acknowledged': True}
+
+    def put_settings(self, body, index):
+        self.settings.append((index.split(','), json.loads(body)))
+        for name in index.split(','):
+            self.client.index_settings[name].update(json.loads(body))
+
+    def refresh(self, index=None):
+        pass
+
+    def get(self, index, ignore_unavailable=False):
+        prefix = index.rstrip('*')
+        return {name: {} for name in self.client.documents
+                if name.startswith(prefix)}
+
+    def get_mapping(self, index):
+        return {index: {'mappings': self.client.mappings.get(index, {})}}
+
+    def delete(self, index, ignore_unavailable=False):
+        if index not in self.client.documents and not ignore_unavailable:
+            raise ValueError(f'No index {index}')
+        self.client.documents.pop(index, None)
+        self.client.deleted.append(index)
+
+
+class FakeElasticsearch:
+    '''documents maps index to {_id: source}. reject(index, _id, source,
+    attempt) may return status of bulk item instead of 201, attempt counts
+    requests of the same document'''
+
+    def __init__(self, reject=None):
+        self.transport = FakeTransport()
+        self.indices = FakeIndices(self)
+        self.documents = dict()
+        self.index_settings = dict()
+        self.mappings = dict()
+        self.templates = dict()
+        self.deleted = []
+        self.requests = []
+        self.reindex_responses = []
+        self.reject = reject
+        self.__attempts = dict()
+        self.__ids = itertools.count()
+
+    def bulk(self, body):
+        self.requests.append(body)
+        lines = body.splitlines()
+        items = []
+        for action_line, source_line in zip(lines[::2], lines[1::2]):
+            metadata = json.loads(action_line)['index']
+            index = metadata['_index']
+            document_id = metadata.get('_id') or f'auto-{next(self.__ids)}'
+            source = json.loads(source_line)
+            attempt = self.__attempts.get((index, document_id), 0)
+            self.__attempts[(index, document_id)] = attempt + 1
+            status = self.reject and self.reject(index, document_id, source,
+                                                 attempt)
+            if status:
+                items.append({'index': {
+                    '_index': index, '_id': document_id, 'status': status,
+                    'error': {'type': 'rejected' if status == 429
+                              else 'mapper_parsing_exception'}}})
+                continue
+            self.documents.setdefault(index, dict())[document_id] = source
+            items.append({'index': {'_index': index, '_id': document_id,
+                                    'status': 201}})
+        return {'errors': False, 'items': items}
+
+    def count(self, index):
+        return {'count': len(self.documents.get(index, {}))}
+
+    def reindex(self, body, refresh=False, request_timeout=None):
+        '''Copies documents, or returns next of reindex_responses (None
+        copies)'''
+        response = self.reindex_responses.pop(0) \
+            if self.reindex_responses else None
+        if response is not None:
+            return response
+        request = json.loads(body)
+        source = self.documents[request['source']['index']]
+        destination = self.documents.setdefault(request['dest']['index'],
+                                                dict())
+        destination.update(source)
+        return {'created': len(source), 'updated': 0, 'failures': [],
+                'timed_out': False}
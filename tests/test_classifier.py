@@ -0,0 +1,70 @@
+import os
+import random
+import shutil
+import pcap
+from classifier import DomainClassifier, CompiledDomainClassifier
+
+
+def list_hostnames(lists, count=20000):
+    '''Returns hostnames derived from list entries: entries, their
+    subdomains, parents and lookalikes that should not match'''
+    entries = []
+    for _, path in lists:
+        with open(path, 'r') as list_file:
+            entries.extend(line.strip().lower() for line in list_file
+                           if line.strip())
+    rng = random.Random(1)
+    hostnames = []
+    for entry in rng.sample(entries, count // 4):
+        hostnames.extend([entry, f'www.{entry}',
+                          entry.split('.', 1)[-1], f'{entry}x.example'])
+    return hostnames
+
+
+def test_compiled_index_classifies_as_lists(tmp_path):
+    lists = pcap.__resource_lists
+    index_path = str(tmp_path / 'index.bin')
+    classifier = DomainClassifier.from_files(lists)
+    classifier.save(index_path, 'signature')
+
+    compiled = CompiledDomainClassifier.open(index_path, 'signature')
+
+    assert compiled is not None and len(compiled) == len(classifier)
+    hostnames = list_hostnames(lists)
+    assert [compiled.classify(hostname) for hostname in hostnames] \
+        == [classifier.classify(hostname) for hostname in hostnames]
+    assert {classifier.classify(hostname) for hostname in hostnames} \
+        == {'asset', 'ads', 'other'}
+
+
+def test_changed_list_rebuilds_index(tmp_path, monkeypatch):
+    lists = []
+    for resource_type, path in pcap.__resource_lists:
+        copy_path = str(tmp_path / f'{resource_type}.txt')
+        shutil.copyfile(path, copy_path)
+        lists.append((resource_type, copy_path))
+    monkeypatch.setattr(pcap, '__resource_lists', lists)
+    monkeypatch.setattr(pcap, '__classifier_index_path',
+                        str(tmp_path / 'index.bin'))
+
+    # Missing index is built, then used
+    assert isinstance(pcap.load_resource_classifier(), DomainClassifier)
+    assert isinstance(pcap.load_resource_classifier(),
+                      CompiledDomainClassifier)
+
+    # Touched list invalidates index
+    resource_type, path = lists[0]
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert isinstance(pcap.load_resource_classifier(), DomainClassifier)
+    assert isinstance(pcap.load_resource_classifier(),
+                      CompiledDomainClassifier)
+
+    with open(path, 'a') as list_file:
+        list_file.write('added.example\n')
+    rebuilt = pcap.load_resource_classifier()
+    assert isinstance(rebuilt, DomainClassifier)
+    assert rebuilt.classify('cdn.added.example') == resource_type
+    compiled = pcap.load_resource_classifier()
+    assert isinstance(compiled, CompiledDomainClassifier)
+    assert compiled.classify('cdn.added.example') == resource_type
@@ -0,0 +1,212 @@
+import json
+import time
+import threading
+import collections
+import pytest
+import elastic
+import metrics
+import pcap
+from cache import HostnameCache
+from captures import conversations_capture
+from fake_elastic import FakeElasticsearch
+from test_rollup import packets
+
+
+def fake_elastic(monkeypatch, reject=None, **kwargs):
+    client = FakeElasticsearch(reject)
+    monkeypatch.setattr(elastic, 'get_client', lambda hostname, port: client)
+    return elastic.MetanetElastic(initial_backoff=0, **kwargs), client
+
+
+def packet_requests(client):
+    return [request for request in client.requests
+            if elastic.packet_index_prefix in request]
+
+
+def frame_of(document_id):
+    return int(document_id.rsplit('-', 1)[1])
+
+
+def test_chunk_is_split_by_bytes(monkeypatch):
+    es, client = fake_elastic(monkeypatch, chunk_size=100,
+                              max_chunk_bytes=4096, thread_count=1)
+
+    stats = es.index_packets(packets('capture'))
+
+    assert stats.indexed == 400 and stats.failed == 0
+    requests = packet_requests(client)
+    assert len(requests) > 400 // 100
+    assert all(len(request.encode()) <= 4096 for request in requests)
+    assert sum(len(documents) for index, documents
+               in client.documents.items()
+               if index.startswith(elastic.packet_index_prefix)) == 400
+
+
+def test_only_rejected_documents_are_retried(monkeypatch):
+    def reject(index, document_id, source, attempt):
+        if not index.startswith(elastic.packet_index_prefix):
+            return None
+        frame = frame_of(document_id)
+        if frame == 7:
+            return 400
+        if frame == 13 or frame % 5 == 0 and attempt < 2:
+            return 429
+        return None
+
+    es, client = fake_elastic(monkeypatch, reject, chunk_size=50,
+                              max_retries=3)
+    metrics.drain()
+    stats = es.index_packets(packets('capture'))
+    counters = metrics.drain()
+
+    assert stats.indexed == 398 and stats.failed == 2
+    assert counters['documents_failed'] == 2
+    assert counters['bulk_rejections'] == 1
+    requested = collections.Counter(
+        frame_of(json.loads(line)['index']['_id'])
+        for request in packet_requests(client)
+        for line in request.splitlines()[::2])
+    assert requested[7] == 1
+    assert requested[13] == es.max_retries + 1
+    assert requested[10] == 3
+    assert all(count == 1 for frame, count in requested.items()
+               if frame % 5 and frame not in (7, 13))
+
+
+def test_clients_are_shared_per_host():
+    client = elastic.get_client('localhost', 9299)
+    assert elastic.get_client('localhost', 9299) is client
+    assert elastic.get_client('localhost', 9298) is not client
+
+
+def test_indexing_consumes_packets_as_chunks_are_indexed(monkeypatch):
+    es, client = fake_elastic(monkeypatch, chunk_size=10, thread_count=1)
+    released = threading.Event()
+    bulk = client.bulk
+
+    def blocked_bulk(body):
+        released.wait()
+        return bulk(body)
+
+    client.bulk = blocked_bulk
+    produced = []
+
+    def counted(packets):
+        for packet in packets:
+            produced.append(packet)
+            yield packet
+
+    indexing = threading.Thread(
+        target=es.index_packets, args=(counted(packets('capture')),))
+    indexing.start()
+    time.sleep(0.2)
+    # Chunks in flight and chunk waiting for them to be collected
+    assert len(produced) <= (2 * es.thread_count + 1) * es.chunk_size
+    released.set()
+    indexing.join()
+    assert len(produced) == 400
+
+
+def two_day_packets():
+    '''Packets of 2020-01-01 followed by packets of 2020-01-02 (UTC)'''
+    day_packets = list(packets('capture'))
+    for packet in day_packets[200:]:
+        packet.timestamp += 24 * 3600
+    return day_packets
+
+
+def test_packets_are_written_to_daily_indices_behind_alias(monkeypatch):
+    es, client = fake_elastic(monkeypatch)
+    es.configure()
+    template = client.templates[es.template_name]
+    assert template['index_patterns'] == [f'{es.index_prefix}*']
+    assert template['aliases'] == {es.index_name: {}}
+
+    es.index_packets(two_day_packets())
+
+    assert {index: len(documents)
+            for index, documents in client.documents.items()
+            if index.startswith(es.index_prefix)} \
+        == {'metanet-packets-2020.01.01': 200,
+            'metanet-packets-2020.01.02': 200}
+
+
+def test_bulk_load_restores_settings_of_created_indices(monkeypatch):
+    es, client = fake_elastic(monkeypatch)
+    client.indices.create('metanet-packets-2020.01.01')
+
+    with es.bulk_load():
+        es.index_packets(two_day_packets())
+
+    assert ('metanet-packets-2020.01.02',
+            {'index.refresh_interval': '-1',
+             'index.number_of_replicas': 0}) in client.indices.created
+    assert client.indices.settings == [
+        (['metanet-packets-2020.01.02'],
+         {'index.refresh_interval': es.refresh_interval,
+          'index.number_of_replicas': es.replicas})]
+    # Existing index is left as it was
+    assert client.index_settings['metanet-packets-2020.01.01'] == {}
+
+
+def test_document_ids_are_stable_across_runs(tmp_path, monkeypatch):
+    capture_path = tmp_path / 'conversations.pcap'
+    conversations_capture(str(capture_path))
+    copy_path = tmp_path / 'copy.pcap'
+    copy_path.write_bytes(capture_path.read_bytes())
+    es, client = fake_elastic(monkeypatch)
+
+    def index(path):
+        es.index_packets(pcap.analize_packets_from_file(
+            str(path), cache=HostnameCache(), backend='native'))
+        return {index: set(documents)
+                for index, documents in client.documents.items()}
+
+    first = index(capture_path)
+    # Analyzing capture again (or its copy) overwrites its documents
+    assert index(capture_path) == first
+    assert index(copy_path) == first
+    packet_ids = first['metanet-packets-2020.01.01']
+    assert not any(document_id.startswith('auto-')
+                   for document_id in packet_ids)
+    assert len(packet_ids) == sum(
+        1 for _ in pcap.extract_packets(str(capture_path), backend='native'))
+
+
+def legacy_client(monkeypatch):
+    es, client = fake_elastic(monkeypatch)
+    client.documents[es.index_name] = {
+        str(frame): {'datetime': {'timestamp': 1577836800 + frame}}
+        for frame in range(10)}
+    return es, client
+
+
+def test_migrate_keeps_source_when_copy_is_incomplete(monkeypatch):
+    es, client = legacy_client(monkeypatch)
+    client.reindex_responses = [{'created': 9, 'updated': 0,
+                                 'failures': [], 'timed_out': False}]
+
+    with pytest.raises(RuntimeError):
+        es.migrate()
+
+    assert len(client.documents[es.index_name]) == 10
+    assert f'{elastic.migrate_index_prefix}{es.index_name}' \
+        not in client.documents
+
+
+def test_migrate_resumes_from_kept_copy(monkeypatch):
+    es, client = legacy_client(monkeypatch)
+    temp_index = f'{elastic.migrate_index_prefix}{es.index_name}'
+    client.reindex_responses = [None, {'created': 0, 'updated': 0,
+                                       'failures': [{'cause': 'full'}],
+                                       'timed_out': False}]
+
+    with pytest.raises(RuntimeError):
+        es.migrate()
+    assert es.index_name not in client.documents
+    assert len(client.documents[temp_index]) == 10
+
+    assert es.migrate() == [es.index_name]
+    assert temp_index not in client.documents
+    # Stand-in does not run routing script, documents stay in destination
+    assert len(client.documents[f'{es.index_prefix}migrate']) == 10
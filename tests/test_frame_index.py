@@ -0,0 +1,71 @@
+import sqlite3
+import frame_index
+import pcap
+import pcap_native
+from cache import HostnameCache
+from captures import conversations_capture
+
+
+def tcp_frames(path):
+    with pcap_native.open_capture(path) as capture:
+        return [bytes(data) for _, _, _, linktype, data in capture.frames()
+                if pcap_native.decode_tcp(linktype, data,
+                                          capture.state.names)]
+
+
+def test_extracted_streams_partition_frames(tmp_path):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    conversations_capture(capture_path)
+    index_path = frame_index.build_frame_index(capture_path)
+    with sqlite3.connect(index_path) as connection:
+        stream_count, key_count = connection.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT address_a || port_a || '
+            'address_b || port_b) FROM streams').fetchone()
+    # Ports are reused, so some streams share conversation key
+    assert key_count < stream_count
+
+    extracted = []
+    for stream in range(stream_count):
+        output_path = str(tmp_path / f'stream{stream}.pcap')
+        frame_index.extract_stream(capture_path, stream, output_path)
+        extracted.extend(tcp_frames(output_path))
+
+    assert sorted(extracted) == sorted(tcp_frames(capture_path))
+
+
+def index_rows(index_path):
+    with sqlite3.connect(index_path) as connection:
+        return {table: sorted(connection.execute(f'SELECT * FROM {table}'))
+                for table in ('streams', 'ranges', 'headers')}
+
+
+def test_index_is_written_while_analyzing(tmp_path, monkeypatch):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    conversations_capture(capture_path)
+    expected = index_rows(frame_index.build_frame_index(
+        capture_path, str(tmp_path / 'separate.idx')))
+
+    reads = []
+    open_capture = pcap_native.open_capture
+    monkeypatch.setattr(pcap_native, 'open_capture',
+                        lambda path: reads.append(path) or open_capture(path))
+    builder = frame_index.FrameIndexBuilder(capture_path)
+    packets = list(pcap.analize_packets_from_file(
+        capture_path, cache=HostnameCache(), backend='native',
+        index_builder=builder))
+
+    assert packets and len(reads) == 1
+    assert index_rows(builder.index_path) == expected
+
+
+def test_index_of_interrupted_analysis_is_dropped(tmp_path):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    conversations_capture(capture_path)
+    builder = frame_index.FrameIndexBuilder(capture_path)
+
+    packets = pcap.extract_packets(capture_path, backend='native',
+                                   index_builder=builder)
+    next(packets)
+    packets.close()
+
+    assert not list(tmp_path.glob('*.idx*'))
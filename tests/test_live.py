@@ -0,0 +1,110 @@
+import time
+import itertools
+import threading
+from live import LivePipeline
+from test_rollup import packets
+
+
+class FakeIndexer:
+    '''Records flushed batch sizes, every flush waits for wait() if
+    given'''
+
+    def __init__(self, wait=None):
+        self.wait = wait
+        self.batches = []
+        self.frames = []
+        self.rollups_flushed = False
+
+    def bulk_index_packets(self, batch):
+        if self.wait is not None:
+            self.wait()
+        self.batches.append(len(batch))
+        self.frames.append([packet.frame for packet in batch])
+        return len(batch), 0
+
+    def index_rollups(self, flush=False):
+        self.rollups_flushed = self.rollups_flushed or flush
+
+
+def captured(count, captured_all):
+    yield from packets(count=count)
+    captured_all.set()
+
+
+def test_full_queue_drops_packets():
+    captured_all = threading.Event()
+    indexer = FakeIndexer(lambda: captured_all.wait(5))
+    pipeline = LivePipeline(captured(400, captured_all), indexer,
+                            queue_size=5, flush_size=5)
+
+    assert pipeline.run()
+
+    stats = pipeline.stats
+    assert stats.captured == 400
+    assert stats.dropped > 0
+    assert stats.indexed + stats.dropped == 400
+    assert sum(indexer.batches) == stats.indexed
+
+
+def test_full_queue_blocks_capture():
+    captured_all = threading.Event()
+    indexer = FakeIndexer(lambda: captured_all.wait(0.01))
+    pipeline = LivePipeline(captured(400, captured_all), indexer,
+                            queue_size=5, flush_size=5,
+                            drop_when_full=False)
+
+    assert pipeline.run()
+
+    stats = pipeline.stats
+    assert stats.dropped == 0
+    assert stats.indexed == 400
+    assert stats.blocked_seconds > 0
+
+
+def test_batches_are_flushed_by_size():
+    indexer = FakeIndexer()
+    pipeline = LivePipeline(packets(count=400), indexer, flush_size=50,
+                            flush_interval=60)
+
+    pipeline.run()
+
+    assert indexer.batches == [50] * 8
+
+
+def test_batches_are_flushed_by_interval():
+    def paused(count):
+        source = packets(count=2 * count)
+        yield from itertools.islice(source, count)
+        time.sleep(0.5)
+        yield from source
+
+    indexer = FakeIndexer()
+    pipeline = LivePipeline(paused(10), indexer, flush_size=1000,
+                            flush_interval=0.1)
+
+    pipeline.run()
+
+    # Packets captured before pause are flushed without reaching flush_size
+    assert sum(indexer.batches) == 20
+    assert not any(min(frames) <= 10 < max(frames)
+                   for frames in indexer.frames)
+
+
+def test_stop_flushes_queued_packets():
+    def endless():
+        for packet in itertools.cycle(packets(count=50)):
+            time.sleep(0.001)
+            yield packet
+
+    indexer = FakeIndexer()
+    pipeline = LivePipeline(endless(), indexer, flush_size=1000,
+                            flush_interval=60)
+    threading.Timer(0.2, pipeline.stop).start()
+
+    assert pipeline.run()
+
+    stats = pipeline.stats
+    assert stats.captured > 0 and stats.dropped == 0
+    assert stats.indexed == stats.captured
+    assert indexer.batches == [stats.captured]
+    assert indexer.rollups_flushed
@@ -0,0 +1,14 @@
+from packet import HostTable
+
+
+def test_host_table_is_bounded():
+    hosts = HostTable(capacity=4)
+    first = hosts.get('Example.com')
+    assert hosts.get('example.com') is first
+
+    for index in range(10):
+        hosts.get(f'host{index}.example.com')
+        assert len(hosts) <= 4
+
+    assert hosts.get('example.com') is not first
+    assert hosts.get('example.com').hostname == 'example.com'
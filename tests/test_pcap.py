@@ -0,0 +1,123 @@
+import shutil
+import ipaddress
+import pytest
+import pcap
+import metrics
+import pcap_native
+from cache import HostnameCache
+from packet import HostTable
+from captures import conversations_capture
+
+
+def records(packets):
+    return sorted((packet.frame, packet.timestamp, packet.tcp_stream,
+                   packet.src_address, packet.src_port, packet.src.hostname,
+                   packet.dst_address, packet.dst_port, packet.dst.hostname,
+                   packet.dst.fld, packet.resource_type)
+                  for packet in packets)
+
+
+def test_parallel_analysis_matches_sequential(tmp_path, monkeypatch):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    frame_count = conversations_capture(capture_path)
+    # Shard boundaries fall inside open conversations
+    monkeypatch.setattr(pcap, 'shard_frames', 17)
+    assert frame_count > 10 * pcap.shard_frames
+
+    metrics.drain()
+    sequential = records(pcap.analize_packets_from_file(
+        capture_path, workers=1, cache=HostnameCache(), backend='native'))
+    sequential_counters = metrics.drain()
+    parallel = records(pcap.analize_packets_from_file(
+        capture_path, workers=3, cache=HostnameCache(), backend='native'))
+    parallel_counters = metrics.drain()
+
+    assert parallel == sequential
+    # Counters of workers are added to counters of parent
+    assert parallel_counters['packets_extracted'] \
+        == sequential_counters['packets_extracted'] == len(sequential)
+    # Reused ports and retransmissions are numbered as single pass does
+    assert len({record[2] for record in sequential}) \
+        < len(sequential) - 5
+    # Hosts resolved in first shard keep hostnames in later shards
+    assert all(record[8].startswith('host') for record in sequential
+               if record[6] < '93.184.216.7')
+
+
+def tshark_lines(capture_path):
+    '''Returns tshark -Tfields output lines of all TCP frames of capture,
+    with conversation fields'''
+    lines = []
+    tracker = pcap_native.ConversationTracker()
+    with pcap_native.open_capture(capture_path) as capture:
+        names = capture.state.names
+        frames = capture.frames()
+        for frame, (_, _, timestamp, linktype, data) in enumerate(frames, 1):
+            tcp = pcap_native.decode_tcp(linktype, data, names)
+            del data
+            if tcp is None:
+                continue
+            src, src_port, dst, dst_port, sequence, flags = tcp
+            stream = tracker.stream(
+                pcap_native.conversation_key(src, src_port, dst, dst_port),
+                pcap_native.is_syn(flags), sequence)
+            src_ip = str(ipaddress.ip_address(src))
+            dst_ip = str(ipaddress.ip_address(dst))
+            lines.append('\t'.join(map(str, [
+                f'{timestamp:.6f}', frame, stream,
+                src_ip, names.get(src, src_ip), '', '', src_port,
+                dst_ip, names.get(dst, dst_ip), '', '', dst_port,
+                int(bool(flags & 0x02)), int(bool(flags & 0x10)),
+                sequence])) + '\n')
+        frames.close()
+    return lines
+
+
+def test_tshark_output_logs_conversations(tmp_path):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    conversations_capture(capture_path)
+    native_log = pcap_native.ConversationLog()
+    native = list(pcap_native.extract_packets(capture_path, native_log))
+
+    log = pcap_native.ConversationLog()
+    packets = list(pcap.__read_packets(tshark_lines(capture_path),
+                                       HostTable(), log))
+
+    assert log.events == native_log.events
+    assert log.names.items() <= native_log.names.items()
+    assert [(packet.frame, packet.tcp_stream, packet.dst.hostname)
+            for packet in packets] \
+        == [(frame, stream, dst_host)
+            for _, frame, stream, _, _, _, _, _, dst_host, _ in native]
+
+
+@pytest.mark.skipif(not (shutil.which('tshark') and shutil.which('editcap')),
+                    reason='needs tshark and editcap')
+def test_parallel_tshark_analysis_matches_sequential(tmp_path, monkeypatch):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    conversations_capture(capture_path)
+    monkeypatch.setattr(pcap, 'shard_frames', 17)
+
+    sequential = records(pcap.analize_packets_from_file(
+        capture_path, workers=1, cache=HostnameCache(), backend='tshark'))
+    parallel = records(pcap.analize_packets_from_file(
+        capture_path, workers=3, cache=HostnameCache(), backend='tshark'))
+
+    assert sequential
+    assert parallel == sequential
+
+
+def test_split_capture_keeps_frames(tmp_path):
+    capture_path = str(tmp_path / 'conversations.pcap')
+    frame_count = conversations_capture(capture_path)
+
+    shard_paths = pcap_native.split_capture(capture_path, str(tmp_path), 50)
+
+    assert len(shard_paths) == (frame_count + 49) // 50
+    shard_frames = []
+    for shard_path in shard_paths:
+        with pcap_native.open_capture(shard_path) as shard:
+            frames = shard.frames()
+            shard_frames.append(sum(1 for _ in frames))
+    assert sum(shard_frames) == frame_count
+    assert set(shard_frames[:-1]) == {50}
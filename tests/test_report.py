@@ -0,0 +1,65 @@
+import json
+import random
+import elastic
+import report
+
+
+class FakeAggregationClient:
+    '''Pages fld buckets of composite aggregation by after_key. Last page
+    has no after_key'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.searches = []
+
+    def search(self, body, index, request_timeout=None):
+        composite = json.loads(body)['aggs']['buckets']['composite']
+        self.searches.append(composite.get('after'))
+        keys = [bucket['key'] for bucket in self.buckets]
+        start = keys.index(composite['after']) + 1 \
+            if 'after' in composite else 0
+        page = {'buckets': self.buckets[start:start + composite['size']]}
+        if start + composite['size'] < len(self.buckets):
+            page['after_key'] = page['buckets'][-1]['key']
+        return {'aggregations': {'buckets': page}}
+
+
+def fld_buckets(count):
+    rng = random.Random(1)
+    return [{'key': {'fld': f'site{index:03d}.com'},
+             'doc_count': rng.randrange(1, 10000),
+             'ads': {'doc_count': 0}, 'asset': {'doc_count': 0},
+             'sources': {'value': rng.randrange(1, 100)}}
+            for index in range(count)]
+
+
+def report_client(monkeypatch, buckets):
+    client = FakeAggregationClient(buckets)
+    monkeypatch.setattr(elastic, 'get_client', lambda hostname, port: client)
+    return elastic.MetanetElastic(), client
+
+
+def test_rows_are_paged_until_after_key_is_missing(monkeypatch):
+    buckets = fld_buckets(30)
+    es, client = report_client(monkeypatch, buckets)
+
+    rows = list(report.report_rows(es, 'flds', page_size=10))
+
+    assert [row['fld'] for row in rows] \
+        == [bucket['key']['fld'] for bucket in buckets]
+    # Full last page without after_key is not followed by another request
+    assert client.searches == [None, buckets[9]['key'], buckets[19]['key']]
+
+
+def test_top_rows_match_full_sort(monkeypatch):
+    buckets = fld_buckets(95)
+    es, client = report_client(monkeypatch, buckets)
+
+    rows = list(report.report_rows(es, 'flds', top=7, page_size=10))
+
+    expected = sorted(buckets, key=lambda bucket: bucket['doc_count'],
+                      reverse=True)[:7]
+    assert [(row['fld'], row['packets']) for row in rows] \
+        == [(bucket['key']['fld'], bucket['doc_count'])
+            for bucket in expected]
+    assert len(client.searches) == 10
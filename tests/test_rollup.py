@@ -0,0 +1,54 @@
+import json
+from rollup import RollupAggregator
+from packet import Packet, HostTable
+
+
+def packets(capture=None, count=400):
+    hosts = HostTable()
+    for host, fld in (('a.example.com', 'example.com'),
+                      ('b.example.org', 'example.org')):
+        hosts.get(host).fld = fld
+        hosts.get(host).resource_type = 'other'
+    for frame in range(1, count + 1):
+        yield Packet(1577836800 + frame * 1.5, frame, frame, 4,
+                     frame % 7, 40000, hosts.get('client'),
+                     frame % 2, 443,
+                     hosts.get(('a.example.com', 'b.example.org')[frame % 2]),
+                     capture)
+
+
+def rollups(aggregator, packets):
+    documents = []
+    for packet in packets:
+        aggregator.observe(packet)
+        documents.extend(aggregator.closed())
+    return documents
+
+
+def test_late_packets_do_not_overwrite_rollups():
+    aggregator = RollupAggregator()
+    documents = rollups(aggregator, packets())
+    late = next(packets())
+    aggregator.observe(late)
+    documents.extend(aggregator.flush())
+
+    assert aggregator.late_packets == 1
+    assert all(document_id is not None for document_id, _ in documents)
+    assert len({document_id for document_id, _ in documents}) \
+        == len(documents)
+    assert sum(document['packets'] for _, document in documents) == 400
+
+
+def test_restored_rollups_continue_counts():
+    whole = RollupAggregator()
+    expected = dict(rollups(whole, packets('capture')))
+    expected.update(whole.flush())
+
+    first = RollupAggregator()
+    documents = dict(rollups(first, list(packets('capture'))[:250]))
+    resumed = RollupAggregator()
+    resumed.restore(json.loads(json.dumps(first.state())))
+    documents.update(rollups(resumed, list(packets('capture'))[250:]))
+    documents.update(resumed.flush())
+
+    assert documents == expected
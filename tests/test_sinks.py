@@ -0,0 +1,17 @@
+import sinks
+from test_rollup import packets
+
+
+def write_bulk(path, max_bytes):
+    with sinks.BulkSink(path, max_bytes) as sink:
+        for packet in packets('capture'):
+            sink.write(packet)
+    return sink.parts
+
+
+def test_bulk_parts_of_previous_run_are_removed(tmp_path):
+    path = str(tmp_path / 'packets.bulk')
+    assert len(write_bulk(path, 4096)) > 2
+    parts = write_bulk(path, 1024 * 1024)
+    assert len(parts) == 1
+    assert sinks.part_paths(path) == parts
@@ -0,0 +1,67 @@
+import itertools
+import watch
+from captures import conversations_capture
+
+
+def run_watch(directory, checkpoint_path, acknowledged=None):
+    '''Reads completed captures, acknowledging at most acknowledged
+    packets. Returns frames read'''
+    checkpoint = watch.CaptureCheckpoint(checkpoint_path)
+    checkpoint.load()
+    packets = list(watch.watch_packets(directory, checkpoint,
+                                       backend='native', settle_time=0,
+                                       once=True))
+    for index in range(0, len(packets[:acknowledged]), 10):
+        checkpoint.acknowledge(packets[index:index + 10])
+    checkpoint.save()
+    return [packet.frame for packet in packets]
+
+
+def test_watch_resumes_from_acknowledged_frame(tmp_path):
+    capture_path = tmp_path / 'captures' / 'metanet.pcap'
+    capture_path.parent.mkdir()
+    conversations_capture(str(capture_path))
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+
+    frames = run_watch(str(capture_path.parent), checkpoint_path, 20)
+    assert len(frames) > 20
+    assert run_watch(str(capture_path.parent), checkpoint_path) \
+        == frames[20:]
+    assert run_watch(str(capture_path.parent), checkpoint_path) == []
+
+    # Appended file is read from its last acknowledged frame
+    other_path = tmp_path / 'other.pcap'
+    conversations_capture(str(other_path))
+    with open(capture_path, 'ab') as capture_file:
+        capture_file.write(other_path.read_bytes()[24:])
+    appended = run_watch(str(capture_path.parent), checkpoint_path)
+    assert len(appended) == len(frames)
+    assert min(appended) > max(frames)
+
+
+def test_watch_reads_failed_file_again(tmp_path):
+    capture_path = tmp_path / 'captures' / 'metanet.pcap'
+    capture_path.parent.mkdir()
+    conversations_capture(str(capture_path))
+    frames = run_watch(str(capture_path.parent),
+                       str(tmp_path / 'reference.json'))
+
+    checkpoint = watch.CaptureCheckpoint(str(tmp_path / 'checkpoint.json'))
+    packets = watch.watch_packets(str(capture_path.parent), checkpoint,
+                                  backend='native', settle_time=0,
+                                  poll_interval=0)
+    read = list(itertools.islice(packets, len(frames)))
+    checkpoint.acknowledge(read[:10])
+    checkpoint.acknowledge(read[10:20], retry_needed=True)
+    # Chunks indexed after the failure do not move the checkpoint
+    checkpoint.acknowledge(read[20:])
+    assert not checkpoint.rolls_up(read[-1])
+    entry = checkpoint.files['metanet.pcap']
+    assert entry['frame'] == frames[9] and not entry['complete']
+
+    again = list(itertools.islice(packets, len(frames) - 10))
+    packets.close()
+    assert [packet.frame for packet in again] == frames[10:]
+    checkpoint.acknowledge(again)
+    assert checkpoint.rolls_up(again[-1])
+    assert entry['frame'] == frames[-1] and entry['complete']